@@ -1,13 +1,15 @@
 import os
+import json
 from django.contrib import admin
-from django.urls import reverse
+from django.urls import reverse, path
+from django.template.response import TemplateResponse
 from django.utils.html import format_html
 from django.utils.safestring import mark_safe
 from django.db.models import Count
 from datetime import datetime, timedelta
 from django.db.models import Exists, OuterRef, Q
 from urllib.parse import urlparse
-from django_common_task_system.producer import producer_agent
+from django_common_task_system.producer import producer_agent, summarize_metrics
 from django_common_task_system.system_task_execution import consumer_agent
 from django_common_task_system.schedule import util as schedule_util
 from . import get_task_model, get_schedule_model, get_schedule_log_model
@@ -156,6 +158,7 @@ class ScheduleAdmin(BaseAdmin):
         ("timing_period", "timing_time",),
         "timing_datetime",
         ("schedule_start_time", "schedule_end_time"),
+        ("catch_up", "catch_up_limit", "spread"),
         'callback',
         'next_schedule_time',
         'config',
@@ -244,6 +247,32 @@ class ScheduleAdmin(BaseAdmin):
     def get_queryset(self, request):
         return super().get_queryset(request).select_related('task')
 
+    def get_urls(self):
+        return [
+            path('forecast/', self.admin_site.admin_view(self.forecast_view), name='schedule-forecast-view'),
+        ] + super(ScheduleAdmin, self).get_urls()
+
+    def forecast_view(self, request):
+        try:
+            hours = min(max(int(request.GET.get('hours', 24)), 1), schedule_util.FORECAST_MAX_HOURS)
+            bucket = max(int(request.GET.get('bucket', 60)), 1)
+        except ValueError:
+            hours, bucket = 24, 60
+        forecast = schedule_util.get_schedule_forecast(hours=hours, bucket=bucket)
+        peak = forecast['peak']['count'] if forecast['peak'] else 0
+        for row in forecast['histogram']:
+            row['width'] = row['count'] * 100 // peak
+        context = dict(
+            self.admin_site.each_context(request),
+            opts=self.model._meta,
+            title='计划负载预测',
+            hours=hours,
+            max_hours=schedule_util.FORECAST_MAX_HOURS,
+            bucket=bucket,
+            forecast=forecast,
+        )
+        return TemplateResponse(request, 'admin/django_common_task_system/schedule/forecast.html', context)
+
     class Media:
         js = (
             'https://cdn.bootcss.com/jquery/3.3.1/jquery.min.js',
@@ -688,16 +717,22 @@ class OverviewAdmin(admin.ModelAdmin):
     def action_producer(obj: models.Overview):
         return OverviewAdmin.action_program('producer-action', producer_agent)
 
+    @staticmethod
+    def action_producer_metrics(obj: models.Overview):
+        return '<a href="%s" target="_blank">查看详情</a>' % reverse('producer-action', args=('metrics',))
+
     @staticmethod
     def action_consumer(obj: models.Overview):
         return OverviewAdmin.action_program('system-consumer-action', consumer_agent)
 
     @staticmethod
     def action_enabled_schedule(obj: models.Overview):
-        return '<a href="/admin/django_common_task_system/%s/?status__exact=%s" target="_blank">查看详情</a>' % (
-            Schedule._meta.model_name,
-            ScheduleStatus.OPENING
-        )
+        return '<a href="/admin/django_common_task_system/%s/?status__exact=%s" target="_blank">查看详情</a>' \
+               '&nbsp;&nbsp;|&nbsp;&nbsp;<a href="%s" target="_blank">负载预测</a>' % (
+                   Schedule._meta.model_name,
+                   ScheduleStatus.OPENING,
+                   reverse('admin:schedule-forecast-view')
+               )
 
     @staticmethod
     def action_failed_schedule(obj: models.Overview):
@@ -734,6 +769,7 @@ class OverviewAdmin(admin.ModelAdmin):
             "程序状态": "运行中" if state.is_running else "已停止",
             "已调度计划数量": state.scheduled_count,
             "最近调度时间": state.last_schedule_time,
+            "配置缓存命中率": state.config_cache_hit_rate,
             "日志文件": state.log_file.replace(os.getcwd(), '')
         }
         model.objects['producer'] = model(
@@ -742,6 +778,27 @@ class OverviewAdmin(admin.ModelAdmin):
             position=2
         )
 
+        metrics = state.metrics
+        if isinstance(metrics, bytes):
+            metrics = metrics.decode()
+        summary = summarize_metrics(json.loads(metrics) if metrics else [])
+        model.objects['producer_metrics'] = model(
+            name="计划调度统计",
+            state={
+                "统计轮数": summary.get('ticks', 0),
+                "扫描计划数": summary.get('rows', 0),
+                "各队列生产数量": summary.get('items', {}),
+                "生产速率(个/秒)": summary.get('enqueue_rate', 0),
+                "当前调度延迟(秒)": summary.get('lag', 0),
+                "最大调度延迟(秒)": summary.get('max_lag', 0),
+                "平均查询耗时(秒)": summary.get('avg_query', 0),
+                "平均计算耗时(秒)": summary.get('avg_compute', 0),
+                "平均序列化耗时(秒)": summary.get('avg_serialize', 0),
+                "平均入队耗时(秒)": summary.get('avg_enqueue', 0),
+            },
+            position=2
+        )
+
         model.objects['enabled_schedule'] = model(
             name="计划概览",
             state={
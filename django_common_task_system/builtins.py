@@ -266,15 +266,13 @@ class Tasks(BuiltinModels):
             }
         )
 
-        interval = 1
-        unit = 'month'
+        # 按名称由LogCleanExecutor执行, 不再执行SQL, 参数见schedule.retention.LogRetention
         self.log_clean = self.model(
             name='日志清理',
             parent=self.sql_execution,
             category=categories.system_task,
             config={
-                'script': 'delete from %s where create_time < date_sub(now(), interval %s %s);' %
-                       (ScheduleLogModel._meta.db_table, interval, unit)
+                'retention_days': 30,
             },
         )
 
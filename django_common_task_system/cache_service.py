@@ -5,6 +5,8 @@ import inspect
 import os
 import socket
 import importlib
+import heapq
+import itertools
 import time
 from asyncio import StreamReader, StreamWriter
 from datetime import datetime
@@ -68,6 +70,24 @@ class HttpResponse(BaseResponse):
 HTTPNullResponse = HttpResponse('')
 
 
+class PriorityQueue(asyncio.PriorityQueue):
+    """
+    优先级高的先出队, 同一优先级先进先出, put的数据为(priority, value), get只返回value,
+    所有优先级都为0时与先进先出队列一致
+    """
+
+    def _init(self, maxsize):
+        super(PriorityQueue, self)._init(maxsize)
+        self._counter = itertools.count()
+
+    def _put(self, item):
+        priority, value = item
+        heapq.heappush(self._queue, (-priority, next(self._counter), value))
+
+    def _get(self):
+        return heapq.heappop(self._queue)[-1]
+
+
 class Queue:
     def __init__(self, queue: asyncio.Queue, name):
         self.name = name
@@ -112,25 +132,113 @@ class TTLString(str):
         return time.time() - self.create_time > self.expire
 
 
+class SortedSet(dict):
+    """
+    有序集合, dict保存成员和分数, 同时用最小堆维护分数顺序,
+    成员被删除或分数被修改后堆中的旧条目在弹出时惰性丢弃
+    """
+
+    def __init__(self):
+        super(SortedSet, self).__init__()
+        self._heap = []
+
+    def add(self, member, score: float) -> int:
+        added = 0 if member in self else 1
+        self[member] = score
+        heapq.heappush(self._heap, (score, member))
+        return added
+
+    def remove(self, member) -> int:
+        return 0 if self.pop(member, None) is None else 1
+
+    def _clean(self):
+        heap = self._heap
+        while heap and self.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+
+    def peek(self):
+        self._clean()
+        return self._heap[0] if self._heap else None
+
+    def pop_by_score(self, max_score: float, count=0) -> List:
+        members = []
+        heap = self._heap
+        while not count or len(members) < count:
+            self._clean()
+            if not heap or heap[0][0] > max_score:
+                break
+            score, member = heapq.heappop(heap)
+            del self[member]
+            members.append(member)
+        return members
+
+
+class DelayedQueue:
+    """
+    延迟队列, 按投递时间维护最小堆, deliver任务只在最早的投递时间醒来, 把到期数据放入目标队列,
+    有更早的数据加入时通过event提前唤醒, 不需要轮询
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._seq = 0
+        self._event: Optional[asyncio.Event] = None
+        self.counts: Dict[str, int] = {}
+
+    def push(self, qname, deliver_at: float, *values, priority=0):
+        heap = self._heap
+        earliest = heap[0][0] if heap else None
+        for value in values:
+            self._seq += 1
+            heapq.heappush(heap, (deliver_at, self._seq, qname, priority, value))
+        self.counts[qname] = self.counts.get(qname, 0) + len(values)
+        if self._event is not None and (earliest is None or deliver_at < earliest):
+            self._event.set()
+
+    def deliver_due(self, now: float) -> int:
+        heap = self._heap
+        delivered = 0
+        while heap and heap[0][0] <= now:
+            _, _, qname, priority, value = heapq.heappop(heap)
+            self.counts[qname] -= 1
+            if not self.counts[qname]:
+                del self.counts[qname]
+            get_or_create_queue(qname).put_nowait((priority, value))
+            delivered += 1
+        return delivered
+
+    async def deliver(self):
+        self._event = asyncio.Event()
+        while True:
+            self.deliver_due(time.time())
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            self._event.clear()
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
 _queue_header_pattern = re.compile(r'(?P<command>\w+) ((?P<queue_name>[\w:/\.]+) )?QUEUE/1.0\r\n')
 _http_header_pattern = re.compile(r'(?P<command>\w+) (?P<url>\S+) HTTP/1.1\r\n')
 _http_path_pattern = re.compile(r'/(?P<path>\w+)?\??(?P<query>.*)')
 _queue_mapping: Dict[str, Queue] = {}
 _cache_mapping: Dict[str, Union[TTLString, Dict, List]] = {}
+_delayed_queue = DelayedQueue()
 
 
 Command = Callable[[Optional[str], Optional[asyncio.Queue], ...], Union[Response, HttpResponse, Coroutine]]
 
 
-def get_or_create_queue(qname) -> asyncio.Queue:
+def get_or_create_queue(qname) -> PriorityQueue:
     queue = _queue_mapping.get(qname)
     if queue is None:
-        queue = Queue(asyncio.Queue(), qname)
+        queue = Queue(PriorityQueue(), qname)
         _queue_mapping[qname] = queue
     return queue.queue
 
 
-def get_queue(qname) -> Union[asyncio.Queue, None]:
+def get_queue(qname) -> Union[PriorityQueue, None]:
     queue = _queue_mapping.get(qname)
     if queue is None:
         return None
@@ -151,7 +259,8 @@ def _list():
         'queues': [{
             'name': x.name,
             'create_time': x.create_time.strftime('%Y-%m-%d %H:%M:%S'),
-            'size': x.queue.qsize()
+            'size': x.queue.qsize(),
+            'delayed': _delayed_queue.counts.get(x.name, 0),
         } for x in _queue_mapping.values()],
         **cache
     }
@@ -167,7 +276,7 @@ def _qpop(qname):
         return None
 
 
-async def _qbpop(qname, timeout: int = 0):
+async def _qbpop(qname, timeout: float = 0):
     queue = get_or_create_queue(qname)
     if timeout <= 0:
         return await queue.get()
@@ -177,15 +286,67 @@ async def _qbpop(qname, timeout: int = 0):
         return None
 
 
-def _qpush(*values, qname=None):
+def _qpush(*values, qname=None, priority: int = 0):
+    """
+    priority越大越先出队, 同一优先级先进先出
+    """
     if not values:
         raise Exception("message is empty")
     queue = get_or_create_queue(qname)
     for value in values:
-        queue.put_nowait(value)
+        queue.put_nowait((priority, value))
     return len(values)
 
 
+def _qpush_at(*values, qname=None, deliver_at: float = 0, priority: int = 0):
+    """
+    在deliver_at(时间戳)时把数据放入队列qname
+    """
+    if not values:
+        raise Exception("message is empty")
+    if deliver_at <= time.time():
+        return _qpush(*values, qname=qname, priority=priority)
+    get_or_create_queue(qname)
+    _delayed_queue.push(qname, deliver_at, *values, priority=priority)
+    return len(values)
+
+
+def _get_sorted_set(name, create=False) -> Optional[SortedSet]:
+    zset = _cache_mapping.get(name)
+    if zset is None:
+        if create:
+            zset = _cache_mapping[name] = SortedSet()
+        return zset
+    if not isinstance(zset, SortedSet):
+        raise Exception("key %s is not a sorted set, the type is %s" % (name, type(zset)))
+    return zset
+
+
+def _zadd(name, data: str):
+    mapping = json.loads(data)
+    zset = _get_sorted_set(name, create=True)
+    return sum(zset.add(member, float(score)) for member, score in mapping.items())
+
+
+def _zpopbyscore(name, max_score: float = float('inf'), count: int = 0):
+    zset = _get_sorted_set(name)
+    if zset is None:
+        return []
+    return zset.pop_by_score(max_score, count=count)
+
+
+def _zrem(*members, name=None):
+    zset = _get_sorted_set(name)
+    if zset is None:
+        return 0
+    return sum(zset.remove(member) for member in members)
+
+
+def _zcard(name):
+    zset = _get_sorted_set(name)
+    return 0 if zset is None else len(zset)
+
+
 def _pop(name):
     clist = _cache_mapping.get(name)
     if not clist:
@@ -334,6 +495,11 @@ _available_commands = {
     'qpop': _qpop,
     'qbpop': _qbpop,
     'qpush': _qpush,
+    'qpush_at': _qpush_at,
+    'zadd': _zadd,
+    'zpopbyscore': _zpopbyscore,
+    'zrem': _zrem,
+    'zcard': _zcard,
     'delete': _delete,
     'llen': _llen,
     'set': _set,
@@ -473,6 +639,8 @@ async def main():
     server = await asyncio.start_server(handle_client, sock=server_socket, limit=2 ** 10 * 2 ** 10)
     addr = server_socket.getsockname()
     print(f'Cacheing Serving on {addr}')
+    # 保留task引用, 防止被垃圾回收
+    delivery_task = asyncio.create_task(_delayed_queue.deliver())
     await run_cache_manager()
     async with server:
         await server.serve_forever()
@@ -565,7 +733,9 @@ class CacheAgent:
     def delete(self, key):
         return self.execute('delete', key)
 
-    def qpush(self, key, *value):
+    def qpush(self, key, *value, priority=0):
+        if priority:
+            return self.execute('qpush', *value, qname=key, priority=priority)
         return self.execute('qpush', *value, qname=key)
 
     def qpop(self, key):
@@ -574,6 +744,23 @@ class CacheAgent:
     def qbpop(self, key, timeout=0):
         return self.execute('qbpop', qname=key, timeout=timeout)
 
+    def qpush_at(self, key, deliver_at: Union[datetime, float], *value, priority=0):
+        if isinstance(deliver_at, datetime):
+            deliver_at = deliver_at.timestamp()
+        return self.execute('qpush_at', *value, qname=key, deliver_at=deliver_at, priority=priority)
+
+    def zadd(self, name, mapping: Dict[str, float]):
+        return int(self.execute('zadd', name, data=mapping))
+
+    def zpopbyscore(self, name, max_score: float = float('inf'), count=0) -> List[str]:
+        return json.loads(self.execute('zpopbyscore', name, max_score=max_score, count=count))
+
+    def zrem(self, name, *members):
+        return int(self.execute('zrem', *members, name=name))
+
+    def zcard(self, name):
+        return int(self.execute('zcard', name))
+
     def push(self, key, *value):
         return self.execute('push', *value, name=key)
 
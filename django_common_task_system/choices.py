@@ -30,6 +30,12 @@ class ScheduleTimingType(TextChoices):
     DATETIME = 'DATETIME', '自选日期'
 
 
+class ScheduleCatchUpPolicy(TextChoices):
+    ALL = 'all', '补偿全部'
+    LATEST = 'latest', '仅最近一次'
+    AT_MOST = 'at_most', '最多N次'
+
+
 class ScheduleCallbackStatus(TextChoices):
     ENABLE = 'E', '启用'
     DISABLE = 'D', '禁用'
@@ -57,10 +63,18 @@ class ScheduleQueueModule(TextChoices):
     # PRIORITY_QUEUE = "%s.%s" % (queue.PriorityQueue.__module__, queue.PriorityQueue.__name__), '优先级队列'
     # SIMPLE_QUEUE = "%s.%s" % (queue.SimpleQueue.__module__, queue.SimpleQueue.__name__), '简单队列'
     REDIS_FIFO = "django_common_task_system.queue.redis.RedisFIFOQueue", 'Redis先进先出队列'
+    PRIORITY = "django_common_task_system.queue.SocketPriorityQueue", '优先级队列'
     REDIS_LIFO = "django_common_task_system.queue.redis.RedisLIFOQueue", 'Redis后进先出队列'
+    REDIS_PRIORITY = "django_common_task_system.queue.redis.RedisPriorityQueue", 'Redis优先级队列'
     # MULTIPROCESS_QUEUE = "multiprocessing.Queue", '多进程队列'
 
 
+class ProducerMode(TextChoices):
+    SINGLE = 'single', '单实例'
+    SHARD = 'shard', '按ID哈希分片'
+    CLAIM = 'claim', '行锁认领'
+
+
 class PermissionType(TextChoices):
     IP_WHITE_LIST = 'I', 'IP白名单'
 
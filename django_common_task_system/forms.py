@@ -7,7 +7,7 @@ from django.conf import settings
 from django.contrib.admin import widgets
 from django.utils.module_loading import import_string
 from django_common_task_system.choices import (
-    ScheduleType, ScheduleTimingType, ScheduleStatus, TaskStatus)
+    ScheduleType, ScheduleTimingType, ScheduleStatus, TaskStatus, ScheduleCatchUpPolicy)
 from django_common_objects.widgets import JSONWidget
 from django_common_task_system.utils import foreign_key
 from datetime import datetime, time as datetime_time
@@ -187,6 +187,12 @@ class ScheduleForm(forms.ModelForm):
     timing_period = forms.IntegerField(required=False, min_value=1, initial=1, label='频率', widget=PeriodWidget)
     timing_time = forms.TimeField(required=False, initial=datetime_time(),
                                   label="时间", widget=widgets.AdminTimeWidget)
+    catch_up = forms.ChoiceField(required=False, label="错过补偿", choices=ScheduleCatchUpPolicy.choices,
+                                 initial=ScheduleCatchUpPolicy.ALL, help_text="停机或积压后错过的计划时间如何补偿")
+    catch_up_limit = forms.IntegerField(required=False, min_value=1, label='最多补偿次数',
+                                        help_text="仅在补偿策略为最多N次时有效")
+    spread = forms.IntegerField(required=False, min_value=0, label='分散窗口(秒)',
+                                help_text="在该窗口内按任务id固定偏移运行时间, 避免同一时刻运行的计划过多")
     config = forms.JSONField(required=False, initial={}, label="配置",
                              widget=JSONWidget(attrs={'readonly': 'readonly'})
                              )
@@ -200,6 +206,9 @@ class ScheduleForm(forms.ModelForm):
             type_config = config[schedule_type]
             self.initial['nlp_sentence'] = config.get('nlp-sentence')
             self.initial['base_on_now'] = config.get('base_on_now', False)
+            self.initial['catch_up'] = config.get('catch_up', ScheduleCatchUpPolicy.ALL.value)
+            self.initial['catch_up_limit'] = config.get('catch_up_limit')
+            self.initial['spread'] = config.get('spread', 0)
             if schedule_type == ScheduleType.CONTINUOUS:
                 t = datetime.strptime(type_config['schedule_start_time'], '%Y-%m-%d %H:%M:%S')
                 self.initial['period_schedule'] = [t, type_config['period']]
@@ -228,8 +237,10 @@ class ScheduleForm(forms.ModelForm):
         cleaned_data.pop("config", None)
         schedule = ScheduleConfig(**cleaned_data)
         cleaned_data['config'] = schedule.config
+        task = cleaned_data.get('task')
         cleaned_data['next_schedule_time'] = schedule.get_current_time(
-            start_time=cleaned_data.get('schedule_start_time', None)
+            start_time=cleaned_data.get('schedule_start_time', None),
+            key=task.id if task else None
         )
         base_on_now = cleaned_data.get('base_on_now', False)
         is_strict = cleaned_data.get('is_strict', False)
@@ -0,0 +1,62 @@
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def backfill_schedule_attempts(apps, schema_editor):
+    # 按已有日志生成计划执行统计
+    ScheduleLog = apps.get_model(*settings.SCHEDULE_LOG_MODEL.split('.'))
+    ScheduleAttempt = apps.get_model('django_common_task_system', 'ScheduleAttempt')
+    records = ScheduleLog.objects.values('schedule_id', 'queue', 'schedule_time').annotate(
+        attempts=Count('id'),
+        last_log_id=Max('id'),
+        update_time=Max('create_time'),
+    ).order_by().iterator(chunk_size=2000)
+
+    def flush(batch):
+        status = dict(ScheduleLog.objects.filter(id__in=[x['last_log_id'] for x in batch]).values_list('id', 'status'))
+        ScheduleAttempt.objects.bulk_create([ScheduleAttempt(last_status=status[x['last_log_id']], **x) for x in batch])
+
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= 2000:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.SCHEDULE_MODEL),
+        migrations.swappable_dependency(settings.SCHEDULE_LOG_MODEL),
+        ('django_common_task_system', '0005_alter_schedulequeue_module'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduleAttempt',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('queue', models.CharField(max_length=100, verbose_name='队列')),
+                ('schedule_time', models.DateTimeField(verbose_name='计划时间')),
+                ('attempts', models.IntegerField(default=0, verbose_name='执行次数')),
+                ('last_status', models.CharField(choices=[('I', '初始化'), ('R', '运行中'), ('S', '运行成功'), ('E', '执行成功了，结果为空'), ('N', '无需重试的异常'), ('X', '运行异常'), ('P', '部分失败'), ('F', '任务失败, 无需重试'), ('T', '超时')], max_length=1, verbose_name='最后运行状态')),
+                ('last_log_id', models.IntegerField(default=0, verbose_name='最后日志ID')),
+                ('update_time', models.DateTimeField(default=django.utils.timezone.now, verbose_name='最后运行时间')),
+                ('schedule', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='attempts', to=settings.SCHEDULE_MODEL, verbose_name='任务计划')),
+            ],
+            options={
+                'verbose_name': '计划执行统计',
+                'verbose_name_plural': '计划执行统计',
+                'db_table': 'schedule_attempt',
+                'unique_together': {('queue', 'schedule', 'schedule_time')},
+                'indexes': [models.Index(fields=['queue', 'last_status', 'update_time'], name='schedule_at_queue_f394b2_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_schedule_attempts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_common_task_system', '0006_scheduleattempt'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scheduleattempt',
+            name='next_retry_time',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='重试时间'),
+        ),
+        migrations.AddIndex(
+            model_name='scheduleattempt',
+            index=models.Index(fields=['queue', 'last_status', 'next_retry_time'], name='schedule_at_queue_cfb1df_idx'),
+        ),
+    ]
@@ -1,6 +1,8 @@
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models.signals import post_save
+from django.dispatch import receiver
 from django_common_task_system.choices import (
     TaskStatus, ScheduleStatus, ScheduleCallbackStatus,
     ScheduleCallbackEvent, ScheduleQueueModule, ConsumerStatus, ProgramType,
@@ -10,7 +12,7 @@ from django_common_objects.models import CommonTag, CommonCategory
 from django_common_objects import fields as common_fields
 from datetime import datetime
 from django.core.validators import ValidationError
-from django_common_task_system.schedule.config import ScheduleConfig
+from django_common_task_system.schedule.config import get_schedule_config
 from django_common_task_system.utils import foreign_key
 from django_common_task_system.schedule import util as schedule_util
 from django_common_task_system.utils import ip as ip_utils
@@ -115,6 +117,13 @@ class AbstractSchedule(models.Model):
 
     __repr__ = __str__
 
+    @property
+    def schedule_config(self):
+        """
+        解析后的计划配置, 按计划id缓存, config没有变化时不再计算配置指纹
+        """
+        return get_schedule_config(self.config, key=self.pk)
+
     def __lt__(self, other):
         return self.priority < other.priority
 
@@ -126,7 +135,8 @@ class Schedule(AbstractSchedule):
 
     def generate_next_schedule(self):
         try:
-            self.next_schedule_time = ScheduleConfig(config=self.config).get_next_time(self.next_schedule_time)
+            self.next_schedule_time = self.schedule_config.get_next_time(
+                self.next_schedule_time, key=self.task_id)
         except Exception as e:
             self.status = ScheduleStatus.ERROR.value
             self.save(update_fields=('status',))
@@ -207,6 +217,63 @@ class ScheduleLog(models.Model):
     __repr__ = __str__
 
 
+class ScheduleAttempt(models.Model):
+    """
+    按(计划, 队列, 计划时间)汇总的执行记录, 写入日志时更新, 异常重试等统计直接查询该表, 不再对日志表分组
+    """
+    id = models.AutoField(primary_key=True)
+    schedule = models.ForeignKey(settings.SCHEDULE_MODEL, db_constraint=False, on_delete=models.CASCADE,
+                                 verbose_name='任务计划', related_name='attempts')
+    queue = models.CharField(max_length=100, verbose_name='队列')
+    schedule_time = models.DateTimeField(verbose_name='计划时间')
+    attempts = models.IntegerField(default=0, verbose_name='执行次数')
+    last_status = models.CharField(max_length=1, verbose_name='最后运行状态', choices=ExecuteStatus.choices)
+    last_log_id = models.IntegerField(default=0, verbose_name='最后日志ID')
+    update_time = models.DateTimeField(default=timezone.now, verbose_name='最后运行时间')
+    # 异常处理放入重试的投递时间, 为空表示还没有安排重试
+    next_retry_time = models.DateTimeField(null=True, blank=True, verbose_name='重试时间')
+
+    class Meta:
+        verbose_name = verbose_name_plural = '计划执行统计'
+        db_table = 'schedule_attempt'
+        unique_together = ('queue', 'schedule', 'schedule_time')
+        indexes = [
+            models.Index(fields=['queue', 'last_status', 'update_time']),
+            models.Index(fields=['queue', 'last_status', 'next_retry_time']),
+        ]
+
+    @classmethod
+    def update_from_log(cls, log):
+        queryset = cls.objects.filter(queue=log.queue, schedule_id=log.schedule_id, schedule_time=log.schedule_time)
+        # 只用更新的日志覆盖最后状态, 先写入的日志后到达时只增加次数; 有新的日志说明重试已经执行
+        if queryset.filter(last_log_id__lt=log.id).update(
+                attempts=models.F('attempts') + 1, last_status=log.status,
+                last_log_id=log.id, update_time=log.create_time, next_retry_time=None):
+            return
+        if queryset.update(attempts=models.F('attempts') + 1):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(queue=log.queue, schedule_id=log.schedule_id, schedule_time=log.schedule_time,
+                                   attempts=1, last_status=log.status, last_log_id=log.id,
+                                   update_time=log.create_time)
+        except IntegrityError:
+            # 其它进程同时写入了同一个计划时间的日志
+            cls.update_from_log(log)
+
+    def __str__(self):
+        return "schedule: %s, time: %s, attempts: %s" % (self.schedule_id, self.schedule_time, self.attempts)
+
+    __repr__ = __str__
+
+
+# 系统任务的日志在Engine进程中写入, 该进程不会导入views, 所以在这里注册
+@receiver(post_save, sender=settings.SCHEDULE_LOG_MODEL, dispatch_uid='update_schedule_attempt')
+def update_schedule_attempt(sender, instance, created, **kwargs):
+    if created:
+        ScheduleAttempt.update_from_log(instance)
+
+
 class ScheduleQueuePermission(models.Model):
     id = models.AutoField(primary_key=True, verbose_name='ID')
     queue = models.ForeignKey(ScheduleQueue, db_constraint=False, on_delete=models.CASCADE, verbose_name='队列')
@@ -466,7 +533,7 @@ class ExceptionScheduleManager(CustomManager):
         return queryset
 
     def get_maximum_retries_exceeded_queryset(self, queue: str, schedule: Schedule):
-        records = schedule_util.get_maximum_retries_exceeded_records(schedule)
+        records = schedule_util.get_maximum_retries_exceeded_records(queue)
         if schedule is not None:
             records = records.filter(schedule=schedule.id)
         return self.records_to_queryset(records, schedule, queue, ScheduleExceptionReason.MAXIMUM_RETRIES_EXCEEDED)
@@ -1,16 +1,25 @@
 from django.conf import settings
-from django_common_task_system.choices import ScheduleStatus
+from django.db import transaction, close_old_connections
+from django.db.models.functions import Mod
+from django_common_task_system.choices import ScheduleStatus, ProducerMode
 from django_common_task_system.builtins import builtins
-from django_common_task_system import get_schedule_model, get_schedule_serializer
-from django_common_task_system.models import AbstractSchedule
+from django_common_task_system import get_schedule_model, get_schedule_serializer, get_task_model
+from django_common_task_system.cache_service import cache_agent, CacheAgent, MapKey
+from django_common_task_system.models import AbstractSchedule, ScheduleCallback
 from django_common_task_system.program import LocalProgram, ProgramAgent, ProgramState, Key
-from django_common_task_system.schedule.config import ScheduleConfig
-from datetime import datetime
+from django_common_task_system.schedule.config import schedule_config_cache
+from datetime import datetime, timedelta
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import json
+import socket
 import time
+import os
 import threading
 
 
 Schedule: AbstractSchedule = get_schedule_model()
+Task = get_task_model()
 ScheduleSerializer = get_schedule_serializer()
 
 
@@ -20,58 +29,476 @@ class ProducerState(ProgramState):
         self.scheduled_count = 0
         self.last_schedule_time = ''
         self.log_file = ''
+        self.mode = ProducerMode.SINGLE.value
+        self.shard = ''
+        self.config_cache_hit_rate = 0
+        self.metrics = '[]'
+
+
+class ProducerCoordinator:
+    """
+    多生产者协调, 每个生产者实例在cache_agent中维护一个心跳租约,
+    存活的实例按member_id排序, 实例只负责 id % total == index 的计划, 实例加入或租约过期后自动重新分片
+    """
+    members_key = MapKey('producers:members')
+
+    def __init__(self, lease=10):
+        self.member_id = '%s:%s' % (socket.gethostname(), os.getpid())
+        self.lease = lease
+        self.index = 0
+        self.total = 1
+
+    @staticmethod
+    def _decode(value):
+        return value.decode() if isinstance(value, bytes) else value
+
+    def heartbeat(self):
+        now = time.time()
+        cache_agent.hset(self.members_key, self.member_id, str(now))
+        members = cache_agent.hgetall(self.members_key) or {}
+        alive = []
+        for member, beat in members.items():
+            member = self._decode(member)
+            if now - float(self._decode(beat)) > self.lease:
+                cache_agent.hdel(self.members_key, member)
+            else:
+                alive.append(member)
+        if self.member_id not in alive:
+            alive.append(self.member_id)
+        alive.sort()
+        self.index, self.total = alive.index(self.member_id), len(alive)
+        return self.index, self.total
+
+    def leave(self):
+        cache_agent.hdel(self.members_key, self.member_id)
+
+
+class ModelObjectCache:
+    """
+    按id缓存生产时需要的关联对象(任务、回调), 有数量上限, 超出时淘汰最久未使用的对象,
+    每轮生产开始时调用refresh, 用一次查询淘汰修改过的对象, 取用时不再查询数据库
+    """
+    # 不同机器的时钟可能不一致, 检查修改时多往前查询的秒数
+    clock_skew = 5
+
+    def __init__(self, queryset, maxsize=10000, ttl=300):
+        self.queryset = queryset
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        # 已经检查到的最大update_time
+        self._checked_time = None
+
+    def refresh(self):
+        """
+        查询上次检查之后修改过的对象, update_time与缓存不一致的对象从缓存中淘汰
+        """
+        with self._lock:
+            checked_time = self._checked_time if self._cache else None
+        if checked_time is None:
+            return
+        changed = self.queryset.model.objects.filter(
+            update_time__gte=checked_time - timedelta(seconds=self.clock_skew)).values_list('id', 'update_time')
+        with self._lock:
+            for i, update_time in changed:
+                item = self._cache.get(i)
+                if item is not None and item[1] != update_time:
+                    del self._cache[i]
+                self._checked_time = max(self._checked_time, update_time)
+
+    def get_many(self, ids) -> dict:
+        ids = set(ids)
+        ids.discard(None)
+        now = time.time()
+        objects = {}
+        with self._lock:
+            for i in ids:
+                item = self._cache.get(i)
+                if item is not None and now - item[2] < self.ttl:
+                    objects[i] = item[0]
+        missing = ids - objects.keys()
+        if missing:
+            loaded = {obj.id: obj for obj in self.queryset.filter(id__in=missing)}
+            with self._lock:
+                for i, obj in loaded.items():
+                    self._cache[i] = (obj, obj.update_time, now)
+                    self._cache.move_to_end(i)
+                    if self._checked_time is None or obj.update_time > self._checked_time:
+                        self._checked_time = obj.update_time
+                while len(self._cache) > self.maxsize:
+                    self._cache.popitem(last=False)
+            objects.update(loaded)
+        return objects
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+class TaskCache(ModelObjectCache):
+
+    def get_many(self, ids) -> dict:
+        tasks = super(TaskCache, self).get_many(ids)
+        # 逐层从缓存中补全父任务, 避免序列化时逐个查询
+        pending = list(tasks.values())
+        seen = set(tasks.keys())
+        while pending:
+            parents = super(TaskCache, self).get_many(task.parent_id for task in pending)
+            for task in pending:
+                if task.parent_id in parents:
+                    task.parent = parents[task.parent_id]
+            pending = [task for task in parents.values() if task.id not in seen]
+            seen.update(parents.keys())
+        return tasks
+
+
+class ProduceMetrics:
+    """
+    一轮生产的统计, 耗时单位为秒, query包含读取计划、关联对象和更新计划的数据库耗时
+    """
+    timing_fields = ('query', 'compute', 'serialize', 'enqueue')
+
+    def __init__(self):
+        self.rows = 0
+        self.query = 0.0
+        self.compute = 0.0
+        self.serialize = 0.0
+        self.enqueue = 0.0
+        self.items = {}
+        self.lag = 0.0
+
+    def merge(self, other: 'ProduceMetrics'):
+        self.rows += other.rows
+        for field in self.timing_fields:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+        for queue_code, count in other.items.items():
+            self.items[queue_code] = self.items.get(queue_code, 0) + count
+        self.lag = max(self.lag, other.lag)
+
+    def to_dict(self) -> dict:
+        data = {
+            'rows': self.rows,
+            'items': self.items,
+            'lag': round(self.lag, 3),
+        }
+        for field in self.timing_fields:
+            data[field] = round(getattr(self, field), 6)
+        return data
+
+
+def summarize_metrics(metrics: list) -> dict:
+    """
+    汇总滚动窗口内的生产统计
+    """
+    if not metrics:
+        return {}
+    count = len(metrics)
+    summary = {
+        'ticks': count,
+        'rows': sum(x['rows'] for x in metrics),
+        'items': {},
+        'lag': metrics[-1]['lag'],
+        'max_lag': max(x['lag'] for x in metrics),
+    }
+    for field in ProduceMetrics.timing_fields:
+        summary['avg_%s' % field] = round(sum(x[field] for x in metrics) / count, 6)
+    for x in metrics:
+        for queue_code, n in x['items'].items():
+            summary['items'][queue_code] = summary['items'].get(queue_code, 0) + n
+    duration = metrics[-1]['time'] - metrics[0]['time']
+    total_items = sum(summary['items'].values())
+    summary['enqueue_rate'] = round(total_items / duration, 3) if duration > 0 else total_items
+    return summary
+
+
+producer_wakeup_key = 'producer:wakeup'
+
+
+def notify_producer():
+    """
+    计划变更后通知生产线程提前醒来重新计算, 最多保留一个未处理的通知, 生产线程没有运行时通知不会累积
+    """
+    if isinstance(cache_agent, CacheAgent):
+        if not cache_agent.llen(producer_wakeup_key):
+            cache_agent.qpush(producer_wakeup_key, '1')
+    else:
+        cache_agent.rpush(producer_wakeup_key, '1')
+        cache_agent.ltrim(producer_wakeup_key, 0, 0)
+
+
+def wait_producer_notification(timeout) -> bool:
+    """
+    阻塞等待计划变更通知, 最多等待timeout秒, 收到通知返回True
+    """
+    if timeout <= 0:
+        return False
+    if isinstance(cache_agent, CacheAgent):
+        notified = cache_agent.qbpop(producer_wakeup_key, timeout=timeout) is not None
+        # 合并等待期间的多次通知
+        while notified and cache_agent.qpop(producer_wakeup_key) is not None:
+            pass
+    else:
+        notified = cache_agent.blpop(producer_wakeup_key, timeout=timeout) is not None
+        if notified:
+            cache_agent.delete(producer_wakeup_key)
+    return notified
 
 
 class Producer(LocalProgram):
     state_class = ProducerState
     state_key = Key('producer')
+    # 计算计划时间和序列化时需要的字段, 自定义SCHEDULE_SERIALIZER用到的其它字段会在访问时再查询
+    schedule_fields = ('id', 'task_id', 'callback_id', 'user_id', 'priority', 'next_schedule_time',
+                       'config', 'status', 'is_strict', 'preserve_log', 'update_time')
 
-    def produce(self):
-        state = self.state
-        count = 0
-        now = datetime.now()
-        qsize = getattr(settings, 'PRODUCE_QUEUE_MAX_SIZE', 1000)
-        max_queue_size = qsize * 2
-        schedule_result = {}
-        for producer in builtins.schedule_producers.values():
-            queue_instance = builtins.schedule_queues[producer.queue.code]
+    def __init__(self, *args, **kwargs):
+        super(Producer, self).__init__(*args, **kwargs)
+        self.mode = getattr(settings, 'PRODUCER_MODE', ProducerMode.SINGLE.value)
+        self.claim_batch_size = getattr(settings, 'PRODUCER_CLAIM_BATCH_SIZE', 500)
+        self.chunk_size = getattr(settings, 'PRODUCE_CHUNK_SIZE', 1000)
+        self.min_sleep = getattr(settings, 'PRODUCER_MIN_SLEEP', 0.1)
+        self.max_sleep = getattr(settings, 'PRODUCER_MAX_SLEEP', 60)
+        self.workers = getattr(settings, 'PRODUCER_WORKERS', 4)
+        # 每个生产者每轮最多生产的数量和最长耗时, 超出后留到下一轮, 防止积压严重的队列拖慢其它队列
+        self.producer_budget = getattr(settings, 'PRODUCER_BUDGET', 1000)
+        self.producer_time_slice = getattr(settings, 'PRODUCER_TIME_SLICE', 1)
+        self._executor = None
+        self._rotation = 0
+        # 最近若干轮的生产统计
+        self.metrics_window = deque(maxlen=getattr(settings, 'PRODUCER_METRICS_WINDOW', 60))
+        cache_size = getattr(settings, 'PRODUCER_OBJECT_CACHE_SIZE', 10000)
+        cache_ttl = getattr(settings, 'PRODUCER_OBJECT_CACHE_TTL', 300)
+        self.task_cache = TaskCache(Task.objects.select_related('category').prefetch_related('tags'),
+                                    maxsize=cache_size, ttl=cache_ttl)
+        self.callback_cache = ModelObjectCache(ScheduleCallback.objects.all(), maxsize=cache_size, ttl=cache_ttl)
+        if self.mode == ProducerMode.SHARD:
+            self.coordinator = ProducerCoordinator(lease=getattr(settings, 'PRODUCER_LEASE', 10))
+        else:
+            self.coordinator = None
+
+    def filter_queryset(self, producer):
+        queryset = Schedule.objects.filter(**producer.filters)
+        coordinator = self.coordinator
+        if coordinator is not None and coordinator.total > 1:
+            queryset = queryset.annotate(shard=Mod('id', coordinator.total)).filter(shard=coordinator.index)
+        return queryset
+
+    def get_queryset(self, producer, now):
+        queryset = self.filter_queryset(producer).only(*self.schedule_fields)
+        if producer.lte_now:
+            queryset = queryset.filter(next_schedule_time__lte=now)
+        return queryset
+
+    def get_next_schedule_time(self, producer):
+        """
+        通过next_schedule_time索引查询最早的计划时间
+        """
+        return self.filter_queryset(producer).order_by(
+            'next_schedule_time').values_list('next_schedule_time', flat=True).first()
+
+    def produce_schedule(self, schedule, queue_instance, now, capacity, metrics=None) -> int:
+        """
+        计算schedule在now之前的所有计划时间并放入队列, capacity为队列剩余容量, 返回放入队列的数量
+        """
+        metrics = metrics or ProduceMetrics()
+        schedule_times = []
+        claimed = False
+        put_size = 0
+        try:
+            start = time.perf_counter()
+            schedule_config = schedule.schedule_config
+            # 按补偿策略合并错过的计划时间, 同时限制队列长度, 防止内存溢出
+            schedule_times, next_schedule_time = schedule_config.get_catch_up_times(
+                schedule.next_schedule_time, now, capacity, key=schedule.task_id)
+            metrics.compute += time.perf_counter() - start
+            if not schedule_times and next_schedule_time == schedule.next_schedule_time:
+                return 0
+            start = time.perf_counter()
+            # 过滤条件重叠的生产者并行生产, 或重新分片期间两个实例短暂地认领同一个计划时, 可能同时读到同一个计划,
+            # 用next_schedule_time做CAS, 只有更新成功的才放入队列
+            claimed = Schedule.objects.filter(
+                id=schedule.id, next_schedule_time=schedule.next_schedule_time
+            ).update(next_schedule_time=next_schedule_time) > 0
+            metrics.query += time.perf_counter() - start
+            if not claimed:
+                return 0
             queue = queue_instance.queue
-            before_size = queue.qsize()
+            schedule.queue = queue_instance.code
+            for schedule_time in schedule_times:
+                schedule.next_schedule_time = schedule_time
+                start = time.perf_counter()
+                data = ScheduleSerializer(schedule).data
+                serialized = time.perf_counter()
+                queue.put(data)
+                put_size += 1
+                metrics.serialize += serialized - start
+                metrics.enqueue += time.perf_counter() - serialized
+            schedule.next_schedule_time = next_schedule_time
+        except Exception as e:
+            if claimed and put_size < len(schedule_times):
+                # 已经提前更新了next_schedule_time, 退回到第一个没有放入队列的计划时间, 避免这些计划时间被跳过
+                Schedule.objects.filter(id=schedule.id, next_schedule_time=next_schedule_time).update(
+                    next_schedule_time=schedule_times[put_size])
+            schedule.status = ScheduleStatus.ERROR.value
+            schedule.save(update_fields=('status',))
+            raise e
+        metrics.items[queue_instance.code] = metrics.items.get(queue_instance.code, 0) + len(schedule_times)
+        return len(schedule_times)
+
+    def iter_chunks(self, queryset, metrics=None):
+        """
+        分块流式读取计划, 每块从共享缓存中关联任务和回调, 到期计划再多内存也只保留一块
+        """
+        metrics = metrics or ProduceMetrics()
+        chunk = []
+        iterator = queryset.iterator(chunk_size=self.chunk_size)
+        while True:
+            start = time.perf_counter()
+            schedule = next(iterator, None)
+            if schedule is not None:
+                chunk.append(schedule)
+                metrics.rows += 1
+            if chunk and (schedule is None or len(chunk) >= self.chunk_size):
+                chunk = self.attach_related(chunk)
+                metrics.query += time.perf_counter() - start
+                yield chunk
+                chunk = []
+            else:
+                metrics.query += time.perf_counter() - start
+            if schedule is None:
+                break
+
+    def attach_related(self, schedules):
+        tasks = self.task_cache.get_many(schedule.task_id for schedule in schedules)
+        callbacks = self.callback_cache.get_many(schedule.callback_id for schedule in schedules)
+        attached = []
+        for schedule in schedules:
+            task = tasks.get(schedule.task_id)
+            if task is None:
+                continue
+            schedule.task = task
+            schedule.callback = callbacks.get(schedule.callback_id)
+            attached.append(schedule)
+        return attached
+
+    def produce_chunks(self, queryset, queue_instance, now, capacity, deadline=None, metrics=None) -> int:
+        put_size = 0
+        for schedules in self.iter_chunks(queryset, metrics=metrics):
+            for schedule in schedules:
+                if put_size >= capacity or (deadline is not None and time.time() >= deadline):
+                    return put_size
+                put_size += self.produce_schedule(schedule, queue_instance, now, capacity - put_size,
+                                                  metrics=metrics)
+        return put_size
+
+    def produce_queue(self, producer, queue_instance, now, capacity, deadline=None, metrics=None) -> int:
+        queryset = self.get_queryset(producer, now)
+        if self.mode == ProducerMode.CLAIM:
+            # 多个实例通过行锁认领到期计划, 被其它实例锁定的行直接跳过, 需要数据库支持SKIP LOCKED(MySQL8+/PostgreSQL)
+            with transaction.atomic():
+                queryset = queryset.select_for_update(skip_locked=True, of=('self', ))[:self.claim_batch_size]
+                return self.produce_chunks(queryset, queue_instance, now, capacity,
+                                           deadline=deadline, metrics=metrics)
+        return self.produce_chunks(queryset, queue_instance, now, capacity, deadline=deadline, metrics=metrics)
+
+    def produce_producer(self, producer, now):
+        """
+        在工作线程中生产一个ScheduleProducer, 返回(队列编码, 放入数量, 距离下一次需要生产的秒数, 统计)
+        """
+        close_old_connections()
+        metrics = ProduceMetrics()
+        try:
+            qsize = getattr(settings, 'PRODUCE_QUEUE_MAX_SIZE', 1000)
+            # 队列已满或不按时间过滤的生产者仍然按固定间隔轮询
+            poll_interval = getattr(settings, 'SCHEDULE_INTERVAL', 1)
+            queue_instance = builtins.schedule_queues[producer.queue.code]
+            if producer.lte_now:
+                # 调度延迟: 当前时间与最早到期计划的差值
+                start = time.perf_counter()
+                oldest_schedule_time = self.get_next_schedule_time(producer)
+                metrics.query += time.perf_counter() - start
+                if oldest_schedule_time is not None:
+                    metrics.lag = max((now - oldest_schedule_time).total_seconds(), 0)
+            before_size = queue_instance.queue.qsize()
             # 队列长度大于1000时不再生产, 防止内存溢出
             if before_size >= qsize:
                 self.logger.info('queue %s is full(%s), skip schedule' % (queue_instance.code, qsize))
-                continue
-            queryset = Schedule.objects.filter(**producer.filters).select_related(
-                'task', 'task__category', 'task__parent')
-            if producer.lte_now:
-                queryset = queryset.filter(next_schedule_time__lte=now)
-            for schedule in queryset:
-                try:
-                    # 限制队列长度, 防止内存溢出
-                    while queue.qsize() < max_queue_size and schedule.next_schedule_time <= now:
-                        schedule.queue = queue_instance.code
-                        data = ScheduleSerializer(schedule).data
-                        queue.put(data)
-                        schedule.next_schedule_time = ScheduleConfig(
-                            config=schedule.config
-                        ).get_next_time(schedule.next_schedule_time)
-                    schedule.save(update_fields=('next_schedule_time', ))
-                except Exception as e:
-                    schedule.status = ScheduleStatus.ERROR.value
-                    schedule.save(update_fields=('status',))
-                    raise e
-            put_size = queue.qsize() - before_size
-            schedule_result[queue_instance.code] = put_size
-            # 诡异的是这里的scheduled_count运行几次后还会变成0, 为什么?
-            count += put_size
+                return queue_instance.code, 0, poll_interval, metrics
+            budget = min(qsize * 2 - before_size, self.producer_budget)
+            deadline = time.time() + self.producer_time_slice
+            put_size = self.produce_queue(producer, queue_instance, now, budget, deadline=deadline, metrics=metrics)
+            if put_size >= budget or time.time() >= deadline:
+                # 本轮额度或时间片用完, 剩余的到期计划尽快在下一轮继续生产
+                return queue_instance.code, put_size, 0, metrics
+            if not producer.lte_now:
+                return queue_instance.code, put_size, poll_interval, metrics
+            next_schedule_time = self.get_next_schedule_time(producer)
+            if next_schedule_time is None:
+                return queue_instance.code, put_size, self.max_sleep, metrics
+            return queue_instance.code, put_size, (next_schedule_time - datetime.now()).total_seconds(), metrics
+        finally:
+            close_old_connections()
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=self.program_name)
+        return self._executor
+
+    def produce(self) -> float:
+        """
+        生产一轮计划, 各ScheduleProducer在线程池中并行生产, 返回距离下一次需要生产的秒数
+        """
+        state = self.state
+        count = 0
+        now = datetime.now()
+        schedule_result = {}
+        sleep_seconds = self.max_sleep
+        if self.coordinator is not None:
+            self.coordinator.heartbeat()
+        # 每轮只检查一次关联对象是否被修改
+        self.task_cache.refresh()
+        self.callback_cache.refresh()
+        producers = list(builtins.schedule_producers.values())
+        if producers:
+            # 轮流调整提交顺序, 生产者数量多于工作线程时每个生产者都有机会先执行
+            self._rotation = (self._rotation + 1) % len(producers)
+            producers = producers[self._rotation:] + producers[:self._rotation]
+        futures = [(producer.name, self.executor.submit(self.produce_producer, producer, now))
+                   for producer in producers]
+        metrics = ProduceMetrics()
+        for name, future in futures:
+            try:
+                queue_code, put_size, producer_sleep_seconds, producer_metrics = future.result()
+            except Exception as e:
+                self.logger.exception('producer %s error: %s' % (name, e))
+                producer_sleep_seconds = getattr(settings, 'SCHEDULE_INTERVAL', 1)
+            else:
+                schedule_result[queue_code] = schedule_result.get(queue_code, 0) + put_size
+                # 诡异的是这里的scheduled_count运行几次后还会变成0, 为什么?
+                count += put_size
+                metrics.merge(producer_metrics)
+            sleep_seconds = min(sleep_seconds, producer_sleep_seconds)
+        self.metrics_window.append(dict(metrics.to_dict(), time=round(now.timestamp(), 3)))
         state.last_schedule_time = now.strftime('%Y-%m-%d %H:%M:%S')
         for queue_code, put_size in schedule_result.items():
             self.logger.info('schedule %s schedules to %s' % (put_size, queue_code))
         state.scheduled_count += count
+        if self.coordinator is not None:
+            state.shard = '%s/%s' % (self.coordinator.index + 1, self.coordinator.total)
         state.push(
             scheduled_count=state.scheduled_count,
-            last_schedule_time=state.last_schedule_time
+            last_schedule_time=state.last_schedule_time,
+            mode=self.mode,
+            shard=state.shard,
+            config_cache_hit_rate=schedule_config_cache.hit_rate,
+            metrics=json.dumps(list(self.metrics_window)),
         )
+        if self.coordinator is not None:
+            # 分片模式下睡眠时间不能超过租约, 否则空闲实例的租约过期, 分片被反复重新分配
+            sleep_seconds = min(sleep_seconds, self.coordinator.lease / 2)
+        return max(sleep_seconds, self.min_sleep)
         # # 设置schedule-thread:pid的过期时间为5秒, 5秒后如果没有更新, 则认为该进程已经停止, 此set相当于心跳包
         # cache_agent.set('schedule-thread:pid', self.runner_id, expire=5)
         # 设置schedule-thread的状态, 用于监控, 不用以下设置为心跳, 是因为想保留上次的状态
@@ -84,10 +511,21 @@ class Producer(LocalProgram):
         is_set = self._event.is_set
         while is_set():
             try:
-                self.produce()
+                sleep_seconds = self.produce()
+            except Exception as e:
+                self.logger.exception(e)
+                sleep_seconds = SCHEDULE_INTERVAL
+            # 睡眠到最早的计划时间, 期间计划变更会提前唤醒
+            try:
+                wait_producer_notification(timeout=sleep_seconds)
             except Exception as e:
                 self.logger.exception(e)
-            time.sleep(SCHEDULE_INTERVAL)
+                time.sleep(SCHEDULE_INTERVAL)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self.coordinator is not None:
+            self.coordinator.leave()
 
 
 class ProducerThread(Producer, threading.Thread):
@@ -101,6 +539,7 @@ class ProducerThread(Producer, threading.Thread):
 
     def stop(self, destroy=False):
         super(ProducerThread, self).stop(destroy=destroy)
+        notify_producer()
         while self.is_alive():
             time.sleep(0.5)
         return ''
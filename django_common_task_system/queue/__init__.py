@@ -1 +1 @@
-from .socket import SocketQueue
+from .socket import SocketQueue, SocketPriorityQueue
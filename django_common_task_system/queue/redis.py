@@ -1,9 +1,25 @@
 import redis
 import json
+import time
+import uuid
+from datetime import datetime
 from queue import Empty
 
 
 class BaseRedisQueue:
+    # 阻塞读取时每次最多等待的秒数, 没有收到唤醒通知的读取方最晚在这个时间后移动到期的延迟数据
+    max_block_seconds = 1
+    # 在一个脚本中移出到期的延迟数据并放入队列, 进程在中途退出也不会丢失数据,
+    # KEYS: 延迟集合, 队列, ARGV: 当前时间戳, 返回下一条延迟数据的投递时间戳
+    promote_script = """
+    local members = redis.call('ZRANGEBYSCORE', KEYS[1], 0, ARGV[1])
+    for _, member in ipairs(members) do
+        redis.call('ZREM', KEYS[1], member)
+        redis.call('RPUSH', KEYS[2], string.sub(member, string.find(member, '|', 1, true) + 1))
+    end
+    local head = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+    return head[2]
+    """
 
     required_params = {
         'host': {
@@ -34,6 +50,69 @@ class BaseRedisQueue:
         self.config = config
         self.name = name
         self._redis = redis.Redis(**config)
+        self._promote = self._redis.register_script(self.promote_script)
+
+    @property
+    def delayed_name(self):
+        return '%s:delayed' % self.name
+
+    def put_delayed(self, item, deliver_at):
+        """
+        延迟数据保存在有序集合name:delayed中, 分数为投递时间戳, 成员加上唯一前缀防止相同数据被合并
+        """
+        if isinstance(deliver_at, datetime):
+            deliver_at = deliver_at.timestamp()
+        member = '%s|%s' % (uuid.uuid4().hex, json.dumps(item, ensure_ascii=False))
+        result = self._redis.zadd(self.delayed_name, {member: deliver_at})
+        # 唤醒阻塞中的读取方, 按新的投递时间重新计算等待时间
+        self.notify()
+        return result
+
+    @property
+    def wakeup_name(self):
+        return '%s:wakeup' % self.name
+
+    def notify(self):
+        self._redis.rpush(self.wakeup_name, 1)
+        self._redis.ltrim(self.wakeup_name, 0, 0)
+
+    def promote_delayed(self):
+        """
+        把到期的延迟数据移入队列, 返回下一条延迟数据的投递时间戳
+        """
+        head = self._promote(keys=[self.delayed_name, self.name], args=[time.time()])
+        return None if head is None else float(head)
+
+    def push_raw(self, value):
+        return self._redis.rpush(self.name, value)
+
+    def put_many(self, items):
+        """
+        批量放入队列, 只请求一次redis
+        """
+        if not items:
+            return 0
+        return self._redis.rpush(self.name, *(json.dumps(item, ensure_ascii=False) for item in items))
+
+    def blocking_pop(self, pop, timeout=0):
+        """
+        阻塞读取, 每次最多等待到下一条延迟数据的投递时间, 先移动到期数据再继续等待
+        """
+        deadline = time.time() + timeout if timeout else None
+        wakeup_name = self.wakeup_name.encode()
+        while True:
+            next_deliver_at = self.promote_delayed()
+            waits = [self.max_block_seconds]
+            if next_deliver_at is not None:
+                waits.append(max(next_deliver_at - time.time(), 0.01))
+            if deadline is not None:
+                waits.append(max(deadline - time.time(), 0.01))
+            # 同时等待唤醒通知, 数据在前优先读取
+            item = pop([self.name, self.wakeup_name], timeout=min(waits))
+            if item is not None and item[0] != wakeup_name:
+                return item[1]
+            if deadline is not None and time.time() >= deadline:
+                raise Empty
 
     def get(self, block=True, timeout=0):
         raise NotImplementedError
@@ -41,11 +120,15 @@ class BaseRedisQueue:
     def get_nowait(self):
         raise NotImplementedError
 
-    def put(self, item):
+    def put(self, item, deliver_at=None):
         raise NotImplementedError
 
     def qsize(self):
-        return self._redis.llen(self.name)
+        # 包含已到期但还没有移入队列的延迟数据, 不修改redis中的数据
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.llen(self.name)
+        pipe.zcount(self.delayed_name, 0, time.time())
+        return sum(pipe.execute())
 
     def empty(self):
         return self.qsize() == 0
@@ -83,30 +166,123 @@ class RedisFIFOQueue(BaseRedisQueue):
 
     def get(self, block=True, timeout=0):
         if block:
-            return self._redis.blpop(self.name, timeout=timeout)[1]
+            return json.loads(self.blocking_pop(self._redis.blpop, timeout=timeout))
         return self.get_nowait()
 
     def get_nowait(self):
+        self.promote_delayed()
         o = self._redis.lpop(self.name)
         if o is None:
             raise Empty
         return json.loads(o)
 
-    def put(self, item):
+    def put(self, item, deliver_at=None):
+        if deliver_at is not None:
+            return self.put_delayed(item, deliver_at)
         return self._redis.rpush(self.name, json.dumps(item, ensure_ascii=False))
 
 
 class RedisLIFOQueue(BaseRedisQueue):
     def get(self, block=True, timeout=0):
         if block:
-            return self._redis.brpop(self.name, timeout=timeout)[1]
+            return json.loads(self.blocking_pop(self._redis.brpop, timeout=timeout))
         return self.get_nowait()
 
     def get_nowait(self):
+        self.promote_delayed()
         o = self._redis.rpop(self.name)
         if o is None:
             raise Empty
         return json.loads(o)
 
-    def put(self, item):
+    def put(self, item, deliver_at=None):
+        if deliver_at is not None:
+            return self.put_delayed(item, deliver_at)
         return self._redis.rpush(self.name, json.dumps(item, ensure_ascii=False))
+
+
+class RedisPriorityQueue(BaseRedisQueue):
+    """
+    基于有序集合的优先级队列, 分数为 -priority * 10^10 + 序号, priority越大越先出队, 同一优先级先进先出,
+    成员以序号为前缀防止相同数据被合并, 需要redis 5.0+(ZPOPMIN/BZPOPMIN)
+    """
+    priority_factor = 10 ** 10
+    # 按数据中的priority计算分数放入有序集合, KEYS多一个序号, ARGV多一个priority_factor
+    promote_script = """
+    local members = redis.call('ZRANGEBYSCORE', KEYS[1], 0, ARGV[1])
+    for _, member in ipairs(members) do
+        redis.call('ZREM', KEYS[1], member)
+        local value = string.sub(member, string.find(member, '|', 1, true) + 1)
+        local priority = cjson.decode(value)['priority']
+        if type(priority) ~= 'number' then
+            priority = 0
+        end
+        local seq = redis.call('INCR', KEYS[3]) % tonumber(ARGV[2])
+        redis.call('ZADD', KEYS[2], string.format('%.17g', -priority * tonumber(ARGV[2]) + seq), seq .. '|' .. value)
+    end
+    local head = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+    return head[2]
+    """
+
+    @property
+    def seq_name(self):
+        return '%s:seq' % self.name
+
+    def push_raw(self, value):
+        if isinstance(value, bytes):
+            value = value.decode()
+        priority = json.loads(value).get('priority') or 0
+        seq = self._redis.incr(self.seq_name) % self.priority_factor
+        member = '%s|%s' % (seq, value)
+        return self._redis.zadd(self.name, {member: -priority * self.priority_factor + seq})
+
+    @staticmethod
+    def _unpack(member):
+        return member.split(b'|', 1)[1]
+
+    def promote_delayed(self):
+        head = self._promote(keys=[self.delayed_name, self.name, self.seq_name],
+                             args=[time.time(), self.priority_factor])
+        return None if head is None else float(head)
+
+    def get(self, block=True, timeout=0):
+        if block:
+            return json.loads(self._unpack(self.blocking_pop(self._redis.bzpopmin, timeout=timeout)))
+        return self.get_nowait()
+
+    def get_nowait(self):
+        self.promote_delayed()
+        o = self._redis.zpopmin(self.name)
+        if not o:
+            raise Empty
+        return json.loads(self._unpack(o[0][0]))
+
+    def put(self, item, deliver_at=None):
+        if deliver_at is not None:
+            return self.put_delayed(item, deliver_at)
+        return self.push_raw(json.dumps(item, ensure_ascii=False))
+
+    def notify(self):
+        # 与队列同为有序集合, 才能用bzpopmin同时等待
+        self._redis.zadd(self.wakeup_name, {'1': 0})
+
+    def put_many(self, items):
+        """
+        用一次INCRBY取得全部序号, 再用一次ZADD放入, 不随数据量增加请求次数
+        """
+        if not items:
+            return 0
+        first = self._redis.incrby(self.seq_name, len(items)) - len(items) + 1
+        mapping = {}
+        for i, item in enumerate(items):
+            seq = (first + i) % self.priority_factor
+            member = '%s|%s' % (seq, json.dumps(item, ensure_ascii=False))
+            mapping[member] = -(item.get('priority') or 0) * self.priority_factor + seq
+        self._redis.zadd(self.name, mapping)
+        return len(items)
+
+    def qsize(self):
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.zcard(self.name)
+        pipe.zcount(self.delayed_name, 0, time.time())
+        return sum(pipe.execute())
@@ -0,0 +1,133 @@
+from urllib.parse import urljoin
+from django.conf import settings
+from django.urls import reverse
+from django_common_task_system.builtins import builtins
+from typing import List, Dict, Optional
+import requests
+import os
+
+
+class QueueServiceError(Exception):
+    pass
+
+
+class QueueNotFound(QueueServiceError):
+    pass
+
+
+def check_schedules(schedules: List[Dict]) -> Optional[str]:
+    """
+    检查放入队列的计划, 返回错误信息, 没有错误时返回None
+    """
+    check_fields = ['schedule_time', 'task', 'id', 'queue']
+    for i, schedule in enumerate(schedules):
+        for field in check_fields:
+            if schedule.get(field) is None:
+                return '第%s个schedule缺少%s字段' % (i, field)
+    return None
+
+
+class LocalQueueService:
+    """
+    直接访问当前进程中的builtins.schedule_queues
+    """
+
+    @staticmethod
+    def get_queue(queue: str):
+        queue_instance = getattr(builtins.schedule_queues.get(queue, None), 'queue', None)
+        if queue_instance is None:
+            raise QueueNotFound('队列(%s)不存在' % queue)
+        return queue_instance
+
+    def status(self) -> Dict[str, int]:
+        return {x: y.queue.qsize() for x, y in builtins.schedule_queues.items()}
+
+    def qsize(self, queue: str) -> int:
+        return self.get_queue(queue).qsize()
+
+    def put_many(self, queue: str, schedules: List[Dict], deliver_at: List[float] = None) -> int:
+        """
+        deliver_at为每个计划的投递时间戳, 到达该时间后才放入队列
+        """
+        queue_instance = self.get_queue(queue)
+        error = check_schedules(schedules)
+        if error:
+            raise QueueServiceError(error)
+        put_many = getattr(queue_instance, 'put_many', None)
+        if deliver_at:
+            if len(deliver_at) != len(schedules):
+                raise QueueServiceError('deliver_at和schedules的数量不一致')
+            for schedule, t in zip(schedules, deliver_at):
+                queue_instance.put(schedule, deliver_at=t)
+        elif put_many is not None:
+            put_many(schedules)
+        else:
+            for schedule in schedules:
+                queue_instance.put(schedule)
+        return len(schedules)
+
+
+class HttpQueueService:
+    """
+    通过schedule-status/schedule-put-raw接口访问队列, 用于远程部署
+    """
+
+    def __init__(self, address=None):
+        self.address = address or os.environ['DJANGO_SERVER_ADDRESS']
+
+    def status(self) -> Dict[str, int]:
+        return requests.get(urljoin(self.address, reverse('schedule-status'))).json()
+
+    def qsize(self, queue: str) -> int:
+        num = self.status().get(queue, -1)
+        if num < 0:
+            raise QueueNotFound('队列(%s)不存在' % queue)
+        return num
+
+    def put_many(self, queue: str, schedules: List[Dict], deliver_at: List[float] = None) -> int:
+        data = {
+            'schedules': schedules,
+            'queue': queue
+        }
+        if deliver_at:
+            data['deliver_at'] = deliver_at
+        response = requests.post(urljoin(self.address, reverse('schedule-put-raw')), json=data).json()
+        if 'error' in response:
+            raise QueueServiceError(response['error'])
+        return len(schedules)
+
+
+class QueueService:
+    """
+    系统任务使用的队列服务, 优先访问本地队列, 本地没有的队列(如其它进程新建的队列)通过HTTP接口访问,
+    SYSTEM_QUEUE_SERVICE = 'http'时只通过HTTP接口访问
+    """
+
+    def __init__(self, mode=None):
+        self.mode = mode or getattr(settings, 'SYSTEM_QUEUE_SERVICE', 'local')
+        self.local = LocalQueueService()
+        self._remote = None
+
+    @property
+    def remote(self) -> Optional[HttpQueueService]:
+        if self._remote is None and os.environ.get('DJANGO_SERVER_ADDRESS'):
+            self._remote = HttpQueueService()
+        return self._remote
+
+    def get_service(self, queue: str):
+        if self.mode == 'http':
+            if self.remote is None:
+                raise QueueServiceError('DJANGO_SERVER_ADDRESS未设置')
+            return self.remote
+        if queue in builtins.schedule_queues or self.remote is None:
+            return self.local
+        return self.remote
+
+    def qsize(self, queue: str) -> int:
+        return self.get_service(queue).qsize(queue)
+
+    def put_many(self, queue: str, schedules: List[Dict], deliver_at: List[float] = None) -> int:
+        return self.get_service(queue).put_many(queue, schedules, deliver_at=deliver_at)
+
+
+queue_service = QueueService()
@@ -1 +1 @@
-from .client import SocketQueue
+from .client import SocketQueue, SocketPriorityQueue
@@ -1,5 +1,7 @@
 import json
+from datetime import datetime
 from queue import Empty
+from typing import Union, List
 from django_common_task_system.cache_service import CacheAgent
 
 
@@ -21,6 +23,8 @@ class SocketQueue:
     def get(self, block=True, timeout=0):
         if block:
             item = self.agent.qbpop(self.name, timeout=timeout)
+            if item is None:
+                raise Empty
             return json.loads(item)
         return self.get_nowait()
 
@@ -30,6 +34,43 @@ class SocketQueue:
             raise Empty
         return json.loads(item)
 
-    def put(self, item: dict):
+    def put(self, item: dict, deliver_at: Union[datetime, float, None] = None):
+        """
+        deliver_at为datetime或时间戳时, 到达该时间后才放入队列
+        """
         item = json.dumps(item)
-        self.agent.qpush(self.name, item)
+        if deliver_at is None:
+            self.agent.qpush(self.name, item)
+        else:
+            self.agent.qpush_at(self.name, deliver_at, item)
+
+    def put_many(self, items: List[dict]):
+        """
+        批量放入队列, 只请求一次缓存服务
+        """
+        if not items:
+            return 0
+        return self.agent.qpush(self.name, *(json.dumps(item) for item in items))
+
+
+class SocketPriorityQueue(SocketQueue):
+    """
+    按数据中的priority出队, priority越大越先出队, 同一优先级先进先出
+    """
+
+    def put(self, item: dict, deliver_at: Union[datetime, float, None] = None):
+        priority = item.get('priority') or 0
+        value = json.dumps(item)
+        if deliver_at is None:
+            self.agent.qpush(self.name, value, priority=priority)
+        else:
+            self.agent.qpush_at(self.name, deliver_at, value, priority=priority)
+
+    def put_many(self, items: List[dict]):
+        # 相同优先级的数据一次放入
+        groups = {}
+        for item in items:
+            groups.setdefault(item.get('priority') or 0, []).append(json.dumps(item))
+        for priority, values in groups.items():
+            self.agent.qpush(self.name, *values, priority=priority)
+        return len(items)
@@ -1,15 +1,50 @@
-from django_common_task_system.utils.cron_utils import get_next_cron_time
-from jionlp_time import parse_time
-from django_common_task_system.utils.schedule_time import nlp_config_to_schedule_config
+from django_common_task_system.utils.cron_utils import get_next_cron_time, iter_cron_times
+from django_common_task_system.utils.schedule_time import parse_sentence
 from datetime import datetime, timedelta
 from django.core.validators import ValidationError
-from django_common_task_system.choices import ScheduleTimingType, ScheduleType
+from django_common_task_system.choices import ScheduleTimingType, ScheduleType, ScheduleCatchUpPolicy
+from django.conf import settings
+from collections import deque, OrderedDict
+from threading import Lock
+from types import MappingProxyType
+import copy
+import json
+import zlib
 
 
 mdays = [0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
 
 
+def advance_time(start: datetime, target: datetime, step: timedelta, inclusive=True) -> datetime:
+    """
+    计算start + k * step(k >= 0)中不早于target的最早时间, inclusive为False时需要晚于target,
+    与逐个累加step的结果一致, 但只需要一次整除
+    """
+    if step <= timedelta(0):
+        raise ValidationError("period must be greater than 0")
+    if start > target or (inclusive and start == target):
+        return start
+    # 向下取整得到不超过target的步数, 再补一步
+    steps = (target - start) // step
+    schedule_time = start + step * steps
+    if schedule_time < target or (not inclusive and schedule_time == target):
+        schedule_time += step
+    return schedule_time
+
+
+def deep_freeze(value):
+    """
+    dict转换为只读的MappingProxyType, list转换为tuple, 用于共享的配置
+    """
+    if isinstance(value, dict):
+        return MappingProxyType({k: deep_freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(deep_freeze(x) for x in value)
+    return value
+
+
 class ScheduleConfig:
+    _frozen = False
 
     def __init__(self,
                  base_on_now=True,
@@ -25,6 +60,9 @@ class ScheduleConfig:
                  timing_monthday=None,
                  timing_year=None,
                  timing_datetime=None,
+                 catch_up=None,
+                 catch_up_limit=None,
+                 spread=None,
                  config=None,
                  **kwargs):
         self.base_on_now = base_on_now
@@ -40,14 +78,52 @@ class ScheduleConfig:
         self.timing_monthday = timing_monthday
         self.timing_year = timing_year
         self.timing_datetime = timing_datetime
+        self.catch_up = catch_up or ScheduleCatchUpPolicy.ALL.value
+        self.catch_up_limit = catch_up_limit
+        self.spread = spread or 0
         self.kwargs = kwargs
         self.config = config or self.to_config()
         if config:
             self.parse_config(config)
 
+    @staticmethod
+    def get_fingerprint(config) -> str:
+        return json.dumps(config, sort_keys=True, default=str)
+
+    def freeze(self):
+        """
+        冻结后不允许再修改, 用于在多个计划之间共享解析后的配置
+        """
+        self.fingerprint = self.get_fingerprint(self.config)
+        # 嵌套的配置也不允许修改
+        for key, value in list(vars(self).items()):
+            setattr(self, key, deep_freeze(value))
+        self._frozen = True
+        return self
+
+    def __setattr__(self, key, value):
+        if self._frozen:
+            raise AttributeError('frozen ScheduleConfig can not be modified')
+        super(ScheduleConfig, self).__setattr__(key, value)
+
+    def __hash__(self):
+        if not self._frozen:
+            raise TypeError('unhashable ScheduleConfig, freeze it first')
+        return hash(self.fingerprint)
+
+    def __eq__(self, other):
+        if not isinstance(other, ScheduleConfig):
+            return NotImplemented
+        if self._frozen and other._frozen:
+            return self.fingerprint == other.fingerprint
+        return self is other
+
     def parse_config(self, config):
         schedule_type = self.schedule_type = config['schedule_type']
         self.base_on_now = config.get('base_on_now', False)
+        self.catch_up = config.get('catch_up', ScheduleCatchUpPolicy.ALL.value)
+        self.catch_up_limit = config.get('catch_up_limit')
+        self.spread = config.get('spread', 0)
         type_config = config[schedule_type]
         if schedule_type == ScheduleType.ONCE:
             self.once_schedule = type_config['schedule_start_time']
@@ -72,15 +148,45 @@ class ScheduleConfig:
             elif timing_type == ScheduleTimingType.YEAR:
                 self.timing_year = timing_config['year']
 
+    def catch_up_config(self):
+        catch_up = self.catch_up
+        if catch_up == ScheduleCatchUpPolicy.ALL:
+            return {}
+        if catch_up == ScheduleCatchUpPolicy.LATEST:
+            return {'catch_up': catch_up}
+        if catch_up == ScheduleCatchUpPolicy.AT_MOST:
+            if not self.catch_up_limit or self.catch_up_limit < 1:
+                raise ValidationError("catch_up_limit must be greater than 0 while catch_up is at_most")
+            return {'catch_up': catch_up, 'catch_up_limit': self.catch_up_limit}
+        raise ValidationError("catch_up<%s> is invalid" % catch_up)
+
+    def spread_config(self):
+        if not self.spread:
+            return {}
+        if not isinstance(self.spread, int) or self.spread < 0:
+            raise ValidationError("spread must be a positive integer")
+        return {'spread': self.spread}
+
+    def get_offset(self, key=None) -> timedelta:
+        """
+        在spread秒内按key(计划对应的任务id)计算固定的偏移, 同一时间的计划分散到spread窗口内运行
+        """
+        if not self.spread or key is None or self.schedule_type == ScheduleType.ONCE:
+            return timedelta(0)
+        return timedelta(seconds=zlib.crc32(str(key).encode()) % self.spread)
+
     def to_config(self):
         if self.nlp_sentence:
-            result = parse_time(self.nlp_sentence)
-            config = nlp_config_to_schedule_config(result, sentence=self.nlp_sentence)
+            _, config = parse_sentence(self.nlp_sentence)
+            config.update(self.catch_up_config())
+            config.update(self.spread_config())
             self.schedule_type = config['schedule_type']
             return config
         config = {
             'schedule_type': self.schedule_type,
             'base_on_now': self.base_on_now,
+            **self.catch_up_config(),
+            **self.spread_config(),
         }
         schedule_type = self.schedule_type
         type_config: dict = config.setdefault(self.schedule_type, {})
@@ -126,7 +232,7 @@ class ScheduleConfig:
             raise ValidationError("type<%s> is invalid" % schedule_type)
         return config
 
-    def get_current_time(self, start_time=None):
+    def get_current_time(self, start_time=None, key=None):
         if self.base_on_now:
             now = datetime.now()
         else:
@@ -134,14 +240,21 @@ class ScheduleConfig:
                 now = datetime.fromtimestamp(start_time.timestamp())
             else:
                 now = datetime.now()
+        offset = self.get_offset(key)
+        if not offset:
+            return self._get_current_time(now)
+        return self._get_current_time(now - offset) + offset
+
+    def _get_current_time(self, now: datetime):
         now_seconds = now.hour * 3600 + now.minute * 60 + now.second
         schedule_type = self.schedule_type
         type_config = self.config[schedule_type]
         schedule_time = None
         if schedule_type == ScheduleType.CONTINUOUS.value:
             schedule_time, period = self.period_schedule
-            while schedule_time < now:
-                schedule_time += timedelta(seconds=period)
+            if isinstance(schedule_time, str):
+                schedule_time = datetime.strptime(schedule_time, '%Y-%m-%d %H:%M:%S')
+            schedule_time = advance_time(schedule_time, now, timedelta(seconds=period))
         elif schedule_type == ScheduleType.CRONTAB.value:
             schedule_time = get_next_cron_time(type_config['crontab'], now)
         elif schedule_type == ScheduleType.TIMINGS:
@@ -151,8 +264,7 @@ class ScheduleConfig:
             timing_config = type_config[timing_type]
             if timing_type == ScheduleTimingType.DAY:
                 schedule_time = datetime(now.year, now.month, now.day, hour, minute, second)
-                while schedule_time < now:
-                    schedule_time += timedelta(days=timing_config['period'])
+                schedule_time = advance_time(schedule_time, now, timedelta(days=timing_config['period']))
             elif timing_type == ScheduleTimingType.WEEKDAY:
                 weekdays = timing_config['weekday']
                 weekday = now.isoweekday()
@@ -239,15 +351,24 @@ class ScheduleConfig:
         #     raise ValidationError("cant create a schedule time before now, schedule_time<%s>" % schedule_time)
         return schedule_time
 
-    def get_next_time(self, last_time: datetime):
-        schedule_type = self.schedule_type
-        type_config = self.config[schedule_type]
+    def get_next_time(self, last_time: datetime, key=None):
         if self.base_on_now:
             last_time = datetime.now()
+        offset = self.get_offset(key)
+        if not offset:
+            return self._get_next_time(last_time)
+        # 先去掉偏移计算原本的下一次时间, 再加上偏移
+        next_time = self._get_next_time(last_time - offset)
+        if next_time == datetime.max:
+            return next_time
+        return next_time + offset
+
+    def _get_next_time(self, last_time: datetime):
+        schedule_type = self.schedule_type
+        type_config = self.config[schedule_type]
         next_time = last_time
         if schedule_type == ScheduleType.CONTINUOUS.value:
-            while next_time <= last_time:
-                next_time += timedelta(seconds=self.period_schedule[1])
+            next_time = advance_time(next_time, last_time, timedelta(seconds=self.period_schedule[1]), inclusive=False)
         elif schedule_type == ScheduleType.CRONTAB.value:
             next_time = get_next_cron_time(type_config['crontab'], last_time)
         elif schedule_type == ScheduleType.TIMINGS:
@@ -258,13 +379,13 @@ class ScheduleConfig:
             timing_period = timing_config.get('period', 1)
             next_time = datetime(next_time.year, next_time.month, next_time.day, hour, minute, second)
             if timing_type == ScheduleTimingType.DAY:
-                while next_time <= last_time:
-                    next_time += timedelta(days=timing_period)
+                next_time = advance_time(next_time, last_time, timedelta(days=timing_period), inclusive=False)
             elif timing_type == ScheduleTimingType.WEEKDAY:
                 weekdays = timing_config['weekday']
                 weekday = last_time.isoweekday()
                 for i in weekdays:
-                    if i > weekday:
+                    # 当天的计划时间还没到时也是下一次计划时间
+                    if i > weekday or (i == weekday and next_time > last_time):
                         days = i - weekday
                         delta = timedelta(days=days)
                         break
@@ -284,10 +405,15 @@ class ScheduleConfig:
                     if next_time > last_time:
                         break
                 else:
-                    month = (last_time.month + timing_period) % 12
-                    if month == 0:
-                        month = 1
-                    year = last_time.year + (last_time.month + timing_period) // 12
+                    # 本月已没有计划时间, 取period个月后的第一个日期
+                    month = last_time.month + timing_period
+                    year = last_time.year + (month - 1) // 12
+                    month = (month - 1) % 12 + 1
+                    day = monthdays[0]
+                    if day == 0:
+                        day = 1
+                    elif day == 32:
+                        day = mdays[month]
                     next_time = datetime(year, month, day, hour, minute, second)
             elif timing_type == ScheduleTimingType.YEAR:
                 month_days = timing_config['year']
@@ -309,3 +435,269 @@ class ScheduleConfig:
         else:
             raise ValidationError("unsupported schedule type: %s" % schedule_type)
         return next_time
+
+    def get_fixed_step(self, last_time: datetime):
+        """
+        从last_time开始计划时间间隔固定时返回间隔, 用于直接跳过错过的计划时间而不是逐个计算
+        """
+        if self.base_on_now:
+            return None
+        schedule_type = self.schedule_type
+        if schedule_type == ScheduleType.CONTINUOUS:
+            return timedelta(seconds=self.period_schedule[1])
+        if schedule_type == ScheduleType.TIMINGS and self.timing_type == ScheduleTimingType.DAY \
+                and last_time.time() == self.timing_time.time():
+            return timedelta(days=self.timing_period or 1)
+        return None
+
+    def get_regular_times(self, start: datetime):
+        """
+        CONTINUOUS、DAY、WEEKDAY类型的计划时间按固定周期重复, 返回(一个周期内start之后的计划时间, 周期),
+        其它类型返回None
+        """
+        schedule_type = self.schedule_type
+        if schedule_type == ScheduleType.CONTINUOUS:
+            step = timedelta(seconds=self.period_schedule[1])
+            return [start + step], step
+        if schedule_type != ScheduleType.TIMINGS:
+            return None
+        if self.timing_type == ScheduleTimingType.DAY:
+            return [self._get_next_time(start)], timedelta(days=self.timing_period or 1)
+        if self.timing_type == ScheduleTimingType.WEEKDAY:
+            type_config = self.config[schedule_type]
+            weekdays = type_config[ScheduleTimingType.WEEKDAY]['weekday']
+            period = type_config[ScheduleTimingType.WEEKDAY].get('period', 1)
+            cycle = timedelta(days=period * 7)
+            times = [self._get_next_time(start)]
+            for _ in range(len(weekdays)):
+                times.append(self._get_next_time(times[-1]))
+            # 星期列表无序或重复时不是固定周期, 逐个计算
+            if times[-1] != times[0] + cycle:
+                return None
+            return times[:-1], cycle
+        return None
+
+    def iter_times(self, start: datetime, end: datetime, key=None):
+        """
+        依次生成start(不包含)到end(包含)之间的计划时间, 不考虑base_on_now,
+        固定周期的计划直接累加周期, crontab复用同一个解析结果
+        """
+        offset = self.get_offset(key)
+        if not offset:
+            yield from self._iter_times(start, end)
+            return
+        for schedule_time in self._iter_times(start - offset, end - offset):
+            yield schedule_time + offset
+
+    def _iter_times(self, start: datetime, end: datetime):
+        if self.schedule_type == ScheduleType.CRONTAB:
+            for schedule_time in iter_cron_times(self.config[ScheduleType.CRONTAB]['crontab'], start):
+                if schedule_time > end:
+                    break
+                yield schedule_time
+            return
+        regular = self.get_regular_times(start)
+        if regular is None:
+            schedule_time = start
+            while True:
+                next_time = self._get_next_time(schedule_time)
+                # ONCE类型下一次时间为datetime.max, 表示不再执行
+                if next_time > end or next_time <= schedule_time or next_time == datetime.max:
+                    break
+                schedule_time = next_time
+                yield schedule_time
+            return
+        times, cycle = regular
+        k = 0
+        while True:
+            offset = cycle * k
+            for schedule_time in times:
+                schedule_time = schedule_time + offset
+                if schedule_time > end:
+                    return
+                yield schedule_time
+            k += 1
+
+    def times_between(self, start: datetime, end: datetime, key=None):
+        """
+        返回start(不包含)到end(包含)之间的计划时间, 固定周期的计划用numpy一次性计算, 返回datetime64[us]数组,
+        未安装numpy时返回datetime列表
+        """
+        try:
+            import numpy as np
+        except ImportError:
+            return list(self.iter_times(start, end, key=key))
+        offset = self.get_offset(key)
+        if offset:
+            times = self.times_between(start - offset, end - offset)
+            return times + np.timedelta64(offset // timedelta(microseconds=1), 'us')
+        regular = self.get_regular_times(start)
+        if regular is None:
+            return np.array(list(self.iter_times(start, end)), dtype='datetime64[us]')
+        times, cycle = regular
+        base = np.array(times, dtype='datetime64[us]')
+        step = np.timedelta64(cycle // timedelta(microseconds=1), 'us')
+        end = np.datetime64(end, 'us')
+        if not len(base) or base[0] > end:
+            return np.array([], dtype='datetime64[us]')
+        cycles = int((end - base[0]) // step) + 1
+        result = (base[None, :] + np.arange(cycles)[:, None] * step).ravel()
+        return result[result <= end]
+
+    def is_calendar_based(self):
+        """
+        计划时间只由日历决定, 与上一次计划时间无关, 可以从任意时间开始计算
+        """
+        if self.base_on_now:
+            return False
+        if self.schedule_type == ScheduleType.CRONTAB:
+            return True
+        return self.schedule_type == ScheduleType.TIMINGS and (self.timing_period or 1) == 1 and \
+            self.timing_type in (ScheduleTimingType.DAY, ScheduleTimingType.WEEKDAY,
+                                 ScheduleTimingType.MONTHDAY, ScheduleTimingType.YEAR)
+
+    def get_latest_times(self, last_time: datetime, now: datetime, limit: int):
+        """
+        直接从now计算下一次计划时间, 再向前查找last_time(包含)到now(包含)之间最近的limit个计划时间,
+        不逐个计算错过的计划时间
+        """
+        next_time = self._get_next_time(now)
+        span = max(self._get_next_time(next_time) - next_time, timedelta(seconds=1)) * limit
+        while True:
+            start = now - span
+            if start <= last_time:
+                schedule_times = [last_time] + list(self._iter_times(last_time, now))
+                break
+            schedule_times = list(self._iter_times(start, now))
+            if len(schedule_times) >= limit:
+                break
+            span *= 2
+        return schedule_times[-limit:], next_time
+
+    def get_catch_up_times(self, last_time: datetime, now: datetime, capacity: int, key=None):
+        """
+        根据补偿策略计算last_time(包含)到now(包含)之间需要放入队列的计划时间,
+        返回(计划时间列表, 下一次计划时间), 超过capacity的计划时间留给下一次调度
+        """
+        offset = self.get_offset(key)
+        if offset:
+            schedule_times, next_time = self.get_catch_up_times(last_time - offset, now - offset, capacity)
+            if next_time != datetime.max:
+                next_time = next_time + offset
+            return [schedule_time + offset for schedule_time in schedule_times], next_time
+        catch_up = self.catch_up
+        if catch_up == ScheduleCatchUpPolicy.LATEST:
+            limit = 1
+        elif catch_up == ScheduleCatchUpPolicy.AT_MOST:
+            limit = self.catch_up_limit
+        else:
+            limit = None
+        if limit is None:
+            schedule_times = []
+            next_time = last_time
+            while len(schedule_times) < capacity and next_time <= now:
+                schedule_times.append(next_time)
+                next_time = self.get_next_time(next_time)
+            return schedule_times, next_time
+        if last_time > now:
+            return [], last_time
+        step = self.get_fixed_step(last_time)
+        if step is not None:
+            missed = (now - last_time) // step + 1
+            schedule_times = [last_time + step * i for i in range(max(0, missed - limit), missed)]
+            next_time = last_time + step * missed
+        elif self.is_calendar_based():
+            schedule_times, next_time = self.get_latest_times(last_time, now, limit)
+        else:
+            schedule_times = deque(maxlen=limit)
+            next_time = last_time
+            while next_time <= now:
+                schedule_times.append(next_time)
+                next_time = self.get_next_time(next_time)
+            schedule_times = list(schedule_times)
+        if len(schedule_times) > capacity:
+            next_time = schedule_times[capacity]
+            schedule_times = schedule_times[:capacity]
+        return schedule_times, next_time
+
+
+class ScheduleConfigCache:
+    """
+    按配置指纹缓存解析后的ScheduleConfig, 超过maxsize时淘汰最久未使用的配置,
+    传入key(计划id)时先比较该计划上一次的配置, 没有变化时不再计算指纹
+    """
+
+    def __init__(self, maxsize=1024, key_maxsize=10000):
+        self.maxsize = maxsize
+        self.key_maxsize = key_maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._keys = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, config, key=None) -> ScheduleConfig:
+        if key is not None:
+            with self._lock:
+                item = self._keys.get(key)
+            # 比较dict比计算指纹快得多
+            if item is not None and item[0] == config:
+                with self._lock:
+                    self._keys.move_to_end(key)
+                    self.hits += 1
+                return item[1]
+        schedule_config = self.get_by_fingerprint(config)
+        if key is not None:
+            with self._lock:
+                self._keys[key] = (copy.deepcopy(config), schedule_config)
+                self._keys.move_to_end(key)
+                if len(self._keys) > self.key_maxsize:
+                    self._keys.popitem(last=False)
+        return schedule_config
+
+    def get_by_fingerprint(self, config) -> ScheduleConfig:
+        fingerprint = ScheduleConfig.get_fingerprint(config)
+        with self._lock:
+            schedule_config = self._cache.get(fingerprint)
+            if schedule_config is not None:
+                self._cache.move_to_end(fingerprint)
+                self.hits += 1
+                return schedule_config
+            self.misses += 1
+        # 复制一份配置, 防止调用方修改config后影响缓存
+        schedule_config = ScheduleConfig(config=copy.deepcopy(config)).freeze()
+        with self._lock:
+            self._cache[fingerprint] = schedule_config
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return schedule_config
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return round(self.hits / total, 4) if total else 0.0
+
+    def info(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._cache),
+            'maxsize': self.maxsize,
+            'hit_rate': self.hit_rate,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._keys.clear()
+            self.hits = self.misses = 0
+
+
+schedule_config_cache = ScheduleConfigCache(
+    maxsize=getattr(settings, 'SCHEDULE_CONFIG_CACHE_SIZE', 1024),
+    key_maxsize=getattr(settings, 'SCHEDULE_CONFIG_KEY_CACHE_SIZE', 10000),
+)
+
+
+def get_schedule_config(config, key=None) -> ScheduleConfig:
+    return schedule_config_cache.get(config, key=key)
@@ -0,0 +1,140 @@
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django_common_task_system import get_schedule_log_model
+from itertools import groupby
+import gzip
+import importlib.util
+import json
+import os
+import time
+
+
+LOG_RETENTION_DAYS = getattr(settings, 'LOG_RETENTION_DAYS', 30)
+LOG_RETENTION_CHUNK_SIZE = getattr(settings, 'LOG_RETENTION_CHUNK_SIZE', 5000)
+# 每删除一批后暂停的秒数, 避免长时间占用数据库
+LOG_RETENTION_PAUSE = getattr(settings, 'LOG_RETENTION_PAUSE', 0.1)
+# 归档目录, 为空时不归档直接删除
+LOG_ARCHIVE_PATH = getattr(settings, 'LOG_ARCHIVE_PATH', None)
+LOG_ARCHIVE_FORMAT = getattr(settings, 'LOG_ARCHIVE_FORMAT', 'ndjson')
+
+
+class NdjsonArchiver:
+    """
+    每批日志按天写入gzip压缩的NDJSON文件, 文件名包含该天第一条日志的id,
+    删除失败重新执行时覆盖同一个文件, 不会重复归档
+    """
+    suffix = 'ndjson.gz'
+
+    def __init__(self, path, prefix):
+        self.path = path
+        self.prefix = prefix
+        os.makedirs(path, exist_ok=True)
+
+    def get_file(self, day, first_id):
+        return os.path.join(self.path, '%s-%s-%s.%s' % (self.prefix, day, first_id, self.suffix))
+
+    def write(self, day, rows):
+        file = self.get_file(day, rows[0]['id'])
+        with gzip.open(file, 'wt', encoding='utf-8') as f:
+            for row in rows:
+                f.write(json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False))
+                f.write('\n')
+        return file
+
+
+class ParquetArchiver(NdjsonArchiver):
+    """
+    需要安装pyarrow
+    """
+    suffix = 'parquet'
+
+    def __init__(self, path, prefix):
+        # 没有安装pyarrow时在开始删除前报错
+        if importlib.util.find_spec('pyarrow') is None:
+            raise ImportError('parquet archive requires pyarrow, '
+                              'install it with `pip install django-common-task-system[parquet]`')
+        super(ParquetArchiver, self).__init__(path, prefix)
+
+    def write(self, day, rows):
+        import pyarrow
+        import pyarrow.parquet
+        file = self.get_file(day, rows[0]['id'])
+        for row in rows:
+            # 结果字段结构不固定, 保存为json字符串
+            row['result'] = json.dumps(row['result'], cls=DjangoJSONEncoder, ensure_ascii=False)
+        pyarrow.parquet.write_table(pyarrow.Table.from_pylist(rows), file, compression='zstd')
+        return file
+
+
+archivers = {
+    'ndjson': NdjsonArchiver,
+    'parquet': ParquetArchiver,
+}
+
+
+class LogRetention:
+    """
+    删除create_time早于retention_days天的日志, 按主键顺序分批删除, 每批之间暂停pause秒,
+    设置archive_path时先按天归档再删除, 只使用ORM查询, 支持所有数据库
+    """
+
+    def __init__(self, retention_days=None, chunk_size=None, pause=None,
+                 archive_path=None, archive_format=None, model=None):
+        self.retention_days = LOG_RETENTION_DAYS if retention_days is None else retention_days
+        self.chunk_size = chunk_size or LOG_RETENTION_CHUNK_SIZE
+        self.pause = LOG_RETENTION_PAUSE if pause is None else pause
+        self.model = model or get_schedule_log_model()
+        archive_path = archive_path or LOG_ARCHIVE_PATH
+        archive_format = archive_format or LOG_ARCHIVE_FORMAT
+        if archive_path:
+            if archive_format not in archivers:
+                raise ValueError('archive format must be one of %s' % ', '.join(archivers))
+            self.archiver = archivers[archive_format](archive_path, self.model._meta.db_table)
+        else:
+            self.archiver = None
+
+    def iter_chunks(self, queryset):
+        last_id = 0
+        while True:
+            ids = list(queryset.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:self.chunk_size])
+            if not ids:
+                break
+            yield ids
+            if len(ids) < self.chunk_size:
+                break
+            last_id = ids[-1]
+            if self.pause:
+                time.sleep(self.pause)
+
+    def archive(self, ids, files):
+        rows = list(self.model.objects.filter(id__in=ids).order_by('create_time', 'id').values())
+        for day, day_rows in groupby(rows, key=lambda x: x['create_time'].strftime('%Y-%m-%d')):
+            day_rows = list(day_rows)
+            file = self.archiver.write(day, day_rows)
+            files[file] = files.get(file, 0) + len(day_rows)
+
+    def trim_attempts(self, cutoff):
+        """
+        最后运行时间早于cutoff的执行统计对应的日志都已删除, 一起删除
+        """
+        from django_common_task_system.models import ScheduleAttempt
+        deleted = 0
+        for ids in self.iter_chunks(ScheduleAttempt.objects.filter(update_time__lt=cutoff)):
+            deleted += ScheduleAttempt.objects.filter(id__in=ids).delete()[0]
+        return deleted
+
+    def run(self, now=None):
+        cutoff = (now or datetime.now()) - timedelta(days=self.retention_days)
+        result = {'cutoff': cutoff.strftime('%Y-%m-%d %H:%M:%S'), 'deleted': 0, 'chunks': 0}
+        files = {}
+        for ids in self.iter_chunks(self.model.objects.filter(create_time__lt=cutoff)):
+            # 归档失败时抛出异常, 不删除日志
+            if self.archiver is not None:
+                self.archive(ids, files)
+            result['deleted'] += self.model.objects.filter(id__in=ids).delete()[0]
+            result['chunks'] += 1
+        result['attempts_deleted'] = self.trim_attempts(cutoff)
+        if self.archiver is not None:
+            result['archive'] = files
+        return result
@@ -1,129 +1,207 @@
-from django.db import connection
-from datetime import datetime
+from datetime import datetime, timedelta
 from dateutil import parser
-from django.db.models import Count, Max
-from django_common_task_system.choices import ExecuteStatus
-from django_common_task_system import get_schedule_log_model
-from .config import ScheduleConfig
+from django.db.models import F, Q
+from django_common_task_system.choices import ExecuteStatus, ScheduleStatus, ScheduleType
+from django_common_task_system import get_schedule_log_model, get_schedule_model
+from .config import get_schedule_config, ScheduleConfig, advance_time
+from collections import Counter
+from itertools import groupby
+from operator import itemgetter
+from django.conf import settings
 import copy
+import random
 
 
-def _get_schedule_start_end_time(schedule, start_time=None, end_time=None):
-    schedule_config = ScheduleConfig(config=schedule.config)
+# 负载预测最多统计的小时数
+FORECAST_MAX_HOURS = getattr(settings, 'SCHEDULE_FORECAST_MAX_HOURS', 24 * 7)
+
+# 异常重试的退避时间: 第n次重试等待 min(BASE * FACTOR ** (n - 1), MAX) 秒, 再加随机抖动
+RETRY_BACKOFF_BASE = getattr(settings, 'RETRY_BACKOFF_BASE', 60)
+RETRY_BACKOFF_FACTOR = getattr(settings, 'RETRY_BACKOFF_FACTOR', 2)
+RETRY_BACKOFF_MAX = getattr(settings, 'RETRY_BACKOFF_MAX', 3600)
+# 到达重试时间后超过该秒数仍没有新的日志, 认为重试丢失(如队列被清空), 重新安排重试
+RETRY_STALE_TIMEOUT = getattr(settings, 'RETRY_STALE_TIMEOUT', 1800)
+
+
+def _get_schedule_own_start_time(schedule):
+    # 计划自身的开始时间: 开始时间之后第一个不早于最后更新时间的计划时间, 计划创建、重新启用或修改前的时间不需要检查
+    update_time = schedule.update_time
+    start_time = schedule.config[schedule.config['schedule_type']].get('schedule_start_time', None)
     if not start_time:
-        update_time = schedule.update_time
-        start_time = schedule.config[schedule.config['schedule_type']].get('schedule_start_time', None)
-        if start_time:
-            start_time = parser.parse(start_time)
-            while start_time < update_time:
-                start_time = schedule_config.get_next_time(start_time)
-        else:
-            start_time = update_time
-    end_time = end_time or datetime.now()
+        return update_time
+    start_time = parser.parse(start_time)
+    if start_time < update_time:
+        schedule_config = schedule.schedule_config
+        times = schedule_config.iter_times(start_time, datetime.max, key=schedule.task_id)
+        start_time = next(times, start_time)
+        step = schedule_config.get_fixed_step(start_time - schedule_config.get_offset(schedule.task_id))
+        if step is not None:
+            # 间隔固定的计划直接计算, 不从开始时间逐个累加
+            return advance_time(start_time, update_time, step)
+        if start_time < update_time:
+            for start_time in times:
+                if start_time >= update_time:
+                    break
+    return start_time
+
+
+def _align_start_time(schedule, own_start_time, start_time):
+    """
+    返回不晚于start_time的最后一个计划时间, 从计划自身的开始时间起算,
+    按周期累加的计划从任意时间(如水位线)开始计算会偏离实际的计划时间
+    """
+    schedule_config = schedule.schedule_config
+    if schedule_config.schedule_type == ScheduleType.CONTINUOUS and not schedule_config.base_on_now:
+        step = timedelta(seconds=schedule_config.period_schedule[1])
+        return advance_time(own_start_time, start_time, step, inclusive=False) - step
+    if schedule_config.is_calendar_based():
+        return start_time
+    aligned = own_start_time
+    for aligned in schedule_config.iter_times(own_start_time, start_time, key=schedule.task_id):
+        pass
+    return aligned
+
+
+def _get_schedule_start_end_time(schedule, start_time=None, end_time=None):
+    own_start_time = _get_schedule_own_start_time(schedule)
     if isinstance(start_time, str):
         start_time = parser.parse(start_time)
+    # 传入的开始时间(如水位线)早于计划自身的开始时间时, 从计划自身的开始时间检查
+    if start_time and start_time > own_start_time:
+        start_time = _align_start_time(schedule, own_start_time, start_time)
+    else:
+        start_time = own_start_time
+    end_time = end_time or datetime.now()
     if isinstance(end_time, str):
-        start_time = parser.parse(end_time)
+        end_time = parser.parse(end_time)
     return start_time, end_time
 
 
 def get_schedule_times(schedule, start_time=None, end_time=None):
-    schedule_times = []
+    # 返回start_time(不包含)到end_time(包含)之间的计划时间
     start_time, end_time = _get_schedule_start_end_time(schedule, start_time, end_time)
-    schedule_config = ScheduleConfig(config=schedule.config)
-    while start_time < end_time:
-        start_time = schedule_config.get_next_time(start_time)
-        schedule_times.append(start_time)
-    return schedule_times
+    schedule_config = schedule.schedule_config
+    return list(schedule_config.iter_times(start_time, end_time, key=schedule.task_id))
 
 
 def get_history_schedules(schedule, start_time=None, end_time=None):
     schedules = []
     start_time, end_time = _get_schedule_start_end_time(schedule, start_time, end_time)
-    schedule_config = ScheduleConfig(config=schedule.config)
-    while start_time < end_time:
-        start_time = schedule_config.get_next_time(start_time)
+    schedule_config = schedule.schedule_config
+    for schedule_time in schedule_config.iter_times(start_time, end_time, key=schedule.task_id):
         history = copy.copy(schedule)
-        history.next_schedule_time = start_time
+        history.next_schedule_time = schedule_time
         schedules.append(history)
     return schedules
 
 
-def get_log_missing_records(queue, schedule, start_time=None, end_time=None):
+def get_schedule_forecast(hours=24, bucket=60, now=None):
+    """
+    统计未来hours小时内已启用计划的运行次数, 按bucket秒分组,
+    配置、下次运行时间、结束时间都相同的计划只计算一次
+    """
+    now = (now or datetime.now()).replace(microsecond=0)
+    end_time = now + timedelta(hours=hours)
+    # 分组起点按bucket对齐, 整点运行的计划落在同一组
+    midnight = now.replace(hour=0, minute=0, second=0)
+    origin = midnight + timedelta(seconds=int((now - midnight).total_seconds()) // bucket * bucket)
+    queryset = get_schedule_model().objects.filter(
+        status=ScheduleStatus.OPENING.value,
+        next_schedule_time__lte=end_time
+    ).values_list('config', 'next_schedule_time', 'schedule_end_time', 'task_id')
+    groups = {}
+    for config, next_time, schedule_end_time, task_id in queryset.iterator(chunk_size=2000):
+        # 设置了分散窗口的计划偏移不同, 偏移也要作为分组条件
+        offset = get_schedule_config(config).get_offset(task_id) if config.get('spread') else None
+        key = (ScheduleConfig.get_fingerprint(config), next_time, schedule_end_time, offset)
+        group = groups.get(key)
+        if group is None:
+            groups[key] = [config, 1, task_id]
+        else:
+            group[1] += 1
+
+    counter = Counter()
+    errors = 0
+    for (_, next_time, schedule_end_time, _), (config, num, task_id) in groups.items():
+        last_time = min(end_time, schedule_end_time)
+        # 已经到期的计划会在下一轮调度时运行
+        first_time = max(next_time, now)
+        if first_time > last_time:
+            continue
+        counter[int((first_time - origin).total_seconds()) // bucket] += num
+        try:
+            times = get_schedule_config(config).times_between(next_time, last_time, key=task_id)
+        except Exception:
+            errors += num
+            continue
+        if isinstance(times, list):
+            for t in times:
+                if t > now:
+                    counter[int((t - origin).total_seconds()) // bucket] += num
+        elif len(times):
+            import numpy as np
+            times = times[times > np.datetime64(now, 'us')]
+            index, counts = np.unique((times - np.datetime64(origin, 'us')) // np.timedelta64(bucket, 's'),
+                                      return_counts=True)
+            for i, count in zip(index.tolist(), counts.tolist()):
+                counter[i] += count * num
+
+    histogram = [{
+        'time': origin + timedelta(seconds=i * bucket),
+        'count': count
+    } for i, count in sorted(counter.items())]
+    peak = max(histogram, key=lambda x: x['count']) if histogram else None
+    return {
+        'start_time': now,
+        'end_time': end_time,
+        'bucket': bucket,
+        'schedules': sum(num for _, num, _ in groups.values()),
+        'groups': len(groups),
+        'errors': errors,
+        'total': sum(counter.values()),
+        'peak': peak,
+        'histogram': histogram,
+    }
+
+
+def diff_sorted_times(expected, logged):
+    """
+    expected和logged都是按时间升序的迭代器, 依次返回expected中不在logged里的时间, 只遍历一次
+    """
+    logged = iter(logged)
+    current = next(logged, None)
+    for schedule_time in expected:
+        while current is not None and current < schedule_time:
+            current = next(logged, None)
+        if current != schedule_time:
+            yield schedule_time
+
+
+def iter_log_missing_records(queue, schedule, start_time=None, end_time=None, chunk_size=2000):
+    """
+    按时间顺序返回应该运行但没有日志的计划时间, 应运行的时间由计划配置计算,
+    已运行的时间从日志中按计划时间升序流式读取, 两者归并比较
+    """
     ScheduleLogModel = get_schedule_log_model()
-    missing = []
-    schedule.config['base_on_now'] = False
-    schedule_times = get_schedule_times(schedule, start_time=start_time, end_time=end_time)
-    diffs = set()
-    if len(schedule_times) < 2:
-        # 处理只有一个时间的情况
-        return missing
-    for i in range(len(schedule_times) - 1):
-        a = schedule_times[i]
-        b = schedule_times[i + 1]
-        diff = b - a
-        seconds = int(diff.total_seconds())
-        diffs.add(seconds)
-    if len(diffs) != 1:
-        # 处理有多个间隔的情况
-        return missing
-    diff = diffs.pop()
-    if diff % (3600 * 24) == 0:
-        dimension = 'DAY'
-        interval = diff // (3600 * 24)
-    elif diff % 3600 == 0:
-        dimension = 'HOUR'
-        interval = diff // 3600
-    elif diff % 60 == 0:
-        dimension = 'MINUTE'
-        interval = diff // 60
-    else:
-        # 处理间隔不是整数的情况
-        return missing
-    start_time, end_time = schedule_times[0], schedule_times[-1]
-    lens = len(schedule_times)
-    # 这里batch=700是因为mysql.help_topic表的最大id是699，也就是700条数据
-    batch = 700
-    schedule_date_commands = []
-    for i, x in enumerate(range(0, lens, batch)):
-        b = x + batch - 1 if x + batch - 1 < lens else lens - 1
-        st, et = schedule_times[x], schedule_times[b]
-        schedule_date_commands.append(f"""
-                                SELECT
-                                date_add('{st}', INTERVAL + t{i}.help_topic_id * {interval} {dimension} ) AS date 
-                            FROM
-                                mysql.help_topic t{i} 
-                            WHERE
-                                t{i}.help_topic_id <= timestampdiff({dimension}, '{st}', '{et}') 
-                            """)
-    schedule_date_command = ' union all '.join(schedule_date_commands)
-    command = f"""
-                select a.date from ({schedule_date_command}) a 
-                left join (
-                    select schedule_time, count(1) as log_num 
-                    from {ScheduleLogModel._meta.db_table} 
-                    where 
-                        schedule_id = {schedule.id} and 
-                        queue = '{queue}' and 
-                        schedule_time between '{start_time}' and '{end_time}' 
-                    group by schedule_time
-                ) b 
-                on a.date = b.schedule_time where b.log_num is null
-            """
-    time = schedule.config[schedule.config['schedule_type']].get('time', '03:00:00')
-    with connection.cursor() as cursor:
-        cursor.execute(command)
-        for d, *_ in cursor.fetchall():
-            # 根据日志查出来的遗漏日期就是实际的日期，不需要根据latest_days来计算
-            if len(d) == 10:
-                d = d + ' ' + time
-            missing.append(parser.parse(d))
-    return missing
+    start_time, end_time = _get_schedule_start_end_time(schedule, start_time, end_time)
+    schedule_config = schedule.schedule_config
+    expected = schedule_config.iter_times(start_time, end_time, key=schedule.task_id)
+    logged = ScheduleLogModel.objects.filter(
+        schedule_id=schedule.id,
+        queue=queue,
+        schedule_time__gt=start_time,
+        schedule_time__lte=end_time
+    ).values_list('schedule_time', flat=True).order_by('schedule_time').distinct().iterator(chunk_size=chunk_size)
+    return diff_sorted_times(expected, logged)
+
+
+def get_log_missing_records(queue, schedule, start_time=None, end_time=None):
+    return list(iter_log_missing_records(queue, schedule, start_time=start_time, end_time=end_time))
 
 
 def get_missing_schedules(queue, schedule, start_time=None, end_time=None):
     missing = []
-    for schedule_time in get_log_missing_records(queue, schedule, start_time=start_time, end_time=end_time):
+    for schedule_time in iter_log_missing_records(queue, schedule, start_time=start_time, end_time=end_time):
         o = copy.copy(schedule)
         o.next_schedule_time = schedule_time
         missing.append(o)
@@ -131,67 +209,156 @@ def get_missing_schedules(queue, schedule, start_time=None, end_time=None):
 
 
 def get_missing_schedules_mapping(queue, schedules,
-                                  start_time=None, end_time=None):
+                                  start_time=None, end_time=None, chunk_size=2000):
+    """
+    批量检测一页计划的遗漏, 一次查询按(计划, 计划时间)升序流式读取所有计划的日志, 再逐个计划归并比较
+    """
+    ScheduleLogModel = get_schedule_log_model()
+    schedules = sorted(schedules, key=lambda x: x.id)
+    if not schedules:
+        return {}
+    windows = {}
+    for schedule in schedules:
+        windows[schedule.id] = _get_schedule_start_end_time(schedule, start_time, end_time)
+    logs = ScheduleLogModel.objects.filter(
+        schedule_id__in=list(windows),
+        queue=queue,
+        schedule_time__gt=min(x for x, _ in windows.values()),
+        schedule_time__lte=max(y for _, y in windows.values())
+    ).values_list('schedule_id', 'schedule_time').order_by(
+        'schedule_id', 'schedule_time'
+    ).distinct().iterator(chunk_size=chunk_size)
+    groups = groupby(logs, key=itemgetter(0))
+    group_id, group = next(groups, (None, ()))
     result = {}
     for schedule in schedules:
-        result[schedule.id] = get_missing_schedules(queue, schedule, start_time=start_time, end_time=end_time)
+        # 跳过不在本页的计划日志, 没有日志的计划对应空的日志
+        while group_id is not None and group_id < schedule.id:
+            group_id, group = next(groups, (None, ()))
+        logged = (schedule_time for _, schedule_time in group) if group_id == schedule.id else ()
+        schedule_start_time, schedule_end_time = windows[schedule.id]
+        expected = schedule.schedule_config.iter_times(
+            schedule_start_time, schedule_end_time, key=schedule.task_id)
+        missing = result[schedule.id] = []
+        for schedule_time in diff_sorted_times(expected, logged):
+            o = copy.copy(schedule)
+            o.next_schedule_time = schedule_time
+            missing.append(o)
     return result
 
 
-def get_maximum_retries_exceeded_records(queue, start_time=None, end_time=None, max_retry_times=5):
-    ScheduleLog = get_schedule_log_model()
-    queryset = ScheduleLog.objects.filter(status__in=[
-        ExecuteStatus.EXCEPTION.value,
-        ExecuteStatus.TIMEOUT.value
-    ], queue=queue)
-    if start_time:
-        queryset = queryset.filter(create_time__gte=start_time)
-    if end_time:
-        queryset = queryset.filter(create_time__lt=end_time)
-    queryset = queryset.values(
-        'schedule_id', 'schedule_time'
-    ).annotate(
-        times=Count('id'),
-        log_id=Max('id'),
-        latest_time=Max('create_time'),
-    ).filter(
-        times__gte=max_retry_times,
-    ).order_by('schedule_id', 'schedule_time')
-    return queryset
+def keyset_after(fields, values) -> Q:
+    """
+    (fields) > (values)的条件, 如(a, b) > (1, 2)转换为a > 1 or (a = 1 and b > 2)
+    """
+    condition = Q(**{'%s__gt' % fields[-1]: values[-1]})
+    for field, value in zip(reversed(fields[:-1]), reversed(values[:-1])):
+        condition = Q(**{'%s__gt' % field: value}) | (Q(**{field: value}) & condition)
+    return condition
 
 
-def get_failed_directly_records(queue, start_time=None, end_time=None):
-    ScheduleLog = get_schedule_log_model()
-    queryset = ScheduleLog.objects.filter(status=ExecuteStatus.FAILED, queue=queue)
+def iter_keyset_pages(queryset, fields=('schedule_id', 'schedule_time'), page_size=3000):
+    """
+    按fields升序分页读取, 每页从上一页最后一条记录之后开始(keyset分页), 不需要COUNT和OFFSET,
+    越往后翻页不会越慢, 每次只保留一页数据; fields需要唯一确定一条记录
+    """
+    fields = tuple(fields)
+    last = None
+    while True:
+        page = queryset if last is None else queryset.filter(keyset_after(fields, last))
+        page = list(page.order_by(*fields)[:page_size])
+        if page:
+            yield page
+        if len(page) < page_size:
+            break
+        row = page[-1]
+        last = [row[x] if isinstance(row, dict) else getattr(row, x) for x in fields]
+
+
+def iter_keyset(queryset, fields=('schedule_id', 'schedule_time'), page_size=3000):
+    for page in iter_keyset_pages(queryset, fields, page_size):
+        yield from page
+
+
+def get_attempt_records(queue, status, start_time=None, end_time=None):
+    """
+    从计划执行统计表中查询最后运行状态为status的记录, start_time/end_time为最后运行时间的范围
+    """
+    from django_common_task_system.models import ScheduleAttempt
+    queryset = ScheduleAttempt.objects.filter(queue=queue, last_status__in=status)
     if start_time:
-        queryset = queryset.filter(create_time__gte=start_time)
+        queryset = queryset.filter(update_time__gte=start_time)
     if end_time:
-        queryset = queryset.filter(create_time__lt=end_time)
-    queryset = queryset.values('schedule_id', 'schedule_time').annotate(
-        count=Count('id'),
-    )
+        queryset = queryset.filter(update_time__lt=end_time)
     return queryset
 
 
-def get_retryable_records(queue, start_time=None, end_time=None, max_retry_times=5):
-    # lt = less than    gt = greater than
-    # lt = less than    gt = greater than
-    ScheduleLog = get_schedule_log_model()
-    queryset = ScheduleLog.objects.filter(status__in=[
-        ExecuteStatus.EXCEPTION.value,
-        ExecuteStatus.TIMEOUT.value
-    ], queue=queue)
-    if start_time:
-        queryset = queryset.filter(create_time__gte=start_time)
-    if end_time:
-        queryset = queryset.filter(create_time__lt=end_time)
-    queryset = queryset.values(
-        'schedule_id', 'schedule_time'
-    ).annotate(
-        times=Count('id'),
-        log_id=Max('id'),
-        latest_time=Max('create_time'),
-    ).filter(
-        times__lt=max_retry_times,
+def _attempt_values(queryset):
+    # 和原先按日志分组统计的结果保持相同的字段
+    return queryset.values(
+        'schedule_id', 'schedule_time',
+        times=F('attempts'),
+        log_id=F('last_log_id'),
+        latest_time=F('update_time'),
     ).order_by('schedule_id', 'schedule_time')
-    return queryset
+
+
+def get_maximum_retries_exceeded_records(queue, start_time=None, end_time=None, max_retry_times=5):
+    queryset = get_attempt_records(queue, [ExecuteStatus.EXCEPTION.value, ExecuteStatus.TIMEOUT.value],
+                                   start_time=start_time, end_time=end_time)
+    return _attempt_values(queryset.filter(attempts__gte=max_retry_times))
+
+
+def get_failed_directly_records(queue, start_time=None, end_time=None):
+    """
+    最后一次运行失败(无需重试)的计划时间, count为该计划时间的总执行次数;
+    之前从日志表统计时包含后来又成功的计划时间, count为失败日志的条数
+    """
+    queryset = get_attempt_records(queue, [ExecuteStatus.FAILED.value], start_time=start_time, end_time=end_time)
+    return _attempt_values(queryset).annotate(count=F('attempts'))
+
+
+def get_retryable_records(queue, start_time=None, end_time=None, max_retry_times=5, active_since=None):
+    # active_since: 只返回在该时间之后有新的异常日志的计划
+    queryset = get_attempt_records(queue, [ExecuteStatus.EXCEPTION.value, ExecuteStatus.TIMEOUT.value],
+                                   start_time=start_time, end_time=end_time)
+    if active_since:
+        queryset = queryset.filter(update_time__gte=active_since)
+    return _attempt_values(queryset.filter(attempts__lt=max_retry_times))
+
+
+def iter_retryable_records(queue, page_size=3000, **kwargs):
+    """
+    按(schedule_id, schedule_time)分页流式读取可重试的记录, 参数同get_retryable_records
+    """
+    return iter_keyset(get_retryable_records(queue, **kwargs), page_size=page_size)
+
+
+def iter_maximum_retries_exceeded_records(queue, page_size=3000, **kwargs):
+    return iter_keyset(get_maximum_retries_exceeded_records(queue, **kwargs), page_size=page_size)
+
+
+def get_retry_delay(attempts, base=None, factor=None, max_delay=None, rnd=random):
+    """
+    第attempts次执行失败后的退避时间, 指数增长, 在后一半区间内随机抖动, 避免同一时间失败的计划同时重试
+    """
+    base = RETRY_BACKOFF_BASE if base is None else base
+    factor = RETRY_BACKOFF_FACTOR if factor is None else factor
+    max_delay = RETRY_BACKOFF_MAX if max_delay is None else max_delay
+    delay = min(base * factor ** max(attempts - 1, 0), max_delay)
+    return timedelta(seconds=delay / 2 + rnd.uniform(0, delay / 2))
+
+
+def get_pending_retry_attempts(queue, max_retry_times=5, now=None, stale_timeout=None):
+    """
+    需要安排重试的执行统计: 最后一次执行异常/超时, 没有超过最大重试次数, 还没有安排重试或重试已丢失
+    """
+    from django_common_task_system.models import ScheduleAttempt
+    now = now or datetime.now()
+    stale_timeout = RETRY_STALE_TIMEOUT if stale_timeout is None else stale_timeout
+    return ScheduleAttempt.objects.filter(
+        Q(next_retry_time__isnull=True) | Q(next_retry_time__lt=now - timedelta(seconds=stale_timeout)),
+        queue=queue,
+        last_status__in=[ExecuteStatus.EXCEPTION.value, ExecuteStatus.TIMEOUT.value],
+        attempts__lt=max_retry_times,
+    )
@@ -68,7 +68,8 @@ class QueueScheduleSerializer(ScheduleSerializer):
 
     class Meta(ScheduleSerializer.Meta):
         # fields = ('id', 'task', 'schedule_time', 'update_time', 'callback', 'user')
-        exclude = ('priority', 'create_time', 'next_schedule_time', 'schedule_start_time',
+        # 保留priority: 队列模块可以在运行中切换为优先级队列, 所有队列都带上priority, 其它队列忽略该字段
+        exclude = ('create_time', 'next_schedule_time', 'schedule_start_time',
                    'schedule_end_time', 'status', 'config')
 
 
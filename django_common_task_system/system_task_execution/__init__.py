@@ -1,5 +1,19 @@
+import os
+import logging
+from django.conf import settings
 from .thread import ScheduleConsumerThread
 from django_common_task_system.program import ProgramAgent
 
 
-consumer_agent = ProgramAgent(program_class=ScheduleConsumerThread)
+# thread: 在Engine进程的线程池中执行系统计划, prefork: fork多个进程执行系统计划
+SYSTEM_CONSUMER_MODE = getattr(settings, 'SYSTEM_CONSUMER_MODE', 'thread')
+
+if SYSTEM_CONSUMER_MODE == 'prefork' and hasattr(os, 'fork'):
+    from .prefork import ScheduleConsumerSupervisor as consumer_program_class
+else:
+    if SYSTEM_CONSUMER_MODE == 'prefork':
+        logging.getLogger('consumer').warning('os.fork is not supported, use thread mode')
+    consumer_program_class = ScheduleConsumerThread
+
+
+consumer_agent = ProgramAgent(program_class=consumer_program_class)
@@ -0,0 +1,135 @@
+import os
+import time
+import signal
+import logging
+import threading
+import multiprocessing
+from django.conf import settings
+from django.db import connections
+from django_common_task_system.system_task_execution.system_task_execution.consumer import (
+    Consumer, Executor, load_executors, SYSTEM_EXECUTOR_CONCURRENCY, SYSTEM_CONSUMER_DRAIN_TIMEOUT
+)
+from django_common_task_system.builtins import builtins
+
+
+logger = logging.getLogger('consumer')
+
+# 执行系统计划的进程数
+SYSTEM_CONSUMER_PROCESSES = getattr(settings, 'SYSTEM_CONSUMER_PROCESSES', None) or os.cpu_count() or 1
+# 每个进程执行多少个计划后重启, 0表示不限制
+SYSTEM_CONSUMER_MAX_TASKS = getattr(settings, 'SYSTEM_CONSUMER_MAX_TASKS', 1000)
+# 每个进程内存超过多少MB后重启, 0表示不限制
+SYSTEM_CONSUMER_MAX_MEMORY = getattr(settings, 'SYSTEM_CONSUMER_MAX_MEMORY', 0)
+
+
+class ScheduleConsumerSupervisor(Consumer, threading.Thread):
+    """
+    多进程模式, 在Engine进程中加载好django和执行器后fork出多个ScheduleConsumerProcess, 共同消费system队列,
+    进程退出(异常退出或达到max_tasks/max_memory)后重新fork
+    """
+
+    def __init__(self, processes=None, max_tasks=None, max_memory=None):
+        super(ScheduleConsumerSupervisor, self).__init__(queue=builtins.schedule_queues.system.queue)
+        threading.Thread.__init__(self, daemon=True)
+        self.processes = processes or SYSTEM_CONSUMER_PROCESSES
+        self.max_tasks = SYSTEM_CONSUMER_MAX_TASKS if max_tasks is None else max_tasks
+        self.max_memory = SYSTEM_CONSUMER_MAX_MEMORY if max_memory is None else max_memory
+        self.workers = {}
+
+    @property
+    def program_id(self) -> int:
+        return self.ident
+
+    @staticmethod
+    def get_shared_limits():
+        """
+        有并发限制的执行器在所有进程间共用一个信号量
+        """
+        context = multiprocessing.get_context('fork')
+        limits = {}
+        for key, executor in Executor.items():
+            limit = SYSTEM_EXECUTOR_CONCURRENCY.get(key) or executor.concurrency
+            if limit:
+                limits[key] = context.Semaphore(limit)
+        return limits
+
+    def spawn(self, shared_limits):
+        from .process import ScheduleConsumerProcess
+        # 子进程不能共用父进程的数据库连接
+        connections.close_all()
+        parent_pid = os.getpid()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                ScheduleConsumerProcess(
+                    max_tasks=self.max_tasks,
+                    max_memory=self.max_memory,
+                    shared_limits=shared_limits,
+                ).run_forked(parent_pid)
+            except BaseException:
+                logger.exception('consumer process(%s) failed', os.getpid())
+                code = 1
+            finally:
+                connections.close_all()
+                logging.shutdown()
+                os._exit(code)
+        logger.info('consumer process(%s) started', pid)
+        self.workers[pid] = time.time()
+
+    def reap(self):
+        for pid in list(self.workers):
+            try:
+                finished, status = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                finished, status = pid, 0
+            if finished:
+                self.workers.pop(pid)
+                logger.info('consumer process(%s) exited with status %s', pid, status)
+
+    def shutdown(self):
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        # 子进程退出前会等待正在执行的计划完成
+        deadline = time.time() + SYSTEM_CONSUMER_DRAIN_TIMEOUT + 5
+        while self.workers and time.time() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in self.workers:
+            logger.warning('consumer process(%s) not exited, kill', pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+        self.workers.clear()
+
+    def run(self):
+        event = self._event
+        event.set()
+        load_executors()
+        shared_limits = self.get_shared_limits()
+        logger.info('system schedule supervisor started, processes: %s', self.processes)
+        workers = None
+        while event.is_set():
+            self.reap()
+            while event.is_set() and len(self.workers) < self.processes:
+                self.spawn(shared_limits)
+            if workers != list(self.workers):
+                workers = list(self.workers)
+                self.state.push(workers=','.join(str(x) for x in workers))
+            time.sleep(1)
+        self.shutdown()
+        self.state.push(workers='')
+        logger.info('system schedule supervisor stopped')
+
+    def stop(self, destroy=False) -> str:
+        # 计数由子进程更新, 停止时会推送整个状态, 先拉取最新的计数
+        self.state.pull()
+        super(ScheduleConsumerSupervisor, self).stop(destroy=destroy)
+        if self.is_alive() and self is not threading.current_thread():
+            self.join()
+        return ''
@@ -1,14 +1,42 @@
 import os
+import time
+import signal
+import threading
+import logging
 from multiprocessing import Process
-from django_common_task_system.system_task_execution.system_task_execution.consumer import Consumer
+from django_common_task_system.system_task_execution.system_task_execution.consumer import Consumer, BaseExecutor
 from django_common_task_system.builtins import builtins
 
 
+logger = logging.getLogger('consumer')
+
+
+def get_rss() -> int:
+    """
+    当前进程占用的物理内存(字节)
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        # 没有/proc时使用峰值内存, Linux单位为KB
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
 class ScheduleConsumerProcess(Consumer, Process):
 
-    def __init__(self):
+    def __init__(self, max_tasks=0, max_memory=0, shared_limits=None):
+        """
+        max_tasks: 执行多少个计划后退出, max_memory: 内存超过多少MB后退出, 0表示不限制,
+        退出前等待正在执行的计划完成, 由ScheduleConsumerSupervisor启动新的进程
+        """
         super(ScheduleConsumerProcess, self).__init__(queue=builtins.schedule_queues.system.queue)
         Process.__init__(self, daemon=True)
+        self.max_tasks = max_tasks
+        self.max_memory = max_memory * 1024 * 1024
+        self.shared_limits = shared_limits
+        self.processed = 0
 
     def run(self):
         import django
@@ -17,6 +45,44 @@ class ScheduleConsumerProcess(Consumer, Process):
         django.setup()
         super(ScheduleConsumerProcess, self).run()
 
+    def run_forked(self, parent_pid):
+        """
+        在os.fork出的子进程中运行, django和执行器已在父进程中加载
+        """
+        event = self._event
+
+        def on_term(*_):
+            event.clear()
+
+        def watch_parent():
+            # 父进程退出后不再取新的计划
+            while event.is_set():
+                if os.getppid() != parent_pid:
+                    logger.warning('consumer process(%s) parent exited', os.getpid())
+                    event.clear()
+                    break
+                time.sleep(1)
+        signal.signal(signal.SIGTERM, on_term)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # 跳过Consumer.run开始时的等待
+        event.set()
+        threading.Thread(target=watch_parent, daemon=True).start()
+        Consumer.run(self)
+
+    def process(self, executor: BaseExecutor):
+        super(ScheduleConsumerProcess, self).process(executor)
+        with self._state_lock:
+            self.processed += 1
+            processed = self.processed
+        if not self._event.is_set():
+            return
+        if self.max_tasks and processed >= self.max_tasks:
+            logger.info('consumer process(%s) processed %s schedules, recycle', os.getpid(), processed)
+            self._event.clear()
+        elif self.max_memory and get_rss() > self.max_memory:
+            logger.info('consumer process(%s) memory exceeded %s bytes, recycle', os.getpid(), self.max_memory)
+            self._event.clear()
+
     def stop(self, destroy=False):
         super(ScheduleConsumerProcess, self).stop(destroy=destroy)
         self.kill()
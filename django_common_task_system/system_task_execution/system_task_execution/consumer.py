@@ -1,7 +1,11 @@
 import traceback
 import socket
 import logging
-from queue import Queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from queue import Queue, Empty
+from django.conf import settings
 from django_common_task_system.models import ExceptionReport
 from django_common_task_system import get_schedule_log_model
 from django_common_task_system.choices import ExecuteStatus
@@ -13,6 +17,13 @@ IP = socket.gethostbyname(socket.gethostname())
 logger = logging.getLogger('consumer')
 ScheduleLog = get_schedule_log_model()
 
+# 同时执行系统计划的线程数
+SYSTEM_CONSUMER_WORKERS = getattr(settings, 'SYSTEM_CONSUMER_WORKERS', 4)
+# 各执行器(按注册的任务名称)最多同时执行的数量, 覆盖执行器的concurrency
+SYSTEM_EXECUTOR_CONCURRENCY = getattr(settings, 'SYSTEM_EXECUTOR_CONCURRENCY', {})
+# 停止时等待正在执行的计划完成的秒数
+SYSTEM_CONSUMER_DRAIN_TIMEOUT = getattr(settings, 'SYSTEM_CONSUMER_DRAIN_TIMEOUT', 60)
+
 
 class NoRetryException(Exception):
     """
@@ -95,6 +106,8 @@ class Schedule:
 class BaseExecutor(object):
     parent = None
     name = None
+    # 同一执行器最多同时执行的数量, None表示只受线程数限制
+    concurrency = None
 
     def __init__(self, schedule: Schedule):
         self.schedule = schedule
@@ -145,6 +158,96 @@ class _Executor(dict):
 Executor = _Executor()
 
 
+class ExecutorPool:
+    """
+    在线程池中执行系统计划, 每个执行器最多同时执行concurrency个计划, 超过的计划由requeue稍后放回队列,
+    不占用线程和内存, 不会阻塞其它执行器
+    """
+
+    def __init__(self, handler, workers=None, limits=None, shared_limits=None, requeue=None):
+        """
+        shared_limits: 执行器名称到多进程信号量的映射, 多个进程共同限制同一执行器的并发,
+        超过并发限制或拿不到信号量的计划由requeue稍后放回队列
+        """
+        self.handler = handler
+        self.workers = workers or SYSTEM_CONSUMER_WORKERS
+        self.limits = SYSTEM_EXECUTOR_CONCURRENCY if limits is None else limits
+        self.shared_limits = shared_limits or {}
+        self.requeue = requeue
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='SystemExecutor')
+        self._slots = threading.Semaphore(self.workers)
+        self._lock = threading.Lock()
+        self._running = {}
+        self._futures = set()
+
+    @staticmethod
+    def get_key(executor: BaseExecutor):
+        return executor.name or executor.parent
+
+    def get_limit(self, executor: BaseExecutor):
+        return self.limits.get(self.get_key(executor)) or executor.concurrency or self.workers
+
+    def acquire(self, timeout=None) -> bool:
+        """
+        等待空闲线程, 有空闲线程时才从队列中取计划
+        """
+        return self._slots.acquire(timeout=timeout)
+
+    def release(self):
+        self._slots.release()
+
+    def submit(self, executor: BaseExecutor):
+        """
+        提交前需要先acquire
+        """
+        key = self.get_key(executor)
+        shared = self.shared_limits.get(key)
+        if shared is not None:
+            # 其它进程正在执行, 本进程等待不会被唤醒
+            limited = not shared.acquire(False)
+        else:
+            with self._lock:
+                limited = self._running.get(key, 0) >= self.get_limit(executor)
+                if not limited:
+                    self._running[key] = self._running.get(key, 0) + 1
+        if limited:
+            # 不在内存中排队, 放回队列稍后再取, 避免执行器积压时内存无限增长
+            self._slots.release()
+            self.requeue(executor)
+            return
+        with self._lock:
+            future = self._pool.submit(self._run, key, executor)
+            self._futures.add(future)
+        future.add_done_callback(self._discard)
+
+    def _discard(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def _run(self, key, executor: BaseExecutor):
+        shared = self.shared_limits.get(key)
+        try:
+            self.handler(executor)
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            if shared is not None:
+                shared.release()
+            else:
+                with self._lock:
+                    self._running[key] -= 1
+            self._slots.release()
+
+    def drain(self, timeout=None):
+        """
+        等待正在执行的计划完成
+        """
+        with self._lock:
+            futures = list(self._futures)
+        wait(futures, timeout=SYSTEM_CONSUMER_DRAIN_TIMEOUT if timeout is None else timeout)
+        self._pool.shutdown(wait=False)
+
+
 def load_executors(module_path='django_common_task_system.system_task_execution.system_task_execution.executors'):
     import importlib
     from pathlib import Path
@@ -180,6 +283,8 @@ class Consumer(LocalProgram):
     def __init__(self, queue: Queue):
         super(Consumer, self).__init__(name='Consumer', logger=logger)
         self.queue = queue
+        self.shared_limits = None
+        self._state_lock = threading.Lock()
 
     def run(self):
         queue = self.queue
@@ -190,29 +295,60 @@ class Consumer(LocalProgram):
         load_executors()
         state.push()
         logger.info('system schedule execution process started')
+        pool = ExecutorPool(self.process, shared_limits=self.shared_limits, requeue=self.requeue)
         while event.is_set():
-            success = 1
+            # 等待超时后重新检查是否已停止
+            if not pool.acquire(timeout=1):
+                continue
+            try:
+                schedule = queue.get(timeout=1)
+            except Empty:
+                schedule = None
+            # 部分队列超时返回None, 与Empty同样处理
+            if schedule is None:
+                pool.release()
+                continue
             try:
-                schedule = queue.get()
                 schedule = Schedule(schedule)
                 logger.info('get schedule: %s', schedule)
                 executor = Executor(schedule)
-                executor.start()
             except Exception as e:
-                success = 0
-                self.logger.exception(e)
-                try:
-                    ExceptionReport.objects.create(
-                        ip=IP,
-                        content=traceback.format_exc(),
-                    )
-                except Exception as e:
-                    self.logger.exception(e)
-            finally:
-                state.pull()
-                state.succeed_count += success
-                state.failed_count += 1 - success
-                state.last_process_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                state.push(last_process_time=state.last_process_time,
-                           succeed_count=state.succeed_count,
-                           failed_count=state.failed_count)
+                pool.release()
+                self.on_failed(e)
+                continue
+            pool.submit(executor)
+        pool.drain()
+        logger.info('system schedule execution process stopped')
+
+    def requeue(self, executor: BaseExecutor):
+        self.queue.put(executor.schedule.content, deliver_at=time.time() + 1)
+
+    def process(self, executor: BaseExecutor):
+        try:
+            executor.start()
+        except Exception as e:
+            self.on_failed(e)
+        else:
+            self.on_processed(1)
+
+    def on_failed(self, e):
+        self.logger.exception(e)
+        try:
+            ExceptionReport.objects.create(
+                ip=IP,
+                content=traceback.format_exc(),
+            )
+        except Exception as e:
+            self.logger.exception(e)
+        self.on_processed(0)
+
+    def on_processed(self, success):
+        state = self.state
+        with self._state_lock:
+            state.pull()
+            state.succeed_count += success
+            state.failed_count += 1 - success
+            state.last_process_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            state.push(last_process_time=state.last_process_time,
+                       succeed_count=state.succeed_count,
+                       failed_count=state.failed_count)
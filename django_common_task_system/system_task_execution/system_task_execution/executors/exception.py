@@ -1,14 +1,11 @@
-from django.urls import reverse
-import requests
 from django_common_task_system.system_task_execution.system_task_execution.consumer import (
     Executor, BaseExecutor, EmptyResult, Failed, NoRetryException, PartialFailed)
 from django_common_task_system.builtins import builtins
+from django_common_task_system.queue.service import queue_service, QueueNotFound, QueueServiceError
 from django_common_task_system.schedule import util as schedule_util
 from django_common_task_system import get_schedule_model, get_schedule_serializer
-from django_common_task_system.models import AbstractSchedule
-from urllib.parse import urljoin
-from django.core.paginator import Paginator
-import os
+from django_common_task_system.models import AbstractSchedule, ScheduleAttempt
+from datetime import datetime
 
 
 Schedule: AbstractSchedule = get_schedule_model()
@@ -18,11 +15,9 @@ ScheduleSerializer = get_schedule_serializer()
 @Executor.register
 class ExceptionHandler(BaseExecutor):
     name = builtins.schedules.exception_handle.task.name
-    last_executed_time = None
+    concurrency = 1
 
     def execute(self):
-        response = requests.get(urljoin(os.environ['DJANGO_SERVER_ADDRESS'], reverse('schedule-status')))
-        queue_status = response.json()
         max_retry_times = self.schedule.task.config.get('max-retry-times', 5)
         queues = self.schedule.task.config.get('queues', ['opening'])
         if not queues:
@@ -32,41 +27,52 @@ class ExceptionHandler(BaseExecutor):
         succeed = False
         total = 0
         for queue in queues:
-            num = queue_status.get(queue, -1)
-            if num < 0:
+            try:
+                num = queue_service.qsize(queue)
+            except QueueNotFound:
                 raise Failed('queue %s not found' % queue)
             if num > 0:
                 result[queue] = "queue %s is not free, %s tasks in queue" % (queue, num)
                 errors.append(NoRetryException(result[queue]))
             else:
-                records = schedule_util.get_retryable_records(queue, start_time=self.last_executed_time,
-                                                              max_retry_times=max_retry_times)
-                paginator = Paginator(records, 3000)
-                for page in paginator.page_range:
-                    page_records = paginator.page(page).object_list
-                    if not page_records:
-                        break
-                    mapping = {}
-                    for x in records:
-                        mapping.setdefault(x['schedule_id'], []).append(x)
-                    schedules = Schedule.objects.filter(id__in=mapping.keys())
+                # 每个失败的计划时间只安排一次重试, 按执行次数退避后延迟投递, 不再每次扫描全部异常记录
+                now = datetime.now()
+                attempts = schedule_util.get_pending_retry_attempts(queue, max_retry_times=max_retry_times, now=now)
+                # 分页投递, 每页的结果累加, 避免后面成功的页覆盖前面失败的页
+                put = 0
+                put_errors = []
+                for page_attempts in schedule_util.iter_keyset_pages(attempts, page_size=3000):
+                    schedules = Schedule.objects.in_bulk({x.schedule_id for x in page_attempts})
                     data = []
-                    for x in schedules:
-                        for e in mapping.get(x.pk, []):
-                            x.next_schedule_time = e['schedule_time']
-                            x.generator = 'retry'
-                            x.queue = queue
-                            data.append(ScheduleSerializer(x).data)
-                    url = urljoin(os.environ['DJANGO_SERVER_ADDRESS'], reverse('schedule-put-raw'))
-                    put_result = requests.post(url, json={
-                        'schedules': data,
-                        'queue': queue
-                    }).json()
-                    if 'error' in put_result:
-                        errors.append(NoRetryException(put_result['error']))
-                    result[queue] = put_result
-                    total += len(data)
-                succeed = True
+                    deliver_at = []
+                    retried = []
+                    for attempt in page_attempts:
+                        x = schedules.get(attempt.schedule_id)
+                        if x is None:
+                            continue
+                        x.next_schedule_time = attempt.schedule_time
+                        x.generator = 'retry'
+                        x.queue = queue
+                        attempt.next_retry_time = now + schedule_util.get_retry_delay(attempt.attempts)
+                        data.append(ScheduleSerializer(x).data)
+                        deliver_at.append(attempt.next_retry_time.timestamp())
+                        retried.append(attempt)
+                    if not data:
+                        continue
+                    try:
+                        queue_service.put_many(queue, data, deliver_at=deliver_at)
+                    except QueueServiceError as e:
+                        errors.append(NoRetryException(str(e)))
+                        put_errors.append(str(e))
+                        continue
+                    ScheduleAttempt.objects.bulk_update(retried, ['next_retry_time'])
+                    put += len(data)
+                result[queue] = {'message': 'put %s schedules to %s' % (put, queue)}
+                if put_errors:
+                    result[queue]['error'] = put_errors
+                total += put
+                if put or not put_errors:
+                    succeed = True
 
         if errors and not succeed:
             raise Failed(result)
@@ -0,0 +1,24 @@
+from django_common_task_system.system_task_execution.system_task_execution.consumer import (
+    Executor, BaseExecutor, EmptyResult)
+from django_common_task_system.builtins import builtins
+from django_common_task_system.schedule.retention import LogRetention
+
+
+@Executor.register
+class LogCleanExecutor(BaseExecutor):
+    name = builtins.tasks.log_clean.name
+    concurrency = 1
+
+    def execute(self):
+        config = self.schedule.task.config
+        retention = LogRetention(
+            retention_days=config.get('retention_days'),
+            chunk_size=config.get('chunk_size'),
+            pause=config.get('pause'),
+            archive_path=config.get('archive_path'),
+            archive_format=config.get('archive_format'),
+        )
+        result = retention.run()
+        if result['deleted'] == 0 and result['attempts_deleted'] == 0:
+            raise EmptyResult('no log before %s' % result['cutoff'])
+        return result
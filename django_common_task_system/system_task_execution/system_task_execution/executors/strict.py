@@ -1,16 +1,13 @@
-from urllib.parse import urljoin
-from django.urls import reverse
 from django_common_task_system.system_task_execution.system_task_execution.consumer import (
     Executor, BaseExecutor, Failed, EmptyResult, NoRetryException, PartialFailed)
+from django_common_task_system.system_task_execution.system_task_execution.watermark import Watermark
 from django_common_task_system.builtins import builtins
+from django_common_task_system.queue.service import queue_service, QueueNotFound, QueueServiceError
 from django_common_task_system.schedule import util as schedule_util
 from django_common_task_system import get_schedule_model, get_schedule_serializer
 from django_common_task_system.choices import ScheduleStatus
-from django.core.paginator import Paginator
 from typing import Dict, Union
 import logging
-import requests
-import os
 
 
 logger = logging.getLogger('client')
@@ -21,46 +18,54 @@ ScheduleSerializer = get_schedule_serializer()
 @Executor.register
 class StrictScheduleHandler(BaseExecutor):
     name = builtins.tasks.strict_schedule_handle.name
-    last_executed_time = None
+    concurrency = 1
 
     def execute(self):
-        response = requests.get(urljoin(os.environ['DJANGO_SERVER_ADDRESS'], reverse('schedule-status')))
-        queue_status = response.json()
         queues = self.schedule.task.config.get('queues', ['opening'])
         if not queues:
             raise Failed('queues is empty, please set queues in config or close this schedule')
-        schedules = Schedule.objects.filter(is_strict=True, status=ScheduleStatus.OPENING)
+        # 按id分页, 每页的日志在get_missing_schedules_mapping中一次查询
+        schedules = Schedule.objects.filter(
+            is_strict=True, status=ScheduleStatus.OPENING
+        ).select_related('task').order_by('id')
         result: Dict[str, Union[Dict, str]] = {}
         total = 0
         errors = []
         succeed = False
         for queue in queues:
-            queue_num = queue_status.get(queue, -1)
-            if queue_num < 0:
+            try:
+                queue_num = queue_service.qsize(queue)
+            except QueueNotFound:
                 raise Failed('queue %s not found' % queue)
-            elif queue_num > 0:
+            if queue_num > 0:
                 result[queue] = 'queue %s is not free, %s tasks in queue' % (queue, queue_num)
                 errors.append(NoRetryException(result[queue]))
             else:
-                paginator = Paginator(schedules, 3000)
-                for page in paginator.page_range:
-                    page_schedules = paginator.page(page).object_list
-                    queue_result = result[queue] = {}
+                # 只检查上次成功处理之后的计划时间, 定期全量检查
+                watermark = Watermark(self.name, queue)
+                start_time = watermark.begin()
+                put_failed = False
+                queue_result = result[queue] = {}
+                for page_schedules in schedule_util.iter_keyset_pages(schedules, ('id',), page_size=3000):
                     missing_mapping = schedule_util.get_missing_schedules_mapping(queue, page_schedules,
-                                                                                  start_time=self.last_executed_time)
+                                                                                  start_time=start_time)
+                    page_missing = []
                     for schedule_id, missing in missing_mapping.items():
                         if missing:
-                            response = requests.post(
-                                urljoin(os.environ['DJANGO_SERVER_ADDRESS'], reverse('schedule-put-raw')),
-                                json={
-                                    'schedules': ScheduleSerializer(missing, many=True).data,
-                                    'queue': queue
-                                }).json()
-                            if 'error' in response:
-                                queue_result[schedule_id] = response['error']
-                            else:
-                                queue_result[schedule_id] = 'put %s tasks' % len(missing)
-                        total += len(missing)
+                            page_missing.extend(missing)
+                            queue_result[schedule_id] = 'put %s tasks' % len(missing)
+                    if not page_missing:
+                        continue
+                    # 一页的遗漏计划一次放入队列
+                    try:
+                        queue_service.put_many(queue, ScheduleSerializer(page_missing, many=True).data)
+                    except QueueServiceError as e:
+                        put_failed = True
+                        for schedule_id in {x.id for x in page_missing}:
+                            queue_result[schedule_id] = str(e)
+                    total += len(page_missing)
+                if not put_failed:
+                    watermark.commit()
                 succeed = True
         if errors and not succeed:
             raise Failed(result)
@@ -0,0 +1,62 @@
+from datetime import datetime, timedelta
+from django.conf import settings
+from django_common_task_system.cache_service import cache_agent
+import json
+
+
+watermark_key = 'system-task:watermark'
+
+
+class Watermark:
+    """
+    记录系统任务在每个队列上最近一次成功处理的时间, 保存在cache_agent中,
+    下次只处理该时间之后的数据, 每隔full_audit_interval做一次全量检查
+    """
+
+    def __init__(self, handler: str, queue: str):
+        self.field = '%s:%s' % (handler, queue)
+        self.full_audit_interval = timedelta(
+            seconds=getattr(settings, 'SYSTEM_TASK_FULL_AUDIT_INTERVAL', 24 * 3600))
+        # 日志上报可能有延迟, 每次多往前检查一段时间
+        self.overlap = timedelta(seconds=getattr(settings, 'SYSTEM_TASK_WATERMARK_OVERLAP', 600))
+        self.time = None
+        self.audit_time = None
+        self.started_time = None
+        self.full_audit = True
+
+    def pull(self):
+        state = cache_agent.hget(watermark_key, self.field)
+        if isinstance(state, bytes):
+            state = state.decode()
+        if state:
+            state = json.loads(state)
+            self.time = datetime.strptime(state['time'], '%Y-%m-%d %H:%M:%S')
+            self.audit_time = datetime.strptime(state['audit_time'], '%Y-%m-%d %H:%M:%S')
+        return self
+
+    def begin(self, now=None):
+        """
+        返回本次需要处理的开始时间, None表示全量检查
+        """
+        self.pull()
+        self.started_time = (now or datetime.now()).replace(microsecond=0)
+        self.full_audit = self.time is None or self.audit_time is None or \
+            self.started_time - self.audit_time >= self.full_audit_interval
+        if self.full_audit:
+            return None
+        return self.time - self.overlap
+
+    def commit(self):
+        """
+        处理成功后保存本次开始处理的时间
+        """
+        self.time = self.started_time
+        if self.full_audit:
+            self.audit_time = self.started_time
+        cache_agent.hset(watermark_key, self.field, json.dumps({
+            'time': self.time.strftime('%Y-%m-%d %H:%M:%S'),
+            'audit_time': self.audit_time.strftime('%Y-%m-%d %H:%M:%S'),
+        }))
+
+    def reset(self):
+        cache_agent.hdel(watermark_key, self.field)
@@ -1,5 +1,4 @@
 import threading
-import time
 from django_common_task_system.system_task_execution.system_task_execution.consumer import Consumer
 from django_common_task_system.builtins import builtins
 
@@ -14,6 +13,8 @@ class ScheduleConsumerThread(Consumer, threading.Thread):
         return self.ident
 
     def stop(self, destroy=False) -> str:
-        while self.is_alive():
-            time.sleep(0.5)
+        # 清除运行标记, 等待正在执行的计划完成
+        super(ScheduleConsumerThread, self).stop(destroy=destroy)
+        if self.is_alive() and self is not threading.current_thread():
+            self.join()
         return ''
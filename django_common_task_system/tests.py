@@ -1,3 +1,1470 @@
-from django.test import TestCase
+from django.test import TestCase, SimpleTestCase
+from datetime import datetime, timedelta
+from django_common_task_system.schedule.config import ScheduleConfig, ScheduleConfigCache
+from django_common_task_system.schedule.util import (
+    diff_sorted_times, get_retry_delay, get_schedule_times, iter_keyset_pages
+)
+from django_common_task_system.utils.cron_utils import compile_cron, get_next_cron_time
+from django_common_task_system.utils.cache import lru_ttl_cache
+from django_common_task_system.utils.schedule_time import _parse_sentence, parse_sentence
+from django_common_task_system.queue.service import check_schedules
+from django_common_task_system.system_task_execution.system_task_execution.consumer import ExecutorPool
+from croniter import croniter
+from types import SimpleNamespace
+from unittest import mock
+from queue import Empty
+import threading
+import shutil
+import tempfile
+import unittest
+import gzip
+import glob
+import json
+import os
+import random
+import uuid
+import time
 
-# Create your tests here.
+
+def loop_current_time(start, now, step):
+    # 原先逐步累加的实现, 用于校验整除计算的结果
+    schedule_time = start
+    while schedule_time < now:
+        schedule_time += step
+    return schedule_time
+
+
+def loop_next_time(start, last_time, step):
+    next_time = start
+    while next_time <= last_time:
+        next_time += step
+    return next_time
+
+
+def random_datetime(rnd: random.Random, start=datetime(2023, 1, 1), days=30):
+    return start + timedelta(seconds=rnd.randint(0, days * 86400), microseconds=rnd.choice([0, rnd.randint(0, 999999)]))
+
+
+class ScheduleTimeArithmeticTest(SimpleTestCase):
+    rounds = 500
+
+    def test_continuous_parity(self):
+        rnd = random.Random(35)
+        for _ in range(self.rounds):
+            period = rnd.choice([1, 2, 3, 7, 60, 3600, rnd.randint(1, 5000)])
+            start = random_datetime(rnd)
+            now = start + timedelta(seconds=rnd.randint(-100, 20000), microseconds=rnd.randint(0, 999999))
+            config = ScheduleConfig(config={
+                'schedule_type': 'S',
+                'base_on_now': False,
+                'S': {'period': period, 'schedule_start_time': start.strftime('%Y-%m-%d %H:%M:%S')}
+            })
+            start = start.replace(microsecond=0)
+            step = timedelta(seconds=period)
+            self.assertEqual(config.get_current_time(start_time=now), loop_current_time(start, now, step))
+            self.assertEqual(config.get_next_time(now), loop_next_time(now, now, step))
+
+    def test_day_parity(self):
+        rnd = random.Random(36)
+        for _ in range(self.rounds):
+            period = rnd.randint(1, 10)
+            timing_time = '%02d:%02d:%02d' % (rnd.randint(0, 23), rnd.randint(0, 59), rnd.randint(0, 59))
+            config = ScheduleConfig(config={
+                'schedule_type': 'T',
+                'base_on_now': False,
+                'T': {'type': 'DAY', 'time': timing_time, 'DAY': {'period': period}}
+            })
+            now = random_datetime(rnd)
+            hour, minute, second = map(int, timing_time.split(':'))
+            first = datetime(now.year, now.month, now.day, hour, minute, second)
+            step = timedelta(days=period)
+            self.assertEqual(config.get_current_time(start_time=now), loop_current_time(first, now, step))
+            self.assertEqual(config.get_next_time(now), loop_next_time(first, now, step))
+
+    def test_continuous_far_start(self):
+        # 1秒周期且开始时间很早时不再逐秒累加
+        config = ScheduleConfig(config={
+            'schedule_type': 'S',
+            'base_on_now': False,
+            'S': {'period': 1, 'schedule_start_time': '2000-01-01 00:00:00'}
+        })
+        now = datetime(2030, 1, 1, 0, 0, 0, 500)
+        self.assertEqual(config.get_current_time(start_time=now), datetime(2030, 1, 1, 0, 0, 1))
+
+
+def loop_times(config, start, end):
+    # 逐个调用get_next_time的结果, 用于校验iter_times
+    times = []
+    schedule_time = config.get_next_time(start)
+    while schedule_time <= end:
+        times.append(schedule_time)
+        schedule_time = config.get_next_time(schedule_time)
+    return times
+
+
+class ScheduleTimesBetweenTest(SimpleTestCase):
+    rounds = 200
+
+    def random_config(self, rnd: random.Random):
+        timing_time = '%02d:%02d:%02d' % (rnd.randint(0, 23), rnd.randint(0, 59), rnd.randint(0, 59))
+        schedule_type = rnd.choice(['S', 'DAY', 'WEEKDAY', 'MONTHDAY', 'C'])
+        if schedule_type == 'S':
+            type_config = {'period': rnd.choice([1, 60, rnd.randint(1, 5000)]),
+                           'schedule_start_time': '2023-01-01 00:00:00'}
+        elif schedule_type == 'C':
+            type_config = {'crontab': rnd.choice(['*/5 * * * *', '0 3 * * *', '15 */2 * * 1-5'])}
+        else:
+            timing_config = {'period': rnd.randint(1, 3)}
+            if schedule_type == 'WEEKDAY':
+                timing_config['weekday'] = sorted(rnd.sample(range(1, 8), rnd.randint(1, 7)))
+            elif schedule_type == 'MONTHDAY':
+                timing_config['period'] = 1
+                timing_config['monthday'] = sorted(rnd.sample(range(1, 29), rnd.randint(1, 5)))
+            type_config = {'type': schedule_type, 'time': timing_time, schedule_type: timing_config}
+            schedule_type = 'T'
+        return ScheduleConfig(config={
+            'schedule_type': schedule_type,
+            'base_on_now': False,
+            schedule_type: type_config
+        })
+
+    def test_iter_times_parity(self):
+        rnd = random.Random(36)
+        for _ in range(self.rounds):
+            config = self.random_config(rnd)
+            start = random_datetime(rnd)
+            end = start + timedelta(days=rnd.randint(0, 60), seconds=rnd.randint(0, 86400))
+            if config.schedule_type == 'S':
+                end = start + timedelta(seconds=config.period_schedule[1] * rnd.randint(0, 300))
+            elif config.schedule_type == 'C':
+                end = start + timedelta(hours=rnd.randint(0, 48))
+            expected = loop_times(config, start, end)
+            self.assertEqual(list(config.iter_times(start, end)), expected, config.config)
+            times = config.times_between(start, end)
+            if hasattr(times, 'tolist'):
+                times = times.tolist()
+            self.assertEqual(times, expected, config.config)
+
+    def test_once(self):
+        config = ScheduleConfig(config={
+            'schedule_type': 'O',
+            'base_on_now': False,
+            'O': {'schedule_start_time': '2023-01-01 00:00:00'}
+        })
+        self.assertEqual(list(config.iter_times(datetime(2023, 1, 1), datetime.max)), [])
+
+
+def random_cron_field(rnd: random.Random, low, high, names=()):
+    r = rnd.random()
+    if r < 0.3:
+        return '*'
+    if r < 0.45:
+        return '*/%d' % rnd.randint(1, high - low + 1)
+    if r < 0.65:
+        a = rnd.randint(low, high)
+        b = rnd.randint(a, high)
+        return '%d-%d' % (a, b) if rnd.random() < 0.5 else '%d-%d/%d' % (a, b, rnd.randint(1, 5))
+    if r < 0.75:
+        return '%d/%d' % (rnd.randint(low, high), rnd.randint(1, 10))
+    if r < 0.8 and names:
+        return rnd.choice(names)
+    return ','.join(str(x) for x in sorted({rnd.randint(low, high) for _ in range(rnd.randint(1, 4))}))
+
+
+def loop_catch_up_times(config, last_time, now, limit):
+    # 逐个计算错过的计划时间, 用于校验直接从now查找的结果
+    times = []
+    next_time = last_time
+    while next_time <= now:
+        times.append(next_time)
+        next_time = config.get_next_time(next_time)
+    return times[-limit:], next_time
+
+
+class CatchUpPolicyTest(SimpleTestCase):
+
+    def get_config(self, catch_up, catch_up_limit=None):
+        return ScheduleConfig(config={
+            'schedule_type': 'S',
+            'base_on_now': False,
+            'catch_up': catch_up,
+            'catch_up_limit': catch_up_limit,
+            'S': {'period': 60, 'schedule_start_time': '2023-01-01 00:00:00'}
+        })
+
+    def test_policies(self):
+        last_time = datetime(2023, 1, 1)
+        now = last_time + timedelta(minutes=5, seconds=30)
+        minutes = [last_time + timedelta(minutes=i) for i in range(7)]
+        self.assertEqual(self.get_config('all').get_catch_up_times(last_time, now, 100), (minutes[:6], minutes[6]))
+        # 超过capacity的计划时间留给下一次调度
+        self.assertEqual(self.get_config('all').get_catch_up_times(last_time, now, 4), (minutes[:4], minutes[4]))
+        self.assertEqual(self.get_config('latest').get_catch_up_times(last_time, now, 100), (minutes[5:6], minutes[6]))
+        self.assertEqual(self.get_config('at_most', 2).get_catch_up_times(last_time, now, 100),
+                         (minutes[4:6], minutes[6]))
+        self.assertEqual(self.get_config('at_most', 3).get_catch_up_times(last_time, now, 2),
+                         (minutes[3:5], minutes[5]))
+        self.assertEqual(self.get_config('latest').get_catch_up_times(now, last_time, 100), ([], now))
+
+    def test_calendar_parity(self):
+        rnd = random.Random(27)
+        for _ in range(200):
+            config = ScheduleTimesBetweenTest.random_config(None, rnd)
+            if not config.is_calendar_based():
+                continue
+            catch_up_limit = rnd.randint(1, 5)
+            config = ScheduleConfig(config=dict(config.config, catch_up='at_most', catch_up_limit=catch_up_limit))
+            last_time = config.get_next_time(random_datetime(rnd))
+            now = last_time + timedelta(seconds=rnd.randint(0, 40 * 86400))
+            self.assertEqual(config.get_catch_up_times(last_time, now, 100),
+                             loop_catch_up_times(config, last_time, now, catch_up_limit))
+
+    def test_calendar_far_last_time(self):
+        # 每分钟执行的计划停了很久, 不逐个计算错过的计划时间
+        config = ScheduleConfig(config={
+            'schedule_type': 'C',
+            'base_on_now': False,
+            'catch_up': 'at_most',
+            'catch_up_limit': 2,
+            'C': {'crontab': '* * * * *'}
+        })
+        now = datetime(2033, 1, 1, 0, 0, 30)
+        start = time.time()
+        times, next_time = config.get_catch_up_times(datetime(2023, 1, 1), now, 100)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(times, [datetime(2032, 12, 31, 23, 59), datetime(2033, 1, 1)])
+        self.assertEqual(next_time, datetime(2033, 1, 1, 0, 1))
+
+
+class ScheduleConfigCacheTest(SimpleTestCase):
+
+    def get_config(self, time_='01:00:00'):
+        return {
+            'schedule_type': 'T',
+            'base_on_now': False,
+            'T': {'type': 'WEEKDAY', 'time': time_, 'WEEKDAY': {'period': 1, 'weekday': [1, 3]}}
+        }
+
+    def test_deep_frozen(self):
+        cache = ScheduleConfigCache()
+        schedule_config = cache.get(self.get_config())
+        with self.assertRaises(TypeError):
+            schedule_config.config['T']['time'] = '02:00:00'
+        with self.assertRaises(AttributeError):
+            schedule_config.config['T']['WEEKDAY']['weekday'].append(5)
+        with self.assertRaises(AttributeError):
+            schedule_config.spread = 10
+        self.assertIs(cache.get(self.get_config()), schedule_config)
+        self.assertEqual(schedule_config.config['T']['time'], '01:00:00')
+
+    def test_key(self):
+        cache = ScheduleConfigCache()
+        config = self.get_config()
+        schedule_config = cache.get(config, key=1)
+        self.assertIs(cache.get(self.get_config(), key=1), schedule_config)
+        self.assertIs(cache.get(self.get_config(), key=2), schedule_config)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        # 计划的配置被修改后重新解析
+        config['T']['time'] = '02:00:00'
+        changed = cache.get(config, key=1)
+        self.assertEqual(changed.config['T']['time'], '02:00:00')
+        self.assertIs(cache.get(self.get_config(), key=2), schedule_config)
+
+
+class LruTtlCacheTest(SimpleTestCase):
+
+    def test_expiry_and_eviction(self):
+        calls = []
+
+        @lru_ttl_cache(maxsize=2, ttl=60)
+        def square(x):
+            calls.append(x)
+            return x * x
+
+        with mock.patch('django_common_task_system.utils.cache.time.time', return_value=1000):
+            self.assertEqual([square(2), square(2), square(3)], [4, 4, 9])
+            self.assertEqual(calls, [2, 3])
+        # ttl内使用缓存, 超过ttl重新计算
+        with mock.patch('django_common_task_system.utils.cache.time.time', return_value=1060):
+            square(2)
+            self.assertEqual(calls, [2, 3])
+        with mock.patch('django_common_task_system.utils.cache.time.time', return_value=1061):
+            square(3)
+            self.assertEqual(calls, [2, 3, 3])
+            # 超过maxsize时淘汰最久未使用的2
+            square(4)
+            square(3)
+            square(2)
+            self.assertEqual(calls, [2, 3, 3, 4, 2])
+            square.cache_clear()
+            square(2)
+            self.assertEqual(calls, [2, 3, 3, 4, 2, 2])
+
+    def test_parse_sentence_lazy_import(self):
+        parse_time = mock.Mock(return_value={
+            'type': 'time_point', 'definition': 'accurate', 'time': ['2024-01-02 15:00:00', '2024-01-02 15:59:59']
+        })
+        _parse_sentence.cache_clear()
+        # jionlp_time在解析时才导入, 替换sys.modules中的模块即可生效
+        with mock.patch.dict('sys.modules', {'jionlp_time': SimpleNamespace(parse_time=parse_time)}):
+            _, config = parse_sentence('明天下午3点')
+            config['O']['schedule_start_time'] = None
+            _, config = parse_sentence('明天下午3点')
+        _parse_sentence.cache_clear()
+        parse_time.assert_called_once_with('明天下午3点')
+        self.assertEqual(config['schedule_type'], 'O')
+        self.assertEqual(config['O']['schedule_start_time'], '2024-01-02 15:00:00')
+
+
+class CompiledCronTest(SimpleTestCase):
+    rounds = 1000
+
+    def test_croniter_parity(self):
+        rnd = random.Random(37)
+        for _ in range(self.rounds):
+            expression = ' '.join([
+                random_cron_field(rnd, 0, 59),
+                random_cron_field(rnd, 0, 23),
+                random_cron_field(rnd, 1, 31),
+                random_cron_field(rnd, 1, 12, ['jan', 'Feb', 'dec']),
+                random_cron_field(rnd, 0, 7, ['mon', 'SUN', 'fri']),
+            ])
+            start_time = random_datetime(rnd, days=800)
+            try:
+                it = croniter(expression, start_time)
+                expected = [it.get_next(datetime) for _ in range(5)]
+            except Exception:
+                # 没有匹配时间的表达式(如2月30日)
+                continue
+            times = []
+            schedule_time = start_time
+            for _ in range(5):
+                schedule_time = get_next_cron_time(expression, schedule_time)
+                times.append(schedule_time)
+            self.assertEqual(times, expected, expression)
+
+    def test_unsupported_fallback(self):
+        start_time = datetime(2024, 2, 10, 3, 4, 5)
+        for expression in ['0 0 L * *', '0 0 15W * *', '0 0 * * 5#2', '0 0 * * * 30']:
+            self.assertIsNone(compile_cron(expression))
+            self.assertEqual(get_next_cron_time(expression, start_time),
+                             croniter(expression, start_time).get_next(datetime))
+
+
+class ScheduleSpreadTest(SimpleTestCase):
+
+    def get_config(self, spread=600):
+        return ScheduleConfig(config={
+            'schedule_type': 'T',
+            'base_on_now': False,
+            'spread': spread,
+            'T': {'type': 'DAY', 'time': '01:00:00', 'DAY': {'period': 1}}
+        })
+
+    def test_offset_stable(self):
+        config = self.get_config()
+        offsets = {config.get_offset(key) for key in range(1000)}
+        self.assertGreater(len(offsets), 400)
+        self.assertTrue(all(timedelta(0) <= offset < timedelta(seconds=600) for offset in offsets))
+        self.assertEqual(config.get_offset(42), self.get_config().get_offset(42))
+        self.assertEqual(self.get_config(spread=0).get_offset(42), timedelta(0))
+
+    def test_next_time_keeps_offset(self):
+        config = self.get_config()
+        start = datetime(2023, 1, 1, 0, 30)
+        for key in range(100):
+            offset = config.get_offset(key)
+            current = config.get_current_time(start_time=start, key=key)
+            self.assertEqual(current, datetime(2023, 1, 1, 1) + offset)
+            next_time = config.get_next_time(current, key=key)
+            self.assertEqual(next_time, datetime(2023, 1, 2, 1) + offset)
+            self.assertEqual(list(config.iter_times(start, datetime(2023, 1, 3, 2), key=key)),
+                             [datetime(2023, 1, d, 1) + offset for d in (1, 2, 3)])
+            times, next_time = config.get_catch_up_times(current, datetime(2023, 1, 3, 2), 100, key=key)
+            self.assertEqual(times, [datetime(2023, 1, d, 1) + offset for d in (1, 2, 3)])
+            self.assertEqual(next_time, datetime(2023, 1, 4, 1) + offset)
+
+
+class MissingTimesDiffTest(SimpleTestCase):
+
+    def test_diff_sorted_times(self):
+        rnd = random.Random(41)
+        for _ in range(200):
+            start = random_datetime(rnd)
+            expected = [start + timedelta(minutes=i) for i in range(rnd.randint(0, 300))]
+            # 日志中可能有不在计划时间上的记录(如手动放入队列的计划)
+            logged = set(rnd.sample(expected, rnd.randint(0, len(expected))))
+            logged.update(start + timedelta(seconds=rnd.randint(0, 20000)) for _ in range(10))
+            missing = list(diff_sorted_times(iter(expected), iter(sorted(logged))))
+            self.assertEqual(missing, [t for t in expected if t not in logged])
+
+
+class ScheduleStartTimeTest(SimpleTestCase):
+
+    def test_start_time_clamped(self):
+        from django_common_task_system.models import Schedule
+        now = datetime(2023, 6, 1, 12, 0, 30)
+        schedule = Schedule(update_time=datetime(2023, 6, 1, 11, 58), config={
+            'schedule_type': 'S',
+            'base_on_now': False,
+            'S': {'period': 60, 'schedule_start_time': '2023-01-01 00:00:00'}
+        })
+        full = get_schedule_times(schedule, end_time=now)
+        self.assertEqual(full, [datetime(2023, 6, 1, 11, 59), datetime(2023, 6, 1, 12, 0)])
+        # 水位线早于计划的更新时间时, 不检查计划修改之前的时间
+        self.assertEqual(get_schedule_times(schedule, start_time=now - timedelta(minutes=10), end_time=now), full)
+        self.assertEqual(get_schedule_times(schedule, start_time='2023-06-01 11:59:30', end_time=now), full[1:])
+
+    def test_start_time_aligned(self):
+        # 按周期累加的计划从水位线开始检查时, 计划时间与全量检查一致
+        from django_common_task_system.models import Schedule
+        now = datetime(2023, 6, 1, 12, 0, 30)
+        schedule = Schedule(update_time=datetime(2023, 1, 1), config={
+            'schedule_type': 'T',
+            'base_on_now': False,
+            'T': {'type': 'DAY', 'time': '08:00:00', 'schedule_start_time': '2023-01-01 08:00:00',
+                  'DAY': {'period': 2}}
+        })
+        full = get_schedule_times(schedule, end_time=now)
+        watermark = datetime(2023, 5, 20, 9, 30, 15)
+        self.assertEqual(get_schedule_times(schedule, start_time=watermark, end_time=now),
+                         [x for x in full if x > watermark])
+
+    def test_own_start_time(self):
+        from django_common_task_system.models import Schedule
+        from django_common_task_system.schedule.util import _get_schedule_own_start_time
+
+        def loop_own_start_time(schedule):
+            # 原先逐个累加的实现
+            start_time = datetime.strptime(schedule.config[schedule.config['schedule_type']]['schedule_start_time'],
+                                           '%Y-%m-%d %H:%M:%S')
+            if start_time < schedule.update_time:
+                for start_time in schedule.schedule_config.iter_times(start_time, datetime.max, key=schedule.task_id):
+                    if start_time >= schedule.update_time:
+                        break
+            return start_time
+
+        configs = [
+            {'schedule_type': 'S', 'S': {'period': 7, 'schedule_start_time': '2023-01-01 00:00:03'}},
+            {'schedule_type': 'S', 'spread': 30, 'S': {'period': 60, 'schedule_start_time': '2023-01-01 00:00:00'}},
+            {'schedule_type': 'T', 'T': {'type': 'DAY', 'time': '08:00:00', 'DAY': {'period': 3},
+                                         'schedule_start_time': '2023-01-01 09:00:00'}},
+            {'schedule_type': 'T', 'spread': 600, 'T': {'type': 'DAY', 'time': '08:00:00', 'DAY': {'period': 1},
+                                                        'schedule_start_time': '2023-01-01 00:00:00'}},
+            {'schedule_type': 'C', 'C': {'crontab': '*/5 * * * *', 'schedule_start_time': '2023-01-01 00:00:00'}},
+        ]
+        rnd = random.Random(43)
+        for i, config in enumerate(configs):
+            config['base_on_now'] = False
+            for _ in range(20):
+                schedule = Schedule(id=i + 1, task_id=i + 1, config=config, update_time=random_datetime(rnd, days=5))
+                self.assertEqual(_get_schedule_own_start_time(schedule), loop_own_start_time(schedule))
+        # 1秒周期且开始时间很早时不再逐秒累加
+        schedule = Schedule(id=10, task_id=10, update_time=datetime(2023, 6, 1, 12, 0, 0, 500), config={
+            'schedule_type': 'S',
+            'base_on_now': False,
+            'S': {'period': 1, 'schedule_start_time': '2020-01-01 00:00:00'}
+        })
+        start = time.perf_counter()
+        self.assertEqual(_get_schedule_own_start_time(schedule), datetime(2023, 6, 1, 12, 0, 1))
+        self.assertLess(time.perf_counter() - start, 0.1)
+
+
+class KeysetPaginationTest(TestCase):
+
+    def test_duplicate_leading_keys(self):
+        from django_common_task_system.models import ScheduleAttempt
+        start = datetime(2023, 1, 1)
+        # 同一个schedule_id有多条记录, 分页边界落在同一个schedule_id中间
+        ScheduleAttempt.objects.bulk_create([
+            ScheduleAttempt(schedule_id=schedule_id, queue='opening', last_status='X',
+                            schedule_time=start + timedelta(minutes=i))
+            for schedule_id in (3, 1, 2) for i in range(schedule_id * 2 + 1)
+        ])
+        queryset = ScheduleAttempt.objects.filter(queue='opening')
+        expected = list(queryset.order_by('schedule_id', 'schedule_time').values_list('id', flat=True))
+        for page_size in (1, 2, 3, 4, 100):
+            pages = list(iter_keyset_pages(queryset.values('id', 'schedule_id', 'schedule_time'),
+                                           page_size=page_size))
+            self.assertTrue(all(len(page) <= page_size for page in pages))
+            self.assertEqual([row['id'] for page in pages for row in page], expected)
+            pages = list(iter_keyset_pages(queryset, page_size=page_size))
+            self.assertEqual([row.id for page in pages for row in page], expected)
+
+
+class MissingSchedulesMappingTest(TestCase):
+    start = datetime(2023, 3, 1)
+    end = datetime(2023, 3, 1, 2)
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from django_common_objects.models import CommonCategory
+        from django_common_task_system.models import Task, Schedule
+        from django_common_task_system import get_schedule_log_model
+        user = User.objects.create(username='missing-test')
+        category = CommonCategory.objects.create(name='missing-test', model='task', user=user)
+        rnd = random.Random(42)
+        self.schedules = []
+        logs = []
+        for i, (period, spread) in enumerate([(60, 0), (300, 0), (420, 120), (900, 0), (600, 0)]):
+            task = Task.objects.create(name='missing-test-%s' % i, category=category, user=user)
+            schedule = Schedule.objects.create(task=task, user=user, update_time=self.start, config={
+                'schedule_type': 'S',
+                'base_on_now': False,
+                'spread': spread,
+                'S': {'period': period, 'schedule_start_time': '2023-03-01 00:00:00'}
+            })
+            times = get_schedule_times(schedule, end_time=self.end)
+            if i == 3:
+                # 没有任何日志
+                times = []
+            for t in times:
+                if rnd.random() < 0.7:
+                    logs.append((schedule.id, 'opening', t))
+                    if rnd.random() < 0.2:
+                        # 重试产生的重复日志
+                        logs.append((schedule.id, 'opening', t))
+                elif rnd.random() < 0.5:
+                    # 其它队列的日志不算
+                    logs.append((schedule.id, 'test', t))
+            self.schedules.append(schedule)
+        # 不在本页的计划的日志
+        logs.append((self.schedules[-1].id + 100, 'opening', self.start + timedelta(minutes=1)))
+        ScheduleLog = get_schedule_log_model()
+        ScheduleLog.objects.bulk_create([
+            ScheduleLog(schedule_id=schedule_id, queue=queue, status='S', result={}, schedule_time=t, create_time=t)
+            for schedule_id, queue, t in logs
+        ])
+
+    def test_same_as_single(self):
+        from django_common_task_system.schedule.util import get_missing_schedules, get_missing_schedules_mapping
+        page = self.schedules[:4]
+        for start_time in (None, self.start + timedelta(minutes=37)):
+            mapping = get_missing_schedules_mapping('opening', page, start_time=start_time, end_time=self.end,
+                                                    chunk_size=7)
+            self.assertEqual(list(mapping), [x.id for x in page])
+            for schedule in page:
+                single = get_missing_schedules('opening', schedule, start_time=start_time, end_time=self.end)
+                self.assertEqual([x.next_schedule_time for x in mapping[schedule.id]],
+                                 [x.next_schedule_time for x in single])
+        self.assertEqual([x.next_schedule_time for x in mapping[self.schedules[3].id]],
+                         get_schedule_times(self.schedules[3], start_time=self.start + timedelta(minutes=37),
+                                            end_time=self.end))
+        self.assertTrue(all(mapping[x.id] for x in page[:3]))
+
+
+class ScheduleForecastTest(TestCase):
+    now = datetime(2023, 3, 1, 12, 0, 0)
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from django_common_objects.models import CommonCategory
+        from django_common_task_system.models import Task, Schedule
+        self.user = User.objects.create(username='forecast-test', is_staff=True, is_superuser=True)
+        category = CommonCategory.objects.create(name='forecast-test', model='task', user=self.user)
+
+        def create(name, config, next_schedule_time):
+            task = Task.objects.create(name=name, category=category, user=self.user)
+            return Schedule.objects.create(task=task, user=self.user, config=config,
+                                           next_schedule_time=next_schedule_time)
+        # 已经错过30分钟的计划
+        create('overdue', {
+            'schedule_type': 'S', 'base_on_now': False,
+            'S': {'period': 600, 'schedule_start_time': '2023-03-01 00:00:00'}
+        }, self.now - timedelta(minutes=30))
+        # 配置相同但分散偏移不同的计划
+        self.spread_config = {
+            'schedule_type': 'S', 'base_on_now': False, 'spread': 600,
+            'S': {'period': 1800, 'schedule_start_time': '2023-03-01 00:00:00'}
+        }
+        self.spread_schedules = []
+        for i in range(2):
+            task_id = Task.objects.create(name='spread-%s' % i, category=category, user=self.user).id
+            offset = ScheduleConfig(config=self.spread_config).get_offset(task_id)
+            self.spread_schedules.append(Schedule.objects.create(
+                task_id=task_id, user=self.user, config=self.spread_config,
+                next_schedule_time=self.now + timedelta(minutes=30) + offset))
+
+    def forecast(self, **kwargs):
+        from django_common_task_system.schedule.util import get_schedule_forecast
+        results = []
+        # numpy和列表两种计算方式结果一致
+        for modules in ({'numpy': None}, {}):
+            with mock.patch.dict('sys.modules', modules):
+                results.append(get_schedule_forecast(now=self.now, **kwargs))
+        self.assertEqual(results[0], results[1])
+        return results[0]
+
+    def test_bucketing(self):
+        forecast = self.forecast(hours=1, bucket=60)
+        expected = {self.now: 1}
+        # 错过的计划计入当前分组, 之后按周期运行
+        for minute in range(10, 61, 10):
+            expected[self.now + timedelta(minutes=minute)] = 1
+        for schedule in self.spread_schedules:
+            t = schedule.next_schedule_time.replace(second=0)
+            expected[t] = expected.get(t, 0) + 1
+        self.assertEqual({x['time']: x['count'] for x in forecast['histogram']}, expected)
+        self.assertEqual((forecast['schedules'], forecast['groups'], forecast['errors']), (3, 3, 0))
+        self.assertEqual(forecast['total'], sum(expected.values()))
+        # 大分组合并同一时间段的运行次数, 结束时间(包含)落在下一组
+        forecast = self.forecast(hours=1, bucket=3600)
+        self.assertEqual(forecast['histogram'], [{'time': self.now, 'count': 6 + 2},
+                                                 {'time': self.now + timedelta(hours=1), 'count': 1}])
+
+    def test_views(self):
+        from django.urls import reverse
+        response = self.client.get(reverse('schedule-forecast'), {'hours': 0})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(reverse('schedule-forecast'), {'hours': 1, 'bucket': 300})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['bucket'], 300)
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('admin:schedule-forecast-view'), {'hours': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['hours'], 1)
+
+
+class ScheduleAttemptTest(TestCase):
+    schedule_time = datetime(2023, 1, 1, 8)
+
+    def log(self, log_id, status, minutes=0, schedule_id=1):
+        return SimpleNamespace(id=log_id, status=status, queue='opening', schedule_id=schedule_id,
+                               schedule_time=self.schedule_time,
+                               create_time=self.schedule_time + timedelta(minutes=minutes))
+
+    def get_attempt(self, schedule_id=1):
+        from django_common_task_system.models import ScheduleAttempt
+        return ScheduleAttempt.objects.get(queue='opening', schedule_id=schedule_id, schedule_time=self.schedule_time)
+
+    def test_out_of_order(self):
+        from django_common_task_system.models import ScheduleAttempt
+        ScheduleAttempt.update_from_log(self.log(5, 'X', minutes=2))
+        # 先写入的日志后到达, 只增加次数, 不覆盖最后状态
+        ScheduleAttempt.update_from_log(self.log(3, 'S', minutes=1))
+        attempt = self.get_attempt()
+        self.assertEqual((attempt.attempts, attempt.last_status, attempt.last_log_id), (2, 'X', 5))
+        self.assertEqual(attempt.update_time, self.schedule_time + timedelta(minutes=2))
+
+    def test_success_clears_retry(self):
+        from django_common_task_system.models import ScheduleAttempt
+        from django_common_task_system.schedule.util import get_retryable_records
+        ScheduleAttempt.update_from_log(self.log(1, 'X'))
+        ScheduleAttempt.objects.update(next_retry_time=self.schedule_time + timedelta(minutes=1))
+        self.assertEqual([x['log_id'] for x in get_retryable_records('opening')], [1])
+        ScheduleAttempt.update_from_log(self.log(2, 'S', minutes=1))
+        attempt = self.get_attempt()
+        self.assertEqual((attempt.attempts, attempt.last_status, attempt.next_retry_time), (2, 'S', None))
+        self.assertEqual(list(get_retryable_records('opening')), [])
+
+    def test_concurrent_create(self):
+        from django.db import transaction
+        from django_common_task_system.models import ScheduleAttempt
+        atomic = transaction.atomic
+
+        def racing_atomic(*args, **kwargs):
+            # 查询不到记录后、创建记录前, 其它进程先写入了同一个计划时间的日志
+            ScheduleAttempt.objects.create(queue='opening', schedule_id=1, schedule_time=self.schedule_time,
+                                           attempts=1, last_status='X', last_log_id=7)
+            return atomic(*args, **kwargs)
+        with mock.patch.object(transaction, 'atomic', racing_atomic):
+            ScheduleAttempt.update_from_log(self.log(9, 'S'))
+        attempt = self.get_attempt()
+        self.assertEqual((attempt.attempts, attempt.last_status, attempt.last_log_id), (2, 'S', 9))
+
+
+class LogRetentionTest(TestCase):
+    now = datetime(2023, 3, 1)
+
+    def setUp(self):
+        from django_common_task_system import get_schedule_log_model
+        from django_common_task_system.models import ScheduleAttempt
+        ScheduleLog = get_schedule_log_model()
+        # 每12小时一条日志, 保留10天时前21条保留
+        ScheduleLog.objects.bulk_create([
+            ScheduleLog(schedule_id=1, queue='opening', status='S', result={'msg': '完成'},
+                        schedule_time=t, create_time=t)
+            for t in (self.now - timedelta(hours=12 * i) for i in range(40))
+        ])
+        ScheduleAttempt.objects.bulk_create([
+            ScheduleAttempt(schedule_id=1, queue='opening', last_status='S', schedule_time=t, update_time=t)
+            for t in (self.now - timedelta(days=15), self.now - timedelta(days=5))
+        ])
+        self.cutoff = self.now - timedelta(days=10)
+        self.expired = set(ScheduleLog.objects.filter(create_time__lt=self.cutoff).values_list('id', flat=True))
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path, ignore_errors=True)
+
+    def read_archive(self):
+        rows = []
+        for file in glob.glob(os.path.join(self.path, '*.ndjson.gz')):
+            with gzip.open(file, 'rt', encoding='utf-8') as f:
+                day_rows = [json.loads(line) for line in f]
+            self.assertEqual({x['create_time'][:10] for x in day_rows}, {file.split('-', 1)[1][:10]})
+            rows.extend(day_rows)
+        return rows
+
+    def test_chunks_and_archive(self):
+        from django_common_task_system import get_schedule_log_model
+        from django_common_task_system.models import ScheduleAttempt
+        from django_common_task_system.schedule.retention import LogRetention
+        result = LogRetention(retention_days=10, chunk_size=7, pause=0, archive_path=self.path).run(now=self.now)
+        self.assertEqual(len(self.expired), 19)
+        self.assertEqual((result['deleted'], result['chunks'], result['attempts_deleted']), (19, 3, 1))
+        self.assertEqual(sum(result['archive'].values()), 19)
+        self.assertEqual(get_schedule_log_model().objects.filter(create_time__lt=self.cutoff).count(), 0)
+        self.assertEqual(get_schedule_log_model().objects.count(), 21)
+        self.assertEqual(ScheduleAttempt.objects.count(), 1)
+        rows = self.read_archive()
+        self.assertEqual(sorted(x['id'] for x in rows), sorted(self.expired))
+        self.assertEqual(rows[0]['result'], {'msg': '完成'})
+
+    def test_rerun_after_failed_delete(self):
+        from django_common_task_system.schedule.retention import LogRetention
+        retention = LogRetention(retention_days=10, chunk_size=7, pause=0, archive_path=self.path)
+        with mock.patch('django.db.models.query.QuerySet.delete', side_effect=RuntimeError('database is down')):
+            with self.assertRaises(RuntimeError):
+                retention.run(now=self.now)
+        retention.run(now=self.now)
+        # 删除失败时已归档的批次重新执行时覆盖, 不会重复
+        self.assertEqual(sorted(x['id'] for x in self.read_archive()), sorted(self.expired))
+
+
+class ListQueue(list):
+
+    def put(self, item, deliver_at=None):
+        self.append(item)
+
+    def qsize(self):
+        return len(self)
+
+
+class FailingQueue(ListQueue):
+
+    def put(self, item, deliver_at=None):
+        if len(self) == 1:
+            raise RuntimeError('queue is down')
+        self.append(item)
+
+
+class FakeHashAgent(dict):
+
+    def hset(self, name, key, value):
+        self.setdefault(name, {})[key] = value
+
+    def hgetall(self, name):
+        return dict(self.get(name, {}))
+
+    def hdel(self, name, key):
+        self.get(name, {}).pop(key, None)
+
+
+class ProducerTestMixin:
+    now = datetime(2023, 3, 1, 12, 0, 0)
+    schedule_count = 6
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from django_common_objects.models import CommonCategory
+        from django_common_task_system.models import Task, Schedule
+        user = User.objects.create(username='producer-test')
+        category = CommonCategory.objects.create(name='producer-test', model='task', user=user)
+        config = {
+            'schedule_type': 'S',
+            'base_on_now': False,
+            'S': {'period': 60, 'schedule_start_time': '2023-03-01 00:00:00'}
+        }
+        # 每个计划在now之前错过3次
+        for i in range(self.schedule_count):
+            task = Task.objects.create(name='producer-test-%s' % i, category=category, user=user)
+            Schedule.objects.create(task=task, user=user, config=config,
+                                    next_schedule_time=self.now - timedelta(seconds=150))
+        self.schedule_producer = SimpleNamespace(name='producer-test', lte_now=True, queue=SimpleNamespace(code='test'),
+                                                 filters={'task__name__startswith': 'producer-test'})
+
+    @staticmethod
+    def create_producer(**kwargs):
+        from django.test import override_settings
+        from django_common_task_system.producer import Producer
+        with override_settings(**kwargs):
+            return Producer()
+
+    def get_schedules(self, producer):
+        return [x for chunk in producer.iter_chunks(producer.get_queryset(self.schedule_producer, self.now))
+                for x in chunk]
+
+
+class ProducerModeTest(ProducerTestMixin, TestCase):
+
+    def test_coordinator_lease(self):
+        from django_common_task_system.producer import ProducerCoordinator
+        agent = FakeHashAgent()
+        with mock.patch('django_common_task_system.producer.cache_agent', agent):
+            a, b = ProducerCoordinator(lease=10), ProducerCoordinator(lease=10)
+            a.member_id, b.member_id = 'a', 'b'
+            self.assertEqual(a.heartbeat(), (0, 1))
+            self.assertEqual(b.heartbeat(), (1, 2))
+            self.assertEqual(a.heartbeat(), (0, 2))
+            # 租约过期的实例被移除
+            agent.hset(ProducerCoordinator.members_key, 'c', str(time.time() - 60))
+            self.assertEqual(b.heartbeat(), (1, 2))
+            self.assertNotIn('c', agent.hgetall(ProducerCoordinator.members_key))
+            b.leave()
+            self.assertEqual(a.heartbeat(), (0, 1))
+
+    def test_shard_filter(self):
+        from django_common_task_system.choices import ProducerMode
+        producer = self.create_producer(PRODUCER_MODE=ProducerMode.SHARD.value)
+        shards = []
+        producer.coordinator.total = 2
+        for index in range(2):
+            producer.coordinator.index = index
+            ids = [x.id for x in self.get_schedules(producer)]
+            self.assertTrue(ids)
+            self.assertEqual({x % 2 for x in ids}, {index})
+            shards.extend(ids)
+        self.assertEqual(len(set(shards)), self.schedule_count)
+
+    def test_shard_rollback(self):
+        from django_common_task_system.choices import ProducerMode, ScheduleStatus
+        from django_common_task_system.models import Schedule
+        producer = self.create_producer(PRODUCER_MODE=ProducerMode.SHARD.value)
+        schedule = self.get_schedules(producer)[0]
+        queue_instance = SimpleNamespace(code='test', queue=FailingQueue())
+        with self.assertRaises(RuntimeError):
+            producer.produce_schedule(schedule, queue_instance, self.now, 10)
+        # 第二个计划时间放入队列失败, next_schedule_time退回到该时间, 下一轮继续生产
+        schedule = Schedule.objects.get(id=schedule.id)
+        self.assertEqual(schedule.next_schedule_time, self.now - timedelta(seconds=90))
+        self.assertEqual(schedule.status, ScheduleStatus.ERROR.value)
+        self.assertEqual(len(queue_instance.queue), 1)
+
+    def test_claim_batch(self):
+        from django_common_task_system.choices import ProducerMode
+        from django_common_task_system.models import Schedule
+        producer = self.create_producer(PRODUCER_MODE=ProducerMode.CLAIM.value, PRODUCER_CLAIM_BATCH_SIZE=2)
+        queue_instance = SimpleNamespace(code='test', queue=ListQueue())
+        put_size = producer.produce_queue(self.schedule_producer, queue_instance, self.now, 100)
+        # 每次最多认领claim_batch_size个计划
+        self.assertEqual(put_size, 6)
+        self.assertEqual(len({x['id'] for x in queue_instance.queue}), 2)
+        self.assertEqual(Schedule.objects.filter(next_schedule_time__lte=self.now).count(), self.schedule_count - 2)
+
+
+class ProducerRoundTest(ProducerTestMixin, TestCase):
+
+    def setUp(self):
+        super(ProducerRoundTest, self).setUp()
+        from django_common_task_system.builtins import builtins
+        self.queue_instance = SimpleNamespace(code='test', queue=ListQueue())
+        for name, value in (('schedule_queues', {'test': self.queue_instance}),
+                            ('schedule_producers', {})):
+            patcher = mock.patch.object(builtins, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # 测试事务中不能关闭数据库连接
+        patcher = mock.patch('django_common_task_system.producer.close_old_connections')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_overlapping_producers(self):
+        producer = self.create_producer()
+        # 两个过滤条件重叠的生产者同时读到同一个计划, 只有CAS成功的放入队列
+        first, second = self.get_schedules(producer)[0], self.get_schedules(producer)[0]
+        self.assertEqual(producer.produce_schedule(first, self.queue_instance, self.now, 10), 3)
+        self.assertEqual(producer.produce_schedule(second, self.queue_instance, self.now, 10), 0)
+        self.assertEqual(len(self.queue_instance.queue), 3)
+
+    def test_budget(self):
+        from django_common_task_system.models import Schedule
+        producer = self.create_producer(PRODUCER_BUDGET=4)
+        code, put_size, sleep_seconds, metrics = producer.produce_producer(self.schedule_producer, self.now)
+        # 额度用完后剩余的计划时间留到下一轮, 并且不再休眠
+        self.assertEqual((code, put_size, sleep_seconds), ('test', 4, 0))
+        self.assertEqual(metrics.items, {'test': 4})
+        self.assertEqual(len(self.queue_instance.queue), 4)
+        self.assertEqual(Schedule.objects.filter(next_schedule_time__lte=self.now).count(), self.schedule_count - 1)
+        producer = self.create_producer()
+        self.assertEqual(producer.produce_producer(self.schedule_producer, self.now)[1], 3 * self.schedule_count - 4)
+
+    def test_time_slice(self):
+        producer = self.create_producer(PRODUCER_TIME_SLICE=0)
+        self.assertEqual(producer.produce_producer(self.schedule_producer, self.now)[1:3], (0, 0))
+        self.assertEqual(self.queue_instance.queue, [])
+
+    def test_rotation(self):
+        from django_common_task_system.builtins import builtins
+        from django_common_task_system.producer import ProduceMetrics
+        producer = self.create_producer(PRODUCER_WORKERS=1)
+        self.addCleanup(producer.executor.shutdown)
+        order = []
+
+        def produce_producer(schedule_producer, now):
+            order.append(schedule_producer.name)
+            return 'test', 1, 10, ProduceMetrics()
+        producer.produce_producer = produce_producer
+        producer.state.push = mock.Mock()
+        builtins.schedule_producers.update((x, SimpleNamespace(name=x)) for x in 'abc')
+        rounds = []
+        for _ in range(3):
+            order.clear()
+            producer.produce()
+            rounds.append(''.join(order))
+        # 每轮轮换提交顺序
+        self.assertEqual(rounds, ['bca', 'cab', 'abc'])
+        self.assertEqual(producer.state.scheduled_count, 9)
+
+
+class ProducerObjectCacheTest(ProducerTestMixin, TestCase):
+
+    def produce_round(self, producer):
+        producer.task_cache.refresh()
+        producer.callback_cache.refresh()
+        return self.get_schedules(producer)
+
+    def test_query_count(self):
+        from django_common_task_system.models import Task
+        producer = self.create_producer(PRODUCE_CHUNK_SIZE=2)
+        # 第一轮: 读取计划, 每块加载任务和标签
+        with self.assertNumQueries(1 + 3 * 2):
+            schedules = self.produce_round(producer)
+        self.assertEqual(len(schedules), self.schedule_count)
+        # 缓存命中: 读取计划和一次修改检查, 回调缓存为空时不查询
+        with self.assertNumQueries(2):
+            schedules = self.produce_round(producer)
+        self.assertEqual({x.task.name for x in schedules}, {'producer-test-%s' % i for i in range(self.schedule_count)})
+        task = Task.objects.get(name='producer-test-0')
+        task.description = 'changed'
+        task.save()
+        # 修改过的任务重新加载
+        with self.assertNumQueries(2 + 2):
+            schedules = self.produce_round(producer)
+        self.assertEqual([x.task.description for x in schedules if x.task.id == task.id], ['changed'])
+
+
+class ProducerWakeupTest(ProducerTestMixin, TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(ProducerWakeupTest, cls).setUpClass()
+        ensure_cache_service()
+
+    def setUp(self):
+        super(ProducerWakeupTest, self).setUp()
+        from django_common_task_system.producer import wait_producer_notification
+        import importlib
+        # 注册post_save唤醒
+        importlib.import_module('django_common_task_system.views')
+        # 清理之前遗留的通知
+        wait_producer_notification(timeout=0.01)
+
+    def test_save_wakes_producer(self):
+        from django_common_task_system.models import Schedule
+        from django_common_task_system.producer import notify_producer
+        producer = self.create_producer(PRODUCER_MAX_SLEEP=30)
+        rounds = []
+
+        def produce():
+            rounds.append(time.time())
+            return producer.max_sleep
+        producer.produce = produce
+        producer._event.set()
+        thread = threading.Thread(target=producer.run, daemon=True)
+        thread.start()
+        # 结束时停止生产线程并唤醒
+        self.addCleanup(thread.join, 5)
+        self.addCleanup(notify_producer)
+        self.addCleanup(producer._event.clear)
+        while not rounds:
+            time.sleep(0.01)
+        schedule = Schedule.objects.first()
+        # 生产线程自身的更新不唤醒
+        schedule.save(update_fields=('next_schedule_time', ))
+        time.sleep(0.3)
+        self.assertEqual(len(rounds), 1)
+        saved = time.time()
+        schedule.save()
+        deadline = time.time() + 5
+        while len(rounds) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(rounds), 2)
+        self.assertLess(rounds[1] - saved, 1)
+
+
+class ProduceMetricsTest(SimpleTestCase):
+
+    @staticmethod
+    def make_metrics(rows, items, lag, cost):
+        from django_common_task_system.producer import ProduceMetrics
+        metrics = ProduceMetrics()
+        metrics.rows, metrics.items, metrics.lag = rows, items, lag
+        metrics.query = metrics.compute = metrics.serialize = metrics.enqueue = cost
+        return metrics
+
+    def test_merge(self):
+        metrics = self.make_metrics(3, {'opening': 2}, 1.5, 0.1)
+        metrics.merge(self.make_metrics(4, {'opening': 1, 'test': 3}, 0.5, 0.2))
+        self.assertEqual(metrics.to_dict(), {
+            'rows': 7, 'items': {'opening': 3, 'test': 3}, 'lag': 1.5,
+            'query': 0.3, 'compute': 0.3, 'serialize': 0.3, 'enqueue': 0.3,
+        })
+
+    def test_summary(self):
+        from django_common_task_system.producer import summarize_metrics
+        self.assertEqual(summarize_metrics([]), {})
+        window = [dict(self.make_metrics(10, {'opening': 4}, 2, 0.1).to_dict(), time=100),
+                  dict(self.make_metrics(20, {'opening': 2, 'test': 6}, 1, 0.3).to_dict(), time=104)]
+        summary = summarize_metrics(window)
+        self.assertEqual({k: summary[k] for k in ('ticks', 'rows', 'items', 'lag', 'max_lag', 'enqueue_rate')}, {
+            'ticks': 2, 'rows': 30, 'items': {'opening': 6, 'test': 6}, 'lag': 1, 'max_lag': 2, 'enqueue_rate': 3.0
+        })
+        self.assertEqual(summary['avg_query'], 0.2)
+        # 只有一轮时生产速率为生产数量
+        self.assertEqual(summarize_metrics(window[:1])['enqueue_rate'], 4)
+
+    def test_window(self):
+        from django.test import override_settings
+        from django_common_task_system.builtins import builtins
+        from django_common_task_system.producer import Producer, summarize_metrics
+        with override_settings(PRODUCER_METRICS_WINDOW=2):
+            producer = Producer()
+        producer.state.push = mock.Mock()
+        with mock.patch.object(builtins, 'schedule_producers', {}):
+            for _ in range(3):
+                producer.produce()
+        # 只保留最近的轮次, 推送的统计可以直接汇总
+        metrics = json.loads(producer.state.push.call_args.kwargs['metrics'])
+        self.assertEqual(len(metrics), 2)
+        self.assertEqual(summarize_metrics(metrics)['ticks'], 2)
+
+
+class CheckSchedulesTest(SimpleTestCase):
+
+    def test_check_schedules(self):
+        schedule = {'schedule_time': '2023-01-01 00:00:00', 'task': {'id': 1}, 'id': 1, 'queue': 'opening'}
+        self.assertIsNone(check_schedules([schedule, schedule]))
+        self.assertEqual(check_schedules([schedule, dict(schedule, task=None)]), '第1个schedule缺少task字段')
+
+
+class RetryDelayTest(SimpleTestCase):
+
+    def test_backoff_bounds(self):
+        rnd = random.Random(48)
+        for attempts in range(1, 12):
+            delay = min(60 * 2 ** (attempts - 1), 3600)
+            delays = [get_retry_delay(attempts, base=60, factor=2, max_delay=3600, rnd=rnd).total_seconds()
+                      for _ in range(200)]
+            self.assertTrue(all(delay / 2 <= x <= delay for x in delays))
+            # 同一次数的重试分散在区间内
+            self.assertGreater(max(delays) - min(delays), delay / 4)
+
+
+class FakeExecutor:
+    parent = None
+    concurrency = None
+
+    def __init__(self, name, concurrency=None):
+        self.name = name
+        self.concurrency = concurrency
+
+
+class ExecutorPoolTest(SimpleTestCase):
+
+    def test_concurrency_limit(self):
+        lock = threading.Lock()
+        running = {}
+        peak = {}
+        requeued = []
+
+        def handler(executor):
+            with lock:
+                running[executor.name] = running.get(executor.name, 0) + 1
+                peak[executor.name] = max(peak.get(executor.name, 0), running[executor.name])
+            time.sleep(0.02)
+            with lock:
+                running[executor.name] -= 1
+            if executor.name == 'boom':
+                raise RuntimeError('boom')
+
+        pool = ExecutorPool(handler, workers=4, limits={'limited': 2}, requeue=requeued.append)
+        executors = [FakeExecutor('single', concurrency=1) for _ in range(5)] + \
+                    [FakeExecutor('limited') for _ in range(6)] + \
+                    [FakeExecutor('free') for _ in range(8)] + [FakeExecutor('boom')]
+        deadline = time.time() + 5
+        while executors and time.time() < deadline:
+            # 超过限制的计划被放回队列, 稍后重新提交
+            for executor in executors:
+                pool.acquire()
+                pool.submit(executor)
+            executors, requeued[:] = requeued[:], []
+        self.assertEqual(executors, [])
+        pool.drain(timeout=1)
+        self.assertEqual(set(pool._running.values()), {0})
+        self.assertEqual(peak['single'], 1)
+        self.assertEqual(peak['limited'], 2)
+        self.assertGreater(peak['free'], 1)
+
+    def test_limit_requeue(self):
+        event = threading.Event()
+        requeued = []
+        pool = ExecutorPool(lambda executor: event.wait(1), workers=2, requeue=requeued.append)
+        executors = [FakeExecutor('single', concurrency=1) for _ in range(3)]
+        for executor in executors:
+            pool.acquire()
+            pool.submit(executor)
+        # 超过限制的计划放回队列, 不在内存中等待, 也不占用线程
+        self.assertEqual(requeued, executors[1:])
+        self.assertTrue(pool.acquire(timeout=0))
+        pool.release()
+        # 停止时等待正在执行的计划完成
+        threading.Timer(0.1, event.set).start()
+        pool.drain(timeout=1)
+        self.assertEqual(pool._running, {'single': 0})
+
+    def test_shared_limit_requeue(self):
+        event = threading.Event()
+        requeued = []
+        shared = threading.Semaphore(1)
+        pool = ExecutorPool(lambda executor: event.wait(1), workers=2,
+                            shared_limits={'single': shared}, requeue=requeued.append)
+        executors = [FakeExecutor('single') for _ in range(3)]
+        for executor in executors:
+            pool.acquire()
+            pool.submit(executor)
+        # 拿不到共享信号量的计划放回队列, 不占用线程
+        self.assertEqual(requeued, executors[1:])
+        self.assertTrue(pool.acquire(timeout=0))
+        pool.release()
+        event.set()
+        pool.drain(timeout=1)
+        self.assertTrue(shared.acquire(blocking=False))
+
+
+class ExceptionHandlerTest(SimpleTestCase):
+
+    def test_result_accumulates_pages(self):
+        from django_common_task_system.system_task_execution.system_task_execution.executors import exception
+        from django_common_task_system.system_task_execution.system_task_execution.consumer import PartialFailed
+        from django_common_task_system.queue.service import QueueServiceError
+        t = datetime(2023, 3, 1)
+        pages = [[SimpleNamespace(schedule_id=i, schedule_time=t, attempts=1) for i in ids] for ids in ([1, 2], [3])]
+        schedules = {i: SimpleNamespace(id=i) for i in range(1, 4)}
+        service = mock.Mock(**{'qsize.return_value': 0,
+                               'put_many.side_effect': [QueueServiceError('queue is full'), 1]})
+        util = SimpleNamespace(get_pending_retry_attempts=mock.Mock(), iter_keyset_pages=lambda qs, page_size: pages,
+                               get_retry_delay=get_retry_delay)
+        schedule_model = mock.Mock(**{'objects.in_bulk.side_effect': lambda ids: {i: schedules[i] for i in ids}})
+        with mock.patch.multiple(exception, queue_service=service, schedule_util=util, Schedule=schedule_model,
+                                 ScheduleSerializer=lambda x: SimpleNamespace(data={'id': x.id}),
+                                 ScheduleAttempt=mock.Mock()):
+            handler = exception.ExceptionHandler(SimpleNamespace(task=SimpleNamespace(config={'queues': ['opening']})))
+            with self.assertRaises(PartialFailed) as cm:
+                handler.execute()
+        # 第一页投递失败, 第二页成功, 失败信息不能被覆盖
+        self.assertEqual(cm.exception.args[0], {
+            'opening': {'message': 'put 1 schedules to opening', 'error': ['queue is full']}
+        })
+
+
+class ConsumerTest(SimpleTestCase):
+
+    def test_get_timeout_none(self):
+        from django_common_task_system.system_task_execution.system_task_execution.consumer import Consumer
+        calls = []
+
+        class TimeoutQueue:
+            def get(self, timeout=None):
+                calls.append(timeout)
+                if len(calls) == 6:
+                    consumer._event.clear()
+                return None
+
+        consumer = Consumer(queue=TimeoutQueue())
+        consumer.state = mock.Mock()
+        consumer.on_failed = mock.Mock()
+        consumer._event.set()
+        # 线程没有释放时循环不会结束, 超时后强制停止
+        timer = threading.Timer(5, consumer._event.clear)
+        timer.start()
+        self.addCleanup(timer.cancel)
+        consumer.run()
+        # 超时返回None不当作失败的计划, 线程数(4)以上的读取次数说明线程都已释放
+        self.assertEqual(len(calls), 6)
+        consumer.on_failed.assert_not_called()
+
+
+def hold_semaphore(semaphore, acquired, release):
+    semaphore.acquire()
+    acquired.set()
+    release.wait(5)
+    semaphore.release()
+
+
+class PreforkConsumerTest(SimpleTestCase):
+
+    def create_process(self, **kwargs):
+        from django_common_task_system.system_task_execution.process import ScheduleConsumerProcess
+        consumer = ScheduleConsumerProcess(**kwargs)
+        consumer.on_processed = mock.Mock()
+        consumer._event.set()
+        return consumer
+
+    def test_recycle_max_tasks(self):
+        consumer = self.create_process(max_tasks=3)
+        executor = mock.Mock()
+        for _ in range(2):
+            consumer.process(executor)
+        self.assertTrue(consumer._event.is_set())
+        # 达到max_tasks后不再取新的计划, 由supervisor重新fork
+        consumer.process(executor)
+        self.assertFalse(consumer._event.is_set())
+        self.assertEqual(executor.start.call_count, 3)
+        self.assertEqual(consumer.processed, 3)
+
+    def test_recycle_max_memory(self):
+        consumer = self.create_process(max_memory=100)
+        with mock.patch('django_common_task_system.system_task_execution.process.get_rss',
+                        side_effect=[50 * 1024 * 1024, 101 * 1024 * 1024]):
+            consumer.process(mock.Mock())
+            self.assertTrue(consumer._event.is_set())
+            consumer.process(mock.Mock())
+            self.assertFalse(consumer._event.is_set())
+        # 不限制时一直运行
+        consumer = self.create_process()
+        with mock.patch('django_common_task_system.system_task_execution.process.get_rss') as get_rss:
+            for _ in range(5):
+                consumer.process(mock.Mock())
+        get_rss.assert_not_called()
+        self.assertTrue(consumer._event.is_set())
+
+    def test_shared_limits(self):
+        from django_common_task_system.system_task_execution import prefork
+        executors = {
+            'single': FakeExecutor('single', concurrency=1),
+            'limited': FakeExecutor('limited'),
+            'free': FakeExecutor('free'),
+        }
+        with mock.patch.dict(prefork.Executor, executors, clear=True), \
+                mock.patch.object(prefork, 'SYSTEM_EXECUTOR_CONCURRENCY', {'limited': 2, 'single': 3}):
+            limits = prefork.ScheduleConsumerSupervisor.get_shared_limits()
+        # 配置覆盖执行器的concurrency, 没有限制的执行器不创建信号量
+        self.assertEqual({k: v.get_value() for k, v in limits.items()}, {'single': 3, 'limited': 2})
+
+    def test_shared_limit_across_processes(self):
+        import multiprocessing
+        context = multiprocessing.get_context('fork')
+        shared = context.Semaphore(1)
+        acquired, release = context.Event(), context.Event()
+        child = context.Process(target=hold_semaphore, args=(shared, acquired, release), daemon=True)
+        child.start()
+        self.addCleanup(child.join, 5)
+        self.addCleanup(release.set)
+        self.assertTrue(acquired.wait(5))
+        requeued = []
+        handled = []
+        pool = ExecutorPool(handled.append, workers=2, shared_limits={'single': shared}, requeue=requeued.append)
+        # 其它进程占用信号量时放回队列
+        executor = FakeExecutor('single')
+        pool.acquire()
+        pool.submit(executor)
+        self.assertEqual((requeued, handled), ([executor], []))
+        release.set()
+        child.join(5)
+        pool.acquire()
+        pool.submit(executor)
+        pool.drain(timeout=1)
+        self.assertEqual(handled, [executor])
+        # 执行完成后释放, 其它进程可以继续获取
+        self.assertEqual(shared.get_value(), 1)
+
+    def test_respawn(self):
+        from django_common_task_system.system_task_execution.prefork import ScheduleConsumerSupervisor
+        supervisor = ScheduleConsumerSupervisor(processes=2)
+        supervisor.state = mock.Mock()
+        spawned = []
+
+        def spawn(shared_limits):
+            # 模拟立即退出的子进程, 第4次fork后停止
+            pid = os.fork()
+            if pid == 0:
+                os._exit(0)
+            spawned.append(pid)
+            supervisor.workers[pid] = time.time()
+            if len(spawned) == 4:
+                supervisor._event.clear()
+
+        supervisor.spawn = spawn
+        with mock.patch('django_common_task_system.system_task_execution.prefork.load_executors'), \
+                mock.patch.object(ScheduleConsumerSupervisor, 'get_shared_limits', return_value={}):
+            supervisor.run()
+        # 子进程退出后重新fork, 停止时回收全部子进程
+        self.assertEqual(len(spawned), 4)
+        self.assertEqual(supervisor.workers, {})
+        for pid in spawned:
+            with self.assertRaises(ChildProcessError):
+                os.waitpid(pid, os.WNOHANG)
+
+
+def ensure_cache_service():
+    """
+    测试进程中没有缓存服务时在后台线程中启动
+    """
+    from django_common_task_system.cache_service import CacheAgent, start_cache_service
+    agent = CacheAgent()
+    try:
+        agent.ping()
+        return
+    except ConnectionRefusedError:
+        threading.Thread(target=start_cache_service, daemon=True).start()
+    for _ in range(50):
+        time.sleep(0.1)
+        try:
+            agent.ping()
+            return
+        except ConnectionRefusedError:
+            pass
+    raise RuntimeError('cache service not started')
+
+
+class LocalQueueServiceTest(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(LocalQueueServiceTest, cls).setUpClass()
+        ensure_cache_service()
+
+    def setUp(self):
+        from django_common_task_system.queue.socket import SocketQueue
+        from django_common_task_system.queue.service import LocalQueueService
+        self.queue = SocketQueue('test:%s' % uuid.uuid4().hex)
+        self.service = LocalQueueService()
+        patcher = mock.patch.object(LocalQueueService, 'get_queue', return_value=self.queue)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.queue.agent.delete, self.queue.name)
+
+    @staticmethod
+    def make_schedules(ids):
+        return [{'id': i, 'task': {'id': 1}, 'queue': 'opening', 'schedule_time': '2023-03-01 00:00:00'} for i in ids]
+
+    def test_put_many(self):
+        self.assertEqual(self.service.put_many(self.queue.name, self.make_schedules(range(3))), 3)
+        self.assertEqual([self.queue.get(timeout=1)['id'] for _ in range(3)], [0, 1, 2])
+
+    def test_deliver_at(self):
+        deliver_at = time.time() + 0.5
+        schedules = self.make_schedules(range(2))
+        self.assertEqual(self.service.put_many(self.queue.name, schedules, deliver_at=[deliver_at] * 2), 2)
+        # 投递时间之前读不到
+        self.assertEqual(self.service.qsize(self.queue.name), 0)
+        with self.assertRaises(Empty):
+            self.queue.get_nowait()
+        items = [self.queue.get(timeout=2) for _ in range(2)]
+        self.assertGreaterEqual(time.time(), deliver_at)
+        self.assertEqual(items, schedules)
+
+    def test_invalid_deliver_at(self):
+        from django_common_task_system.queue.service import QueueServiceError
+        with self.assertRaises(QueueServiceError):
+            self.service.put_many(self.queue.name, self.make_schedules(range(2)), deliver_at=[time.time()])
+        with self.assertRaises(QueueServiceError):
+            self.service.put_many(self.queue.name, [{'id': 1}])
+        self.assertEqual(self.queue.qsize(), 0)
+
+
+class SocketPriorityQueueTest(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(SocketPriorityQueueTest, cls).setUpClass()
+        ensure_cache_service()
+
+    def test_priority_order(self):
+        from django_common_task_system.queue.socket import SocketPriorityQueue
+        queue = SocketPriorityQueue('test:%s' % uuid.uuid4().hex)
+        self.addCleanup(queue.agent.delete, queue.name)
+        for i, priority in enumerate([1, 5, None, 5]):
+            queue.put({'id': i, 'priority': priority})
+        self.assertEqual(queue.put_many([{'id': 4, 'priority': 1}, {'id': 5, 'priority': 5}, {'id': 6}]), 3)
+        queue.put({'id': 7, 'priority': 9}, deliver_at=time.time() + 0.3)
+        # 优先级高的先出队, 同一优先级先进先出, 没有优先级按0处理
+        self.assertEqual([queue.get(timeout=1)['id'] for _ in range(7)], [1, 3, 5, 0, 4, 2, 6])
+        self.assertEqual(queue.get(timeout=2)['id'], 7)
+        with self.assertRaises(Empty):
+            queue.get(timeout=0.2)
+
+
+def redis_available():
+    try:
+        import redis
+        return redis.Redis(socket_connect_timeout=0.2).ping()
+    except Exception:
+        return False
+
+
+@unittest.skipUnless(redis_available(), 'redis server is not available')
+class RedisQueueTest(SimpleTestCase):
+
+    def create_queue(self, queue_class):
+        queue = queue_class(name='test:%s' % uuid.uuid4().hex)
+        self.addCleanup(queue._redis.delete, queue.name, queue.delayed_name, queue.wakeup_name, '%s:seq' % queue.name)
+        return queue
+
+    def get_in_thread(self, queue, timeout):
+        result = {}
+
+        def get():
+            result['item'] = queue.get(timeout=timeout)
+            result['time'] = time.time()
+        thread = threading.Thread(target=get)
+        thread.start()
+        return thread, result
+
+    def test_delayed_wakeup(self):
+        from django_common_task_system.queue.redis import RedisFIFOQueue
+        queue = self.create_queue(RedisFIFOQueue)
+        # 读取方先阻塞, 之后放入的延迟数据也按投递时间送达
+        queue.max_block_seconds = 30
+        thread, result = self.get_in_thread(queue, timeout=5)
+        time.sleep(0.2)
+        deliver_at = time.time() + 0.5
+        queue.put({'id': 1}, deliver_at=deliver_at)
+        thread.join()
+        self.assertEqual(result['item'], {'id': 1})
+        self.assertGreaterEqual(result['time'], deliver_at)
+        self.assertLess(result['time'] - deliver_at, 0.5)
+
+    def test_priority_delivery(self):
+        from django_common_task_system.queue.redis import RedisPriorityQueue
+        queue = self.create_queue(RedisPriorityQueue)
+        for i, priority in enumerate([1, 5, 3, 5]):
+            queue.put({'id': i, 'priority': priority})
+        queue.put({'id': 9, 'priority': 9}, deliver_at=time.time() + 0.3)
+        # 已到期的延迟数据按优先级移入队列
+        queue.put({'id': 8, 'priority': 4}, deliver_at=time.time() - 1)
+        self.assertEqual([queue.get(timeout=1)['id'] for _ in range(5)], [1, 3, 8, 2, 0])
+        self.assertEqual(queue.qsize(), 0)
+        self.assertEqual(queue.get(timeout=2), {'id': 9, 'priority': 9})
+        with self.assertRaises(Empty):
+            queue.get(timeout=0.2)
+
+    def test_priority_put_many(self):
+        from django_common_task_system.queue.redis import RedisPriorityQueue
+        queue = self.create_queue(RedisPriorityQueue)
+        self.assertEqual(queue.put_many([{'id': i, 'priority': p} for i, p in enumerate([1, 5, 1, 5])]), 4)
+        queue.put({'id': 4, 'priority': 5})
+        self.assertEqual([queue.get(timeout=1)['id'] for _ in range(5)], [1, 3, 4, 0, 2])
+
+    def test_qsize_and_timeout(self):
+        from django_common_task_system.queue.redis import RedisFIFOQueue
+        queue = self.create_queue(RedisFIFOQueue)
+        queue.put({'id': 1}, deliver_at=time.time() - 1)
+        queue.put({'id': 2}, deliver_at=time.time() + 60)
+        # qsize包含已到期的延迟数据, 但不移动数据
+        self.assertEqual(queue.qsize(), 1)
+        self.assertEqual(queue._redis.zcard(queue.delayed_name), 2)
+        self.assertEqual(queue.get(timeout=1), {'id': 1})
+        with self.assertRaises(Empty):
+            queue.get(timeout=0.2)
+        with self.assertRaises(Empty):
+            queue.get_nowait()
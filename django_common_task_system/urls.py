@@ -17,6 +17,7 @@ urlpatterns = [
     path('schedule/get/<int:pk>/', views.ScheduleDetailView.as_view()),
     path('schedule/queue/get/<slug:code>/', views.ScheduleAPI.get, name='schedule-get'),
     path('schedule/queue/status/', views.ScheduleAPI.status, name='schedule-status'),
+    path('schedule/forecast/', views.ScheduleAPI.forecast, name='schedule-forecast'),
     path('schedule/time-parse/', views.ScheduleTimeParseView.as_view()),
     path('exception/', views.ExceptionReportView.as_view(), name='exception-report'),
     path('program/download/<int:task_id>/', views.ProgramDownloadView.as_view(), name='program-download'),
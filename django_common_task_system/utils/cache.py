@@ -1,4 +1,6 @@
 import time
+from collections import OrderedDict
+from threading import Lock
 
 
 _cache = {}
@@ -23,3 +25,30 @@ def ttl_cache(ttl=600):
             return result
         return wrapper
     return fun_decorator
+
+
+def lru_ttl_cache(maxsize=128, ttl=600):
+    """
+    有容量上限的ttl缓存, 超过maxsize时淘汰最久未使用的结果
+    """
+    def fun_decorator(func):
+        cache = OrderedDict()
+        lock = Lock()
+
+        def wrapper(*args):
+            now = time.time()
+            with lock:
+                result, cache_time = cache.get(args, (Empty, 0))
+                if result is not Empty and now - cache_time <= ttl:
+                    cache.move_to_end(args)
+                    return result
+            result = func(*args)
+            with lock:
+                cache[args] = result, now
+                cache.move_to_end(args)
+                while len(cache) > maxsize:
+                    cache.popitem(last=False)
+            return result
+        wrapper.cache_clear = cache.clear
+        return wrapper
+    return fun_decorator
@@ -1,7 +1,140 @@
-from croniter import croniter
-from datetime import datetime
+from croniter import croniter, CroniterError
+from datetime import datetime, timedelta
+from calendar import monthrange
+from functools import lru_cache
+
+
+# 各字段(分、时、日、月、星期)的取值范围
+CRON_FIELD_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+# 最多向后查找的年数, 超过后认为表达式没有匹配的时间(如2月30日), 交给croniter处理
+MAX_SEARCH_YEARS = 8
+
+
+def _field_mask(values, low, high):
+    """
+    将croniter展开后的字段转为位图, 第n位为1表示值n匹配
+    """
+    if values[0] == '*':
+        values = range(low, high + 1)
+    mask = 0
+    for value in values:
+        # L等特殊值不支持
+        if not isinstance(value, int):
+            raise ValueError(value)
+        mask |= 1 << value
+    return mask
+
+
+def _next_bit(mask, n):
+    """
+    返回mask中大于等于n的最低位, 没有时返回None
+    """
+    mask >>= n
+    if not mask:
+        return None
+    return n + (mask & -mask).bit_length() - 1
+
+
+class CompiledCron:
+    """
+    编译后的crontab表达式, 每个字段保存为位图, 通过位扫描计算下一次时间
+    """
+    __slots__ = ('minutes', 'hours', 'days', 'months', 'weekdays', 'day_star', 'weekday_star')
+
+    def __init__(self, expression: str):
+        # 表达式仍由croniter解析, 保证和croniter的语义一致
+        it = croniter(expression)
+        expanded = it.expanded
+        if len(expanded) != 5 or it.nth_weekday_of_month or getattr(it, 'nearest_weekday', None):
+            raise ValueError(expression)
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            _field_mask(values, low, high) for values, (low, high) in zip(expanded, CRON_FIELD_RANGES)
+        )
+        # 7和0都表示周日, 转成isoweekday() % 7
+        if weekdays & (1 << 7):
+            weekdays = (weekdays | 1) & ~(1 << 7)
+        self.weekdays = weekdays
+        # 日期和星期都有限制时满足其一即可
+        self.day_star = expanded[2][0] == '*'
+        self.weekday_star = expanded[4][0] == '*'
+
+    def match_day(self, t: datetime):
+        day = (self.days >> t.day) & 1
+        weekday = (self.weekdays >> (t.isoweekday() % 7)) & 1
+        if self.day_star or self.weekday_star:
+            return day and weekday
+        return day or weekday
+
+    def get_next(self, start_time: datetime) -> datetime:
+        t = start_time.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        max_year = t.year + MAX_SEARCH_YEARS
+        while t.year <= max_year:
+            month = _next_bit(self.months, t.month)
+            if month is None:
+                t = datetime(t.year + 1, 1, 1)
+                continue
+            if month != t.month:
+                t = datetime(t.year, month, 1)
+            if not self.match_day(t):
+                day = _next_bit(self.days, t.day + 1) if self.weekday_star else None
+                if day is not None and day <= monthrange(t.year, t.month)[1]:
+                    # 只限制日期时直接跳到下一个匹配的日期
+                    t = datetime(t.year, t.month, day)
+                elif self.weekday_star:
+                    t = datetime(t.year + t.month // 12, t.month % 12 + 1, 1)
+                else:
+                    t = datetime(t.year, t.month, t.day) + timedelta(days=1)
+                continue
+            hour = _next_bit(self.hours, t.hour)
+            if hour is None:
+                t = datetime(t.year, t.month, t.day) + timedelta(days=1)
+                continue
+            if hour != t.hour:
+                t = t.replace(hour=hour, minute=0)
+            minute = _next_bit(self.minutes, t.minute)
+            if minute is None:
+                t = t.replace(minute=0) + timedelta(hours=1)
+                continue
+            return t.replace(minute=minute)
+        raise ValueError('no matching time for cron expression')
+
+
+@lru_cache(maxsize=1024)
+def compile_cron(cron: str):
+    """
+    按表达式缓存编译结果, 不支持的语法(L、W、#、秒字段等)返回None, 由croniter处理
+    """
+    try:
+        return CompiledCron(cron)
+    except (ValueError, CroniterError):
+        return None
 
 
 def get_next_cron_time(cron, start_time=None, ret_type=datetime):
     start_time = start_time or datetime.now()
+    compiled = compile_cron(cron)
+    if compiled is not None and ret_type is datetime and start_time.tzinfo is None:
+        try:
+            return compiled.get_next(start_time)
+        except ValueError:
+            pass
     return croniter(cron, start_time, ret_type).get_next()
+
+
+def iter_cron_times(cron, start_time=None, ret_type=datetime):
+    """
+    依次生成start_time之后的计划时间, 只解析一次表达式
+    """
+    start_time = start_time or datetime.now()
+    compiled = compile_cron(cron)
+    if compiled is not None and ret_type is datetime and start_time.tzinfo is None:
+        try:
+            while True:
+                start_time = compiled.get_next(start_time)
+                yield start_time
+        except ValueError:
+            pass
+    it = croniter(cron, start_time, ret_type)
+    while True:
+        yield it.get_next()
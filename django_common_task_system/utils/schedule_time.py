@@ -4,6 +4,9 @@
 # datetime: 2023/3/5 15:33
 # software: PyCharm
 from typing import Dict
+from django.conf import settings
+from django_common_task_system.utils.cache import lru_ttl_cache
+import copy
 
 
 def nlp_config_to_schedule_config(nlp_syntax: Dict, sentence=None):
@@ -58,3 +61,21 @@ def nlp_config_to_schedule_config(nlp_syntax: Dict, sentence=None):
                 }
                 timing_config["type"] = "YEAR"
     return config
+
+
+# 相对时间(如"明天下午3点")的解析结果和当前时间有关, 缓存时间不宜过长
+@lru_ttl_cache(maxsize=getattr(settings, 'NLP_PARSE_CACHE_SIZE', 256),
+               ttl=getattr(settings, 'NLP_PARSE_CACHE_TTL', 60))
+def _parse_sentence(sentence):
+    # jionlp_time在第一次解析时才导入
+    from jionlp_time import parse_time
+    result = parse_time(sentence)
+    return result, nlp_config_to_schedule_config(result, sentence=sentence)
+
+
+def parse_sentence(sentence):
+    """
+    解析nlp语句, 返回(jionlp解析结果, 计划配置), 返回的是缓存结果的副本, 可以修改
+    """
+    result, config = _parse_sentence(sentence)
+    return copy.deepcopy(result), copy.deepcopy(config)
@@ -9,7 +9,6 @@ from django.shortcuts import render, redirect
 from django.urls import reverse
 from django.views.decorators.csrf import csrf_exempt
 from django_common_objects.models import CommonCategory
-from jionlp_time import parse_time
 from rest_framework import status
 from rest_framework.decorators import api_view
 from rest_framework.exceptions import NotFound, ValidationError
@@ -18,13 +17,14 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet
 from django_common_task_system.utils.foreign_key import get_model_related
-from django_common_task_system.utils.schedule_time import nlp_config_to_schedule_config
+from django_common_task_system.utils.schedule_time import parse_sentence
 from django_common_objects.rest_view import UserListAPIView, UserRetrieveAPIView
 from rest_framework.request import Request
 from django.http.response import HttpResponse
 from django_common_task_system.schedule import util as schedule_util
-from django_common_task_system.producer import producer_agent
+from django_common_task_system.producer import producer_agent, notify_producer, summarize_metrics
 from django_common_task_system.system_task_execution import consumer_agent
+from django_common_task_system.queue.service import queue_service, QueueNotFound, QueueServiceError
 from django_common_task_system.program import ProgramAction, ProgramAgent, ContainerProgramAction
 from .choices import ConsumerStatus, ScheduleStatus, ConsumerSource, TaskStatus
 from .consumer import ConsumerManager
@@ -34,8 +34,11 @@ from . import models, system_initialized_signal
 from .log import PagedLog
 from typing import List, Dict, Union
 import os
+import json
+import logging
 
 
+logger = logging.getLogger('producer')
 User = models.UserModel
 Task: models.Task = get_task_model()
 Schedule: models.Schedule = get_schedule_model()
@@ -79,6 +82,17 @@ def delete_schedule_queue_permission(sender, instance: models.ScheduleQueuePermi
     builtins.schedule_queue_permissions.delete(instance)
 
 
+@receiver(post_save, sender=Schedule)
+def wakeup_producer(sender, instance: Schedule, created, update_fields=None, **kwargs):
+    # 生产线程自身只更新next_schedule_time和status, 不需要唤醒
+    if update_fields and set(update_fields) <= {'next_schedule_time', 'status'}:
+        return
+    try:
+        notify_producer()
+    except Exception as e:
+        logger.exception('notify producer error: %s', e)
+
+
 @receiver(post_delete, sender=Task)
 def delete_task(sender, instance: Task, **kwargs):
     if instance.config:
@@ -258,22 +272,31 @@ class ScheduleAPI:
     def put_raw(request: Request):
         schedules: List[Dict] = request.data['schedules']
         queue = request.data['queue']
-        queue_instance = getattr(builtins.schedule_queues.get(queue, None), 'queue', None)
-        if queue_instance is None:
-            return Response({'error': '队列(%s)不存在' % queue}, status=status.HTTP_404_NOT_FOUND)
-        check_fields = ['schedule_time', 'task', 'id', 'queue']
-        for i, schedule in enumerate(schedules):
-            for field in check_fields:
-                if schedule.get(field) is None:
-                    return Response({'error': '第%s个schedule缺少%s字段' % (i, field)}, status=status.HTTP_400_BAD_REQUEST)
-        for schedule in schedules:
-            queue_instance.put(schedule)
+        try:
+            queue_service.local.put_many(queue, schedules, deliver_at=request.data.get('deliver_at'))
+        except QueueNotFound as e:
+            return Response({'error': str(e)}, status=status.HTTP_404_NOT_FOUND)
+        except QueueServiceError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         return Response({'message': 'put %s schedules to %s' % (len(schedules), queue)})
 
     @staticmethod
     @api_view(['GET'])
     def status(request):
-        return Response({x: y.queue.qsize() for x, y in builtins.schedule_queues.items()})
+        return Response(queue_service.local.status())
+
+    @staticmethod
+    @api_view(['GET'])
+    def forecast(request: Request):
+        try:
+            hours = int(request.query_params.get('hours', 24))
+            bucket = int(request.query_params.get('bucket', 60))
+        except ValueError:
+            return Response({'error': 'hours和bucket必须为整数'}, status=status.HTTP_400_BAD_REQUEST)
+        if not 0 < hours <= schedule_util.FORECAST_MAX_HOURS or bucket <= 0:
+            return Response({'error': 'hours范围为1-%s, bucket必须大于0' % schedule_util.FORECAST_MAX_HOURS},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return Response(schedule_util.get_schedule_forecast(hours=hours, bucket=bucket))
 
     @staticmethod
     def get_missing_schedules(request):
@@ -339,8 +362,7 @@ class ScheduleTimeParseView(APIView):
         if not sentence:
             return Response({'error': 'sentence is required'}, status=status.HTTP_400_BAD_REQUEST)
         try:
-            result = parse_time(sentence)
-            schedule = nlp_config_to_schedule_config(result, sentence=sentence)
+            result, schedule = parse_sentence(sentence)
             return Response({
                 "jio_result": result,
                 "schedule": schedule
@@ -460,6 +482,17 @@ class ProgramViewMixin:
 class ProducerView(ProgramViewMixin, APIView):
     agent = producer_agent
 
+    def get(self, request: Request, action: str):
+        if action == 'metrics':
+            state = self.agent.state
+            state.pull()
+            metrics = state.metrics
+            if isinstance(metrics, bytes):
+                metrics = metrics.decode()
+            metrics = json.loads(metrics) if metrics else []
+            return Response({"summary": summarize_metrics(metrics), "metrics": metrics})
+        return super(ProducerView, self).get(request, action)
+
 
 class SystemConsumerView(ProgramViewMixin, APIView):
     agent = consumer_agent
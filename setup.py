@@ -12,6 +12,10 @@ setup(
         "PyMySQL>=1.0.2",
         "jionlp-time>=1.0.0",
     ],
+    extras_require={
+        'numpy': ['numpy'],
+        'parquet': ['pyarrow'],
+    },
     include_package_data=True,
     author='cone387',
     maintainer_email='1183008540@qq.com',
@@ -0,0 +1,46 @@
+"""
+对比croniter和编译后的crontab表达式计算下一次时间的耗时
+python -m tests.cron_benchmark
+"""
+import time
+from datetime import datetime, timedelta
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure()
+
+from croniter import croniter
+from django_common_task_system.utils.cron_utils import get_next_cron_time
+
+
+EXPRESSIONS = [
+    '*/5 * * * *',
+    '0 3 * * *',
+    '15 */2 * * 1-5',
+    '0 0 1,15 * *',
+    '30 8 * jan-jun mon',
+]
+
+
+def bench(func, expression, times):
+    start_time = datetime(2023, 1, 1)
+    t = time.perf_counter()
+    for i in range(times):
+        func(expression, start_time + timedelta(minutes=i))
+    return time.perf_counter() - t
+
+
+def croniter_next(expression, start_time):
+    return croniter(expression, start_time).get_next(datetime)
+
+
+def main(times=20000):
+    print('%-20s %12s %12s %8s' % ('expression', 'croniter(s)', 'compiled(s)', 'speedup'))
+    for expression in EXPRESSIONS:
+        a = bench(croniter_next, expression, times)
+        b = bench(get_next_cron_time, expression, times)
+        print('%-20s %12.3f %12.3f %7.1fx' % (expression, a, b, a / b))
+
+
+if __name__ == '__main__':
+    main()